@@ -13,10 +13,11 @@ import os, sys
 import shutil
 import tempfile
 import subprocess
+from bisect import bisect_right
+from time import time
 
 # External dependency.
 from briefcase import *
-from Crypto.Hash import MD4
 
 from PyQt4 import QtCore
 from PyQt4 import QtGui
@@ -157,6 +158,8 @@ class MainWindow(QtGui.QMainWindow):
         for index in range(self.tabWidget.count()):
             vCurrent = self.tabWidget.widget(index)
             vCurrent.close() # Release resources.
+        # Wait for the cancelled background jobs.
+        QtCore.QThreadPool.globalInstance().waitForDone()
         #
         self.close()
         #
@@ -246,7 +249,6 @@ class MainWindow(QtGui.QMainWindow):
         new_tab = CustomTab(self, tab_name, dir, pwd)
         self.tabWidget.addTab(new_tab, ' [ '+tab_name+' ] ') # Add tab to tab widget.
         self.tabWidget.setCurrentWidget(new_tab) # Must enable new tab.
-        new_tab.fRefresh()
 
         self.actionAddFiles.setVisible(True)
         self.actionExport.setVisible(True)
@@ -265,10 +267,8 @@ class MainWindow(QtGui.QMainWindow):
 
     def on_add(self):
         '''
-        Add one or more files in the briefcase.
+        Add one or more files in the briefcase, in background.
         '''
-        #QProgressDialog !!!
-
         vCurrent = self.tabWidget.currentWidget() # Current tab.
         dlg = CustomDialog(vCurrent, 'Add files to briefcase', 'Select the files to be '
             'added. You can specify a password and one or more labels, separated by ";".', 'Add !')
@@ -276,53 +276,73 @@ class MainWindow(QtGui.QMainWindow):
         dlg.exec_()
 
         # Selected files are separated by ";" so must be exploded.
-        dirs = str(dlg.dir.text()).split(';')
+        dirs = [elem for elem in str(dlg.dir.text()).split(';') if elem]
         pwd = str(dlg.pwd.text())
-        compress = dlg.radioZLIB.isChecked()
+        if dlg.radioZLIB.isChecked(): arch = 'zlib'
+        else:                         arch = 'bz2'
 
         if not pwd: pwd = 1 # If password is null, use database default value.
         lbl = str(dlg.lbl.text()) # Labels.
         if not dirs or not dlg.result(): return # If no file was selected, or the dialog was canceled.
         del dlg
 
-        for elem in dirs:
-            if compress:
-                vCurrent.b.AddFile(elem, pwd, lbl, 'zlib')
-            else:
-                vCurrent.b.AddFile(elem, pwd, lbl, 'bz2')
-            file_name = os.path.split(elem)[1]
-            vInfo = vCurrent.b.FileStatistics(file_name)
-            vCurrent.create_button(file_name, vInfo['lastFileSize'], vInfo['versions'])
-
-        vCurrent.fRefresh()
+        def work(b, progress):
+            added = []
+            nbytes = 0
+            for i, elem in enumerate(dirs):
+                if b.AddFile(elem, pwd, lbl, arch) == 0:
+                    added.append(os.path.split(elem)[1])
+                nbytes += os.path.getsize(elem)
+                if progress(i+1, len(dirs), nbytes) is False:
+                    break
+            return added
+
+        def finished(added):
+            for file_name in added:
+                vCurrent.model.invalidate(file_name)
+            vCurrent.index.update(vCurrent.b.GetFileDetails(added))
+            vCurrent.fRefresh()
+
+        vCurrent.run_job('Adding files', len(dirs), work, finished)
         #
 
 
     def on_export(self):
         #
-        #QProgressDialog !!!
-
         vCurrent = self.tabWidget.currentWidget() # Current tab.
         f = QtGui.QFileDialog()
         input = f.getExistingDirectory(vCurrent, 'Select a folder to export into :',
             os.getcwd())
         if input:
             input = str(input.toUtf8())
-            vRet = vCurrent.b.ExportAll(input)
-            QtGui.QMessageBox.information(vCurrent, 'Export', 'Export finished !')
+
+            def work(b, progress):
+                return b.ExportAll(input, progress=progress)
+
+            def finished(ret):
+                QtGui.QMessageBox.information(vCurrent, 'Export', 'Export finished !')
+
+            vCurrent.run_job('Exporting files', len(vCurrent.model.files), work, finished)
         #
 
 
     def on_cleanup(self):
         #
-        #QProgressDialog !!!
-
         vCurrent = self.tabWidget.currentWidget() # Current tab.
         qtMsg = QtGui.QMessageBox.warning(vCurrent, 'Cleanup database ? ...',
             'Are you sure you want to cleanup the database ?', 'Yes', 'No')
         if qtMsg == 0: # Clicked yes.
-            vCurrent.b.Cleanup()
-            QtGui.QMessageBox.information(vCurrent, 'Cleanup', 'Cleanup finished !')
+
+            def work(b, progress):
+                return b.Cleanup(progress=progress)
+
+            def finished(ret):
+                if ret == 0:
+                    QtGui.QMessageBox.information(vCurrent, 'Cleanup', 'Cleanup finished !')
+                else:
+                    QtGui.QMessageBox.warning(vCurrent, 'Cleanup', 'Cleanup was cancelled !')
+
+            vCurrent.run_job('Cleanup database', len(vCurrent.model.files), work, finished)
         #
 
 
@@ -344,7 +364,10 @@ class MainWindow(QtGui.QMainWindow):
 
     def on_show_log(self):
         #
-        logs = self.tabWidget.currentWidget().b.c.execute('select date, msg from _logs_').fetchall()
+        b = self.tabWidget.currentWidget().b
+        # The last messages are written at commit.
+        b._commit()
+        logs = b.c.execute('select date, msg from _logs_').fetchall()
         dlg = QtGui.QDialog(self)
         dlg.setMinimumSize(QtCore.QSize(400, 300))
         dlg.resize(500, self.height()-20)
@@ -511,6 +534,10 @@ class CustomTab(QtGui.QWidget):
         super(CustomTab, self).__init__(parent)
         self.setObjectName(tab_name)
         self.b = Briefcase(database, password)
+        # Background jobs open their own briefcase.
+        self.database = database
+        self.password = password
+        self.jobs = []
 
         self.mainLayout = QtGui.QGridLayout(self)
 
@@ -534,15 +561,22 @@ class CustomTab(QtGui.QWidget):
         self.sortLabel = QtGui.QLabel('&Sort:', self)
         self.sortLabel.setBuddy(self.sortCombo)
 
-        # Area widget to hold the flow layout...
-        self.flowLayout = FlowLayout(parent=None, margin=0, spacing=0)
-        areaWidget = QtGui.QWidget()
-        areaWidget.setLayout(self.flowLayout)
-
-        # The scroll area that will hold the area widget.
-        scrollArea = QtGui.QScrollArea(self)
-        scrollArea.setWidgetResizable(True)
-        scrollArea.setWidget(areaWidget)
+        # The view shows only the files on screen, the model fetches them from the briefcase.
+        self.model = FileListModel(self.b, self)
+        self.view = QtGui.QListView(self)
+        self.view.setViewMode(QtGui.QListView.IconMode)
+        self.view.setResizeMode(QtGui.QListView.Adjust)
+        self.view.setMovement(QtGui.QListView.Static)
+        self.view.setLayoutMode(QtGui.QListView.Batched)
+        self.view.setBatchSize(FileListModel.BATCH)
+        self.view.setUniformItemSizes(True)
+        self.view.setWordWrap(True)
+        self.view.setGridSize(QtCore.QSize(108, 64))
+        self.view.setSelectionMode(QtGui.QAbstractItemView.ExtendedSelection)
+        self.view.setEditTriggers(QtGui.QAbstractItemView.NoEditTriggers)
+        self.view.setModel(self.model)
+        self.view.selectionModel().selectionChanged.connect(self.on_selection)
+        self.view.doubleClicked.connect(self.on_view)
 
         # Horizontal layout, at the bottom
         self.bottomLayout = QtGui.QHBoxLayout()
@@ -586,143 +620,114 @@ class CustomTab(QtGui.QWidget):
         self.mainLayout.addWidget(self.filterBox, 1, 2)
         self.mainLayout.addWidget(self.sortLabel, 1, 3)
         self.mainLayout.addWidget(self.sortCombo, 1, 4)
-        self.mainLayout.addWidget(scrollArea, 2, 1, 4, 4)
+        self.mainLayout.addWidget(self.view, 2, 1, 4, 4)
         self.mainLayout.addLayout(self.bottomLayout, 7, 1, 1, 4)
         self.mainLayout.addWidget(self.propWidget, 8, 1, 1, 4)
 
-        # Setup double click timer. Buttons don't have double click action.
-        self.dblClickTimer = QtCore.QTimer()
-        self.dblClickTimer.setSingleShot(True)
-        self.dblClickTimer.setInterval(250)
-
-        self.BUTTON_W = 108
-        self.BUTTON_H = 64
+        self.selected = []
 
-        self.buttons = {}
-        self.buttons_visible = []
-        self.buttons_selected = []
-        self.item_clicked_old = None
-        self.key_modif = None
-
-        # Populate with icons, each icon represents a file from the Briefcase
-        for file_name in self.b.GetFileList():
-            vInfo = self.b.FileStatistics(file_name)
-            self.create_button(file_name, vInfo['lastFileSize'], vInfo['versions'])
+        # All the names and details are loaded once, filter and sort don't query the briefcase.
+        self.index = FileIndex()
+        self.index.load(self.b.GetFileDetails())
+        self.fRefresh()
         #
 
 
     def closeEvent(self, event):
         #
-        del self.buttons
-        del self.buttons_visible
-        del self.buttons_selected
-        del self.item_clicked_old
-        del self.key_modif
+        # The cancelled jobs still finish later ; their callbacks must not use this tab anymore.
+        for job in self.jobs:
+            job.cancel()
+            job.signals.progress.disconnect()
+            job.signals.finished.disconnect()
+            job.signals.failed.disconnect()
+            job.dialog.close()
+        self.jobs = []
+        self.view.setModel(None)
+        del self.model
+        del self.index
+        del self.selected
         del self.b
         #
         self.close()
         #
 
 
-    def create_button(self, file_name, file_size, versions):
+    def run_job(self, title, total, work, on_finish):
         '''
-        Each button represents a file from the briefcase.
+        Run work(briefcase, progress) in the thread pool, showing a progress dialog.
+        The tab is disabled while its job runs, the other tabs can be used.
+        On_finish(result) is called in the GUI thread.
         '''
-        pushButton = QtGui.QPushButton(self)
-        pushButton.setMinimumSize(QtCore.QSize(self.BUTTON_W, self.BUTTON_H))
-        pushButton.setMaximumSize(QtCore.QSize(self.BUTTON_W, self.BUTTON_H))
-        pushButton.resize(QtCore.QSize(self.BUTTON_W, self.BUTTON_H))
-
-        pushButton.setCheckable(True)
-        pushButton.setFlat(True)
-
-        self.update_button(pushButton, file_name, file_size, versions)
-
-        pushButton.setStyleSheet('''
-        QPushButton {
-        	border-style: outset;
-        	border: 2px solid #999;
-        	border-radius: 5px;
-        	padding: 2px;
-        	margin: 2px;
-        	font: 10px;
-        	text-align: center bottom;
-        	color: #001;
-        	/* background-image: url(Extensions/Default.png);'
-        	background-position: top center; */
-        }
-        QPushButton:pressed { border-style: inset; }
-        QPushButton:checked { border: 2px dashed #f33 }
-        QPushButton:disabled { border: 2px dotted #bbb }''')
-
-        # Connect click event
-        pushButton.clicked.connect(self.on_button_click)
-        # Save pointer
-        self.buttons[file_name] = pushButton
-        self.buttons_visible.append(file_name)
-        # Show the button
-        self.flowLayout.addWidget(pushButton)
-        #
-
-
-    def update_button(self, pushButton, file_name, file_size, versions):
-        '''
-        Update button info.
-        '''
-        # Full name.
-        pushButton.setObjectName(file_name)
-        # Short name.
-        if len(file_name) > 12: pushButton.setText(file_name[:12] + ' (...)')
-        else:                   pushButton.setText(file_name)
-        # Tool tip.
-        pushButton.setToolTip('<pre>%s<br>Size: %i bytes<br>Versions: %i</pre>' % (file_name, file_size, versions))
+        # Write the logs of this tab, the job has its own connection.
+        self.b._commit()
+        self.setEnabled(False)
+
+        job = BriefcaseJob(self.database, self.password, work)
+        dlg = QtGui.QProgressDialog(title, 'Cancel', 0, max(total, 1), self)
+        dlg.setWindowTitle(title)
+        dlg.setWindowModality(QtCore.Qt.NonModal)
+        dlg.setMinimumDuration(500)
+        dlg.setAutoClose(False)
+        dlg.setValue(0)
+        dlg.canceled.connect(job.cancel)
+        job.dialog = dlg
+        ti = time()
+
+        def progress(done, total, nbytes):
+            elapsed = max(time() - ti, 0.001)
+            dlg.setMaximum(max(total, 1))
+            dlg.setValue(done)
+            dlg.setLabelText('%s\n%i / %i files\n%s/s , %.1f files/s' % (title, done, total,
+                human_size(nbytes / elapsed), done / elapsed))
+
+        def done():
+            dlg.close()
+            self.jobs.remove(job)
+            self.setEnabled(True)
+
+        def finished(result):
+            done()
+            on_finish(result)
+
+        def failed(msg):
+            done()
+            QtGui.QMessageBox.critical(self, 'Error on %s' % title.lower(), '<br>%s<br>' % msg)
+
+        job.signals.progress.connect(progress)
+        job.signals.finished.connect(finished)
+        job.signals.failed.connect(failed)
+        self.jobs.append(job)
+        QtCore.QThreadPool.globalInstance().start(job)
 
 
     def fRefresh(self):
         '''
-        Refresh buttons.
-        This function is used when opening, adding, renaming or deleting buttons.
+        Reload the file names in the model, using current sort and filter.
+        This function is used when opening, adding, renaming or deleting files.
         '''
-
-        # Hide all buttons
-        for vButton in self.buttons:
-            self.buttons[vButton].hide()
-        # Reset layout and visible list
-        self.flowLayout.reset()
-        self.buttons_visible = []
-
-        # Current sort and filter...
         ssort = str(self.sortCombo.currentText())
         ffilter = str(self.filterBox.text())
-        if ffilter: ffilter = "file like '%"+ffilter+"%'"
-
-        # Rebuild list of visible buttons.
-        for file_name in self.b.GetFileList(ssort=ssort, ffilter=ffilter):
-            pushButton = self.buttons[file_name]
-            self.buttons_visible.append(file_name)
-            self.flowLayout.addWidget(pushButton)
-            pushButton.show()
 
+        self.model.setFiles(self.index.query(ffilter, ssort))
+        self.on_selection()
 
-    def keyPressEvent(self, event):
 
-        key = event.key()
-
-        if key == QtCore.Qt.Key_Control:
-            self.key_modif = 'ctrl'
-
-        elif key == QtCore.Qt.Key_Shift:
-            self.key_modif = 'shift'
-
-        else:
-            self.key_modif = None
-            super(CustomTab, self).keyPressEvent(event)
+    def current_file(self):
+        '''
+        The name of the file under the cursor, or None.
+        '''
+        index = self.view.currentIndex()
+        if not index.isValid():
+            return None
+        return self.model.files[index.row()]
 
 
-    def keyReleaseEvent(self, event):
-        # Release multiple button selection
-        self.key_modif = None
-        super(CustomTab, self).keyReleaseEvent(event)
+    def on_selection(self, *args):
+        #
+        self.selected = [self.model.files[index.row()] for index in self.view.selectionModel().selectedIndexes()]
+        self.manage_selection()
+        #
 
 
     def manage_selection(self):
@@ -731,7 +736,7 @@ class CustomTab(QtGui.QWidget):
         '''
 
         # When at least one item is selected, show the bottom area
-        if self.buttons_selected:
+        if self.selected:
             self.propWidget.show()
             for btnBtm in self.btmBtns:
                 btnBtm.show()
@@ -743,10 +748,10 @@ class CustomTab(QtGui.QWidget):
                 btnBtm.hide()
 
         # When a single item is selected...
-        if len(self.buttons_selected) == 1:
+        if len(self.selected) == 1:
             self.btmBtns[2].setEnabled(True)
             self.btmBtns[3].setEnabled(True)
-            prop = self.b.FileStatistics(fname=self.buttons_selected[0])
+            prop = self.b.FileStatistics(fname=self.selected[0])
 
             if not prop:
                 QtGui.QMessageBox.critical(self, 'Error on properties',
@@ -785,18 +790,10 @@ class CustomTab(QtGui.QWidget):
             self.btmBtns[3].setEnabled(False)
             props = {}
 
-            for fname in self.buttons_selected:
-                prop = self.b.FileStatistics(fname=fname)
-
-                if not prop:
-                    QtGui.QMessageBox.critical(self, 'Error on properties',
-                        '<br>Could not get statistics ! Invalid file name !<br>')
-                    return
-
-                if not prop['labels']:
-                    prop['labels'] = '-'
-
-                props[fname] = prop
+            # The details of many files come from the index.
+            for fname in self.selected:
+                file_size, date, labels = self.index.get(fname)
+                props[fname] = {'lastFileSize':file_size, 'labels':labels or '-'}
 
             labels = '; '.join(props[e]['labels'] for e in props)
             labels = '; '.join( list(set(e.strip() for e in labels.split(';'))) )
@@ -809,106 +806,20 @@ class CustomTab(QtGui.QWidget):
 
 
     def select_all(self):
-        self.buttons_selected = []
-        for vButton in self.buttons:
-            self.buttons[vButton].setChecked(True)
-            self.buttons_selected.append(str(self.buttons[vButton].objectName()))
-        self.manage_selection()
+        # Selecting everything means loading all the names in the view.
+        while self.model.canFetchMore(QtCore.QModelIndex()):
+            self.model.fetchMore(QtCore.QModelIndex())
+        self.view.selectAll()
 
 
     def select_nan(self):
-        self.buttons_selected = []
-        for vButton in self.buttons:
-            self.buttons[vButton].setChecked(False)
-        self.manage_selection()
-
-
-    def on_button_click(self):
-        #
-        vPos = self.cursor().pos()
-        # Selected item name, to string
-        item_clicked = str(self.childAt(self.mapFromGlobal(vPos)).objectName())
-
-        # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
-        # Manage key press and selections
-        # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
-
-        # If Ctrl key is not pressed
-        if self.key_modif != 'ctrl':
-            # All buttons except the current one, become deselected
-            for item in self.buttons:
-                if self.buttons[item].objectName() != item_clicked:
-                    self.buttons[item].setChecked(False)
-            # Reset the list, just one button
-            self.buttons_selected = [item_clicked]
-        else:
-            # For all other keys
-            if self.buttons[item_clicked].isChecked():
-                self.buttons_selected.append(item_clicked)
-            else:
-                index = self.buttons_selected.index(item_clicked)
-                self.buttons_selected.pop(index)
-
-        # If Shift key is pressed
-        if self.key_modif == 'shift':
-            # Must select buttons in the correct order
-            ssort = str(self.sortCombo.currentText())
-            ffilter = str(self.filterBox.text())
-            if ffilter: ffilter = "file like '%"+ffilter+"%'"
-            items_list = self.b.GetFileList(ssort=ssort, ffilter=ffilter)
-
-            vSelecting = False
-            self.buttons_selected = []
-            index = self.buttons_visible.index(item_clicked)
-            index_old = self.buttons_visible.index(self.item_clicked_old)
-
-            # If the new selected item is at the left of the old item
-            if index < index_old:
-                # The item list will be cycled in reversed order
-                items_list.reverse()
-
-            # All buttons become selected, starting with the current one
-            for item in items_list:
-                btnName = str(self.buttons[item].objectName())
-                if item == self.item_clicked_old:
-                    vSelecting = True
-                elif item == item_clicked:
-                    vSelecting = False
-                    self.buttons_selected.append(btnName)
-                if vSelecting:
-                    self.buttons[item].setChecked(True)
-                    self.buttons_selected.append(btnName)
-            del vSelecting
-
-        # If no key is pressed
-        elif not self.key_modif:
-            if self.buttons[item_clicked].isChecked():
-                self.buttons_selected = [item_clicked]
-            else:
-                self.buttons_selected = []
-
-        # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
-        # Manage click / double click
-        # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+        self.view.clearSelection()
 
-        # If after receiving the first click, the timer isn't running, start the timer and return
-        if not self.dblClickTimer.isActive():
-            self.dblClickTimer.start()
-        # If timer is running and hasn't timed out, the second click occured within timer interval
-        elif item_clicked == self.item_clicked_old:
-            # Stop timer so next click can start it again
-            self.dblClickTimer.stop()
-            # Export function
-            self.on_view()
 
-        self.item_clicked_old = item_clicked
-
-        self.manage_selection()
-
-
-    def on_view(self):
+    def on_view(self, *args):
         #
-        fname = self.item_clicked_old
+        fname = self.current_file()
+        if not fname: return
 
         # Briefcase export file cleans-up the temporary file and folder
         vRes = self.b.ExportFile(fname=fname, execute=True)
@@ -931,7 +842,8 @@ class CustomTab(QtGui.QWidget):
 
     def on_edit(self):
         #
-        fname = self.item_clicked_old
+        fname = self.current_file()
+        if not fname: return
         temp_dir = tempfile.mkdtemp('__', '__py')
         filename = temp_dir + '/' + fname
 
@@ -964,9 +876,8 @@ class CustomTab(QtGui.QWidget):
             print('System not supported : `%s` !' % os.name)
             return -1
 
-        md4 = MD4.new(open(filename, 'rb').read())
-        new_hash = md4.hexdigest()
-        del md4
+        # The briefcase file can use another hash than MD4.
+        new_hash = self.b._hasher(open(filename, 'rb').read()).hexdigest()
 
         # Compare hashes to see if the file was edited
         if old_hash != new_hash:
@@ -974,6 +885,9 @@ class CustomTab(QtGui.QWidget):
                 'File "%s" was changed! Save changes ?' % fname, 'Yes', 'No')
             if qtMsg == 0: # Clicked yes.
                 self.b.AddFile(filename)
+                self.model.invalidate(fname)
+                self.index.update(self.b.GetFileDetails([fname]))
+                self.fRefresh()
 
         # Cleanup the mess
         #destroy_file(filename)
@@ -987,55 +901,75 @@ class CustomTab(QtGui.QWidget):
     def on_copy(self):
         #
         q = QtGui.QMessageBox.question(self,
-            'Copy %i file(s) ? ...' % len(self.buttons_selected),
-            'Are you sure you want to copy %i file(s) ?' % len(self.buttons_selected),
+            'Copy %i file(s) ? ...' % len(self.selected),
+            'Are you sure you want to copy %i file(s) ?' % len(self.selected),
             'Yes', 'No')
 
         # If clicked yes...
         if q == 0:
-            # Copy each item.
-            for fname in self.buttons_selected:
-                ret = self.b.CopyIntoNew(fname=fname, version=0, new_fname='copy of '+fname)
-
-                if ret == 0: # If Briefcase returns 0, create new button.
-                    vInfo = self.b.FileStatistics(fname)
-                    self.create_button('copy of ' + fname, vInfo['lastFileSize'], vInfo['versions'])
-                    self.fRefresh()
-                else:
-                    QtGui.QMessageBox.critical(self, 'Error on copy',
-                        '<br>Could not copy file ! Invalid file name, or the copy exists already !<br>')
+            selected = list(self.selected)
+
+            def work(b, progress):
+                # Copy each item.
+                results = []
+                for i, fname in enumerate(selected):
+                    results.append((fname, b.CopyIntoNew(fname=fname, version=0, new_fname='copy of '+fname)))
+                    if progress(i+1, len(selected), 0) is False:
+                        break
+                return results
+
+            def finished(results):
+                for fname, ret in results:
+                    if ret != 0:
+                        QtGui.QMessageBox.critical(self, 'Error on copy',
+                            '<br>Could not copy file ! Invalid file name, or the copy exists already !<br>')
+                self.index.update(self.b.GetFileDetails('copy of ' + fname for fname, ret in results if ret == 0))
+                self.fRefresh()
+
+            self.run_job('Copying files', len(selected), work, finished)
         #
 
 
     def on_delete(self):
         #
         q = QtGui.QMessageBox.warning(self,
-            'Delete %i file(s) ? ...' % len(self.buttons_selected),
-            'Are you sure you want to delete %i file(s) ?' % len(self.buttons_selected),
+            'Delete %i file(s) ? ...' % len(self.selected),
+            'Are you sure you want to delete %i file(s) ?' % len(self.selected),
             'Yes', 'No')
 
         # If clicked yes...
         if q == 0:
-            # Delete each selected item
-            for fname in self.buttons_selected:
-                ret = self.b.DelFile(fname=fname, version=0)
-
-                if ret == 0: # If Briefcase returns 0, delete the button.
-                    self.buttons[fname].close()
-                    del self.buttons[fname]
-                    self.fRefresh()
-                else:
-                    QtGui.QMessageBox.critical(self, 'Error on delete',
-                        '<br>Could not delete file ! Invalid file name !<br>')
-            # All files must be de-selected
-            self.select_nan()
+            selected = list(self.selected)
+
+            def work(b, progress):
+                # Delete each selected item
+                results = []
+                for i, fname in enumerate(selected):
+                    results.append((fname, b.DelFile(fname=fname, version=0)))
+                    if progress(i+1, len(selected), 0) is False:
+                        break
+                return results
+
+            def finished(results):
+                for fname, ret in results:
+                    if ret == 0: # If Briefcase returns 0, forget the file.
+                        self.model.invalidate(fname)
+                        self.index.remove(fname)
+                    else:
+                        QtGui.QMessageBox.critical(self, 'Error on delete',
+                            '<br>Could not delete file ! Invalid file name !<br>')
+                self.fRefresh()
+                # All files must be de-selected
+                self.select_nan()
+
+            self.run_job('Deleting files', len(selected), work, finished)
         #
 
 
     def on_rename(self):
         #
         qText, q = QtGui.QInputDialog.getText(self,
-            'Rename %i file(s) ? ...' % len(self.buttons_selected),
+            'Rename %i file(s) ? ...' % len(self.selected),
             'This name + item number will be added for each file.\n\nNew name :',
             QtGui.QLineEdit.Normal, '...')
 
@@ -1044,125 +978,270 @@ class CustomTab(QtGui.QWidget):
 
         # If clicked yes and text exists...
         if q and qText:
+            selected = list(self.selected)
             # Rename each item.
-            for i in range(len(self.buttons_selected)):
+            for i in range(len(selected)):
 
-                fname = self.buttons_selected[i]
-                numbr = str(i+1).rjust(len(str(len(self.buttons_selected))), '0')
+                fname = selected[i]
+                numbr = str(i+1).rjust(len(str(len(selected))), '0')
                 new_fname = '%s [%s]' % (qText, numbr)
                 ret = self.b.RenFile(fname=fname, new_fname=new_fname)
 
                 if ret == 0:
-                    vInfo = self.b.FileStatistics(new_fname)
-                    # If Briefcase returns 0, button text and info
-                    self.update_button(self.buttons[fname], new_fname, vInfo['lastFileSize'], vInfo['versions'])
-                    # Pass the pointer to the new name
-                    self.buttons[new_fname] = self.buttons[fname]
-                    del self.buttons[fname]
-                    self.fRefresh()
+                    # If Briefcase returns 0, forget the old name.
+                    self.model.invalidate(fname)
+                    self.index.rename(fname, new_fname)
 
                 else:
                     QtGui.QMessageBox.critical(self, 'Error on rename',
                         '<br>Could not rename file ! Invalid file name, or file name exists !<br>')
+            self.fRefresh()
         #
 
 
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
-#  F L O W   L A Y O U T
+#  B A C K G R O U N D   J O B S
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
 
-class FlowLayout(QtGui.QLayout):
+def human_size(nbytes):
+    # Bytes, as short text.
+    for unit in ['B', 'KB', 'MB']:
+        if nbytes < 1024.0:
+            return '%.1f %s' % (nbytes, unit)
+        nbytes /= 1024.0
+    return '%.1f GB' % nbytes
+
+
+class JobSignals(QtCore.QObject):
 
     '''
-    Flow Layout defined in PyQt4 Layout examples.
+    QRunnable is not a QObject, so the job signals live here.
+    They are emitted from the pool thread and received in the GUI thread.
     '''
 
-    def __init__(self, parent=None, margin=0, spacing=-1):
+    progress = QtCore.pyqtSignal(object, object, object)
+    finished = QtCore.pyqtSignal(object)
+    failed = QtCore.pyqtSignal(str)
 
-        super(FlowLayout, self).__init__(parent)
 
-        if parent is not None: self.setMargin(margin)
-        self.setSpacing(spacing)
-        self.itemList = []
+class BriefcaseJob(QtCore.QRunnable):
 
-    def __del__(self):
-        item = self.takeAt(0)
-        while item:
-            item = self.takeAt(0)
+    '''
+    Runs work(briefcase, progress) in one thread from the pool.
+    SQLite connections cannot be shared between threads, so each job opens its own briefcase.
+    Progress(done, total, nbytes) returns False after the job was cancelled.
+    '''
 
-    def reset(self):
-        for item in self.itemList:
-            self.removeWidget(item.widget())
-        self.itemList = []
+    def __init__(self, database, password, work):
 
-    def addItem(self, item):
-        self.itemList.append(item)
+        super(BriefcaseJob, self).__init__()
+        self.setAutoDelete(False)
+        self.database = database
+        self.password = password
+        self.work = work
+        self.cancelled = False
+        self.signals = JobSignals()
 
-    def count(self):
-        return len(self.itemList)
+    def cancel(self):
+        self.cancelled = True
 
-    def itemAt(self, index):
-        if index >= 0 and index < len(self.itemList):
-            return self.itemList[index]
+    def progress(self, done, total, nbytes):
+        self.signals.progress.emit(done, total, nbytes)
+        return not self.cancelled
 
-        return None
+    def run(self):
+        try:
+            b = Briefcase(self.database, self.password)
+            b.verbose = 1
+            # The briefcase is always closed, so a failed job doesn't keep its connection and locks.
+            try:
+                result = self.work(b, self.progress)
+            except:
+                b.conn.rollback()
+                raise
+            finally:
+                b.Close()
+        except Exception, e:
+            self.signals.failed.emit(str(e))
+            return
+        self.signals.finished.emit(result)
 
-    def takeAt(self, index):
-        if index >= 0 and index < len(self.itemList):
-            return self.itemList.pop(index)
 
-        return None
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#  F I L E   I N D E X
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
-    def expandingDirections(self):
-        return QtCore.Qt.Orientations(QtCore.Qt.Orientation(0))
 
-    def hasHeightForWidth(self):
-        return True
+class FileIndex:
 
-    def heightForWidth(self, width):
-        height = self.doLayout(QtCore.QRect(0, 0, width, 0), True)
-        return height
+    '''
+    The names and details of all the files from one briefcase, kept in memory.
+    Filter and sort don't query the briefcase ; the index must be updated on add, rename and delete.
+    Filter is a case insensitive substring, like SQL "like '%...%'".
+    '''
 
-    def setGeometry(self, rect):
-        super(FlowLayout, self).setGeometry(rect)
-        self.doLayout(rect, False)
+    def __init__(self):
 
-    def sizeHint(self):
-        return self.minimumSize()
+        self.entries = {} # Name -> (size, date, labels). The dates are ISO strings, they sort as text.
+        self._reset()
+
+    def _reset(self):
+        # Search structures, rebuilt on the next query after any change.
+        self._names = None
+        self._text = ''
+        self._offsets = []
+        self._last = ('', [])
+
+    def _build(self):
+        # All the names, lower case, joined in one string. Searching it runs in C.
+        self._names = sorted(self.entries)
+        self._offsets = []
+        pos = 0
+        for name in self._names:
+            self._offsets.append(pos)
+            pos += len(name) + 1
+        self._text = '\0'.join(name.lower() for name in self._names)
+        self._last = ('', self._names)
+
+    def load(self, details):
+        self.entries = {}
+        self.update(details)
+
+    def update(self, details):
+        # Add new files, or change existing files. Details are (file, size, date, labels).
+        for fname, file_size, date, labels in details:
+            self.entries[fname] = (file_size or 0, date or '', labels or '')
+        self._reset()
+
+    def remove(self, fname):
+        if self.entries.pop(fname, None):
+            self._reset()
+
+    def rename(self, fname, new_fname):
+        if fname in self.entries:
+            self.entries[new_fname] = self.entries.pop(fname)
+            self._reset()
+
+    def get(self, fname):
+        return self.entries.get(fname, (0, '', ''))
+
+    def match(self, ffilter):
+        '''
+        All the names containing ffilter, in name order.
+        When the user types more letters, only the previous matches are searched.
+        '''
+        if self._names is None:
+            self._build()
+        ffilter = ffilter.lower()
+        if not ffilter:
+            return self._names
+
+        last_filter, last_matches = self._last
+        if last_filter and last_filter in ffilter:
+            matches = [name for name in last_matches if ffilter in name.lower()]
+        else:
+            matches = []
+            pos = self._text.find(ffilter)
+            while pos != -1:
+                i = bisect_right(self._offsets, pos) - 1
+                matches.append(self._names[i])
+                # Continue with the next name.
+                if i + 1 == len(self._names):
+                    break
+                pos = self._text.find(ffilter, self._offsets[i + 1])
+
+        self._last = (ffilter, matches)
+        return matches
+
+    def query(self, ffilter='', ssort='file asc'):
+        '''
+        Names containing ffilter, sorted by "file", "size" or "date", "asc" or "desc".
+        '''
+        matches = self.match(ffilter)
+        field, order = (ssort.lower().split() + ['asc'])[:2]
 
-    def minimumSize(self):
-        size = QtCore.QSize()
+        if field == 'size':
+            matches = sorted(matches, key=lambda name: (self.entries[name][0], name))
+        elif field == 'date':
+            matches = sorted(matches, key=lambda name: (self.entries[name][1], name))
+        else:
+            matches = list(matches)
 
-        for item in self.itemList:
-            size = size.expandedTo(item.minimumSize())
+        if order == 'desc':
+            matches.reverse()
+        return matches
 
-        size += QtCore.QSize(2 * self.margin(), 2 * self.margin())
-        return size
 
-    def doLayout(self, rect, testOnly):
-        x = rect.x()
-        y = rect.y()
-        lineHeight = 0
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#  F I L E   M O D E L
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
-        for item in self.itemList:
-            wid = item.widget()
-            spaceX = self.spacing() + wid.style().layoutSpacing(QtGui.QSizePolicy.PushButton, QtGui.QSizePolicy.PushButton, QtCore.Qt.Horizontal)
-            spaceY = self.spacing() + wid.style().layoutSpacing(QtGui.QSizePolicy.PushButton, QtGui.QSizePolicy.PushButton, QtCore.Qt.Vertical)
-            nextX = x + item.sizeHint().width() + spaceX
-            if nextX - spaceX > rect.right() and lineHeight > 0:
-                x = rect.x()
-                y = y + lineHeight + spaceY
-                nextX = x + item.sizeHint().width() + spaceX
-                lineHeight = 0
 
-            if not testOnly:
-                item.setGeometry(QtCore.QRect(QtCore.QPoint(x, y), item.sizeHint()))
+class FileListModel(QtCore.QAbstractListModel):
 
-            x = nextX
-            lineHeight = max(lineHeight, item.sizeHint().height())
+    '''
+    The files from one briefcase, for the list view.
+    Only the names are kept in memory. The view asks for more rows in batches,
+    and the details for the tool tip are fetched only for the files the user hovers.
+    '''
 
-        return y + lineHeight - rect.y()
+    BATCH = 256
+
+    def __init__(self, briefcase, parent=None):
+
+        super(FileListModel, self).__init__(parent)
+        self.b = briefcase
+        self.files = []
+        self.loaded = 0
+        self.details = {}
+        self.icon = QtGui.QFileIconProvider().icon(QtGui.QFileIconProvider.File)
+
+    def setFiles(self, files):
+        self.beginResetModel()
+        self.files = files
+        self.loaded = min(self.BATCH, len(files))
+        self.endResetModel()
+
+    def invalidate(self, file_name):
+        # The file changed, its details must be fetched again.
+        self.details.pop(file_name, None)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.loaded
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and self.loaded < len(self.files)
+
+    def fetchMore(self, parent):
+        more = min(self.BATCH, len(self.files) - self.loaded)
+        self.beginInsertRows(QtCore.QModelIndex(), self.loaded, self.loaded + more - 1)
+        self.loaded += more
+        self.endInsertRows()
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or index.row() >= self.loaded:
+            return QtCore.QVariant()
+        file_name = self.files[index.row()]
+
+        if role == QtCore.Qt.DisplayRole:
+            # Short name.
+            if len(file_name) > 12: return QtCore.QVariant(file_name[:12] + ' (...)')
+            else:                   return QtCore.QVariant(file_name)
+        elif role == QtCore.Qt.DecorationRole:
+            return QtCore.QVariant(self.icon)
+        elif role == QtCore.Qt.ToolTipRole:
+            if file_name not in self.details:
+                vInfo = self.b.FileStatistics(file_name)
+                if not vInfo:
+                    return QtCore.QVariant()
+                self.details[file_name] = (vInfo['lastFileSize'], vInfo['versions'])
+            file_size, versions = self.details[file_name]
+            return QtCore.QVariant('<pre>%s<br>Size: %i bytes<br>Versions: %i</pre>' % (file_name, file_size, versions))
+
+        return QtCore.QVariant()
 
 
 import res_rc
@@ -21,8 +21,23 @@
     - _logs_ table : \n\
         _logs_ (date TEXT, msg TEXT); \n\
         all actions can be stored in here. \n\
+    - _labels_ table : id INTEGER primary key, label TEXT unique; \n\
+        every label used in the briefcase. \n\
+    - _file_labels_ table : file TEXT, label INTEGER; \n\
+        the labels of each file, indexed by label. _files_ and _statistics_ keep a ";" joined copy. \n\
+    - _exported_ table : path TEXT, file TEXT, version INTEGER, hash TEXT, size INTEGER; \n\
+        the version of each file exported by SyncOut, in each folder. \n\
+    - _imported_ table : path TEXT, file TEXT, size INTEGER, mtime REAL; \n\
+        the size and modification time of each file added by SyncIn, from each folder. \n\
+    - _retention_ table : label TEXT unique, keep_last INTEGER, daily INTEGER, weekly INTEGER,
+        monthly INTEGER, max_bytes INTEGER; \n\
+        the versions kept by Prune, for the files with one label, or for all files if label is "". \n\
+    - _verified_ table : file TEXT, version INTEGER, date TEXT, error TEXT; \n\
+        the last time each version was checked by Verify, and the error, if any. \n\
     - other tables, one table for each new file : \n\
-        version integer primary key asc, raw BLOB, hash TEXT, size INTEGER, date TEXT, user TEXT. \n\
+        version integer primary key asc, raw BLOB, hash TEXT, size INTEGER, date TEXT, user TEXT;
+        with an index on date. \n\
+    All dates are stored as "YYYY-MM-DD HH:MM:SS" strings, that sort correctly. \n\
 '''
 
 '''
@@ -36,14 +51,29 @@
 import os, sys
 import re
 import glob
+import random
+import stat
 import shutil
 import sqlite3
+import Queue
+import threading
 import zlib, bz2
 import tempfile
+import tarfile, zipfile
+import struct
+import hashlib
+import mmap
 import thread
 import subprocess
+from collections import OrderedDict
+from time import time
 from time import clock
+from time import sleep
 from time import strftime
+from time import localtime
+from time import strptime
+from time import mktime
+from uuid import uuid4
 
 # External dependency.
 from Crypto.Cipher import AES
@@ -51,15 +81,137 @@ from Crypto.Hash import MD4
 from Crypto.Protocol.KDF import PBKDF2
 from Crypto.Random import get_random_bytes
 
+# Optional, faster directory walking.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# Optional, faster content hashes.
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
 __version__ = 'r77'
-__all__ = ['Briefcase', 'destroy_file', '__version__']
+__all__ = ['Briefcase', 'destroy_file', 'hashRestored', 'primeDictionary', '__version__']
 
 #
 
-EXEC_info_ = 'create table if not exists _info_ (pwd BLOB, salt BLOB, date TEXT, user TEXT, version TEXT)'
+EXEC_info_ = 'create table if not exists _info_ (pwd BLOB, salt BLOB, date TEXT, user TEXT, version TEXT, hash TEXT, packs INTEGER, pack_size INTEGER, uuid TEXT)'
 EXEC_files_ = 'create table if not exists _files_ (file TEXT unique, pwd BLOB, labels TEXT)'
 EXEC_statistics_ = 'create table if not exists _statistics_ (file TEXT unique, size0 INTEGER, size INTEGER, sizeB INTEGER, date0 TEXT, date TEXT, user0 TEXT, user TEXT, labels TEXT)'
 EXEC_logs_ = 'create table if not exists _logs_ (date TEXT, msg TEXT)'
+EXEC_labels_ = 'create table if not exists _labels_ (id INTEGER primary key, label TEXT unique)'
+EXEC_file_labels_ = 'create table if not exists _file_labels_ (file TEXT, label INTEGER, unique (file, label))'
+EXEC_file_labels_index_ = 'create index if not exists _file_labels_label_ on _file_labels_ (label, file)'
+EXEC_exported_ = 'create table if not exists _exported_ (path TEXT, file TEXT, version INTEGER, hash TEXT, size INTEGER, unique (path, file))'
+EXEC_imported_ = 'create table if not exists _imported_ (path TEXT, file TEXT, size INTEGER, mtime REAL, unique (path, file))'
+EXEC_retention_ = 'create table if not exists _retention_ (label TEXT unique, keep_last INTEGER, daily INTEGER, weekly INTEGER, monthly INTEGER, max_bytes INTEGER)'
+EXEC_verified_ = 'create table if not exists _verified_ (file TEXT, version INTEGER, date TEXT, error TEXT, unique (file, version))'
+# Solid blocks : many small files compressed and encrypted together. Ids are never reused.
+# The blocks stored in packfiles have null raw, the packfile number, the position and the length.
+EXEC_blocks_ = 'create table if not exists _blocks_ (id INTEGER primary key autoincrement, raw BLOB, size INTEGER, dict INTEGER, '\
+    'refs INTEGER default 0, pack INTEGER, pos INTEGER, length INTEGER)'
+# The volume folders : the packfiles are spread over them, maybe on different disks.
+EXEC_volumes_ = 'create table if not exists _volumes_ (path TEXT unique)'
+# The content hash of every version, used to find duplicates and to store the same content only once.
+EXEC_hashes_ = 'create table if not exists _hashes_ (hash TEXT, file TEXT, version INTEGER, size INTEGER, unique (file, version))'
+EXEC_hashes_index_ = 'create index if not exists _hashes_hash_ on _hashes_ (hash)'
+# Compression dictionaries, trained from the small files. They are encrypted with the global password.
+EXEC_dicts_ = 'create table if not exists _dicts_ (id INTEGER primary key autoincrement, raw BLOB, size INTEGER, files INTEGER, date TEXT)'
+# Covering indexes, used by GetFileList to sort and filter files without reading the table.
+EXEC_statistics_indexes_ = [
+    'create index if not exists _statistics_size_ on _statistics_ (size, file)',
+    'create index if not exists _statistics_date_ on _statistics_ (date, file)',
+    'create index if not exists _statistics_user_ on _statistics_ (user, file)',
+    ]
+
+# Fields and operators that can be used in GetFileList structured filters.
+QUERY_FIELDS = {'file':'file', 'size0':'size0', 'size':'size', 'sizeb':'sizeB', 'date0':'date0',
+    'date':'date', 'user0':'user0', 'user':'user', 'labels':'labels'}
+QUERY_OPERATORS = ['=', '!=', '<', '<=', '>', '>=', 'like', 'glob', 'in', 'between', 'has']
+
+# Every file table has an index on date, so versions can be searched by date.
+# The data of the versions is stored in _blocks_, so the file tables are small ; they have null raw,
+# the block id and the offset inside the block. Only the oldest briefcase files can have raw data here.
+# The versions compressed against a dictionary have the dictionary id.
+EXEC_versions_ = 'create table if not exists %s (version integer primary key asc, raw BLOB, hash TEXT, size INTEGER, date TEXT, user TEXT, block INTEGER, offset INTEGER, dict INTEGER)'
+EXEC_versions_index_ = 'create index if not exists %s_date_ on %s (date)'
+# Everything needed to restore one version : raw, block, offset, size, dict, the hash, and the place
+# of the data in the packfiles. A version that is the whole block gets the data of the block, and no block.
+EXEC_stored_ = 'select ifnull(v.raw, case when b.size = v.size then b.raw end), case when b.size = v.size '\
+    'then null else v.block end, v.offset, v.size, ifnull(v.dict, b.dict), v.hash, case when b.size = v.size '\
+    'then b.pack end, b.pos, b.length from %s v left join _blocks_ b on b.id = v.block'
+
+# Dates are stored like the logs, so they sort correctly as text.
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+MONTHS = {'Jan':'01', 'Feb':'02', 'Mar':'03', 'Apr':'04', 'May':'05', 'Jun':'06',
+    'Jul':'07', 'Aug':'08', 'Sep':'09', 'Oct':'10', 'Nov':'11', 'Dec':'12'}
+
+# Schema of the briefcase files created by this version, stored in "pragma user_version".
+SCHEMA_VERSION = 11
+
+# Each file has its own table, so the statement cache must be larger than the default.
+CACHED_STATEMENTS = 512
+
+# Seconds to wait for another process that is writing, then the number of retries, with backoff.
+BUSY_TIMEOUT = 10.0
+RETRIES = 5
+RETRY_DELAY = 0.05
+
+# Statements that begin a write transaction. The sqlite3 module commits the open transaction before
+# all the other statements, except select, and runs them alone, in autocommit mode.
+WRITE_STATEMENTS = ('insert', 'update', 'delete', 'replac')
+READ_STATEMENTS = ('select',)
+# Temporary tables ; each connection has its own, so changing them doesn't need the write lock.
+TEMP_TABLES = set(['_selected_'])
+
+# AddManyFiles with solid=True packs the files up to SMALL_FILE bytes, in blocks of about BLOCK_SIZE bytes.
+# The most recent restored blocks are kept in memory, up to BLOCK_CACHE bytes.
+SMALL_FILE = 64 * 1024
+BLOCK_SIZE = 1024 * 1024
+BLOCK_CACHE = 16 * 1024 * 1024
+
+# Compression dictionaries are at most the size of the zlib window, trained from a sample of files,
+# at most DICT_CORPUS times the size of the dictionary. They are made of segments of DICT_SEGMENT bytes,
+# with the substrings of DICT_GRAM bytes found in most files.
+DICT_SIZE = 32 * 1024
+DICT_SAMPLE = 1000
+DICT_CORPUS = 32
+DICT_SEGMENT = 64
+DICT_GRAM = 8
+
+# Content hashes, by name. Each briefcase file uses one of them, stored in _info_ ; the old files use md4.
+# New files use BLAKE2b when it's available. xxh64 is very fast, but it's not a cryptographic hash.
+HASHES = {'md4': MD4.new, 'md5': hashlib.md5, 'sha1': hashlib.sha1, 'sha256': hashlib.sha256}
+if blake2b:
+    HASHES['blake2b'] = lambda data='': blake2b(data, digest_size=32)
+if xxhash:
+    HASHES['xxh64'] = xxhash.xxh64
+DEFAULT_HASH = blake2b and 'blake2b' or 'md4'
+
+# The number of file names whose table names are kept in memory.
+TABLE_CACHE = 4096
+
+# Packfiles are closed before they grow over PACK_SIZE bytes, unless the briefcase has another volume size.
+# CompactPacks rewrites the packfiles that
+# have less than PACK_LIVE of their bytes still used.
+PACK_SIZE = 1024 * 1024 * 1024
+PACK_LIVE = 0.5
+
+# The zlib header for raw deflate streams from zip archives : deflate, 32 KB window, best compression.
+ZLIB_HEADER = '\x78\xda'
 
 #
 
@@ -72,6 +224,16 @@ def validFileName(fname):
         return True
 
 
+def isoDate(date):
+    '''
+    Converts dates from old briefcase files, like "2012-Mar-05 10:20:30", into "2012-03-05 10:20:30". \n\
+    Other values are returned unchanged. \n\
+    '''
+    if date and date[5:8] in MONTHS:
+        return date[:5] + MONTHS[date[5:8]] + date[8:]
+    return date
+
+
 def validPassword(user_pwd, old_check):
     # If both are false, the check is OK
     if not user_pwd and not old_check:
@@ -121,18 +283,550 @@ def destroy_file(filename):
     w.close() ; del w
     os.remove(filename) # Del file
 
+
+def _retry(func, *args):
+    '''
+    Calls func, retrying with exponential backoff while the database is locked by another process. \n\
+    '''
+    for attempt in range(RETRIES):
+        try:
+            return func(*args)
+        except sqlite3.OperationalError, e:
+            if attempt == RETRIES - 1 or not ('locked' in str(e) or 'busy' in str(e)):
+                raise
+            sleep(min(RETRY_DELAY * 2 ** attempt, 2.0) * (0.5 + random.random()))
+
+
+class _Cursor(sqlite3.Cursor):
+    """ Cursor that retries the statements that find the database locked """
+
+    def execute(self, sql, *args):
+        return self.connection._execute(sqlite3.Cursor.execute, self, sql, *args)
+
+    def executemany(self, sql, *args):
+        return self.connection._execute(sqlite3.Cursor.executemany, self, sql, *args)
+
+
+class _Connection(sqlite3.Connection):
+    """ Connection that uses _Cursor and retries the commits """
+
+    # The lock shared by all the connections of one Briefcase, held while a write transaction is open.
+    gate = None
+    writing = False
+    # Python 2 sqlite3 doesn't tell if a transaction is open, so the write statements are tracked here.
+    pending = False
+    wait = BUSY_TIMEOUT
+
+    def cursor(self, factory=_Cursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+    def _execute(self, func, cursor, sql, *args):
+        '''
+        Runs one statement with func, retrying while the database is locked. \n\
+        Outside of a transaction, the statements that change only temporary tables run in autocommit mode,
+        so they don't take the write lock of the briefcase file. \n\
+        '''
+        words = sql.split(None, 5)
+        kind = words and words[0][:6].lower()
+        if kind in WRITE_STATEMENTS and TEMP_TABLES.intersection(words[1:5]):
+            if self.pending or self.isolation_level is None:
+                return _retry(func, cursor, sql, *args)
+            level = self.isolation_level
+            self.isolation_level = None
+            try:
+                return _retry(func, cursor, sql, *args)
+            finally:
+                self.isolation_level = level
+
+        if kind in WRITE_STATEMENTS:
+            self._beginWrite()
+            self.pending = True
+        try:
+            return _retry(func, cursor, sql, *args)
+        finally:
+            if kind not in WRITE_STATEMENTS and kind not in READ_STATEMENTS:
+                # The open transaction was committed before this statement.
+                self._endWrite()
+
+    def _beginWrite(self):
+        '''
+        Waits until the other threads of this Briefcase finish writing, so only one connection
+        writes at one time. If the gate is not released in time, SQLite busy handling takes over. \n\
+        '''
+        if self.gate is None or self.writing:
+            return
+        end = time() + self.wait
+        delay = 0.001
+        while not self.gate.acquire(False):
+            if time() > end:
+                return
+            sleep(delay)
+            delay = min(delay * 2, 0.05)
+        self.writing = True
+
+    def _endWrite(self):
+        self.pending = False
+        if self.writing:
+            self.writing = False
+            self.gate.release()
+
+    def commit(self):
+        try:
+            return _retry(sqlite3.Connection.commit, self)
+        finally:
+            self._endWrite()
+
+    def rollback(self):
+        try:
+            return sqlite3.Connection.rollback(self)
+        finally:
+            self._endWrite()
+
+    def close(self):
+        self._endWrite()
+        return sqlite3.Connection.close(self)
+
+
+class _Counter:
+    """ Write-only file that counts the bytes written, so zipfile can write into pipes and stdout """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.pos = 0
+
+    def write(self, data):
+        self.fp.write(data)
+        self.pos += len(data)
+
+    def tell(self):
+        return self.pos
+
+    def flush(self):
+        self.fp.flush()
+
+
+class _Reader:
+    """ Read-only file over the parts of a restored file, so tarfile can copy it without joining the parts """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = ''
+        self.pos = 0
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.pos >= len(self.buf):
+                try:
+                    self.buf, self.pos = next(self.chunks), 0
+                except StopIteration:
+                    break
+                continue
+            part = self.buf[self.pos:size > 0 and self.pos+size or None]
+            self.pos += len(part)
+            size -= size > 0 and len(part)
+            parts.append(part)
+        return ''.join(parts)
+
+
+class _BloomFilter:
+    """ Set of hex digests that answers "maybe" or "no", using 10 bits per digest """
+
+    def __init__(self, capacity):
+        self.capacity = max(capacity, 1024)
+        self.bits = self.capacity * 10
+        self.array = bytearray(self.bits // 8 + 1)
+        self.count = 0
+
+    def _positions(self, hexdigest):
+        # The digests are already random, so two parts of the digest are enough for all positions.
+        h = int(hexdigest, 16)
+        h1, h2 = h & 0xffffffff, (h >> 32) & 0xffffffff | 1
+        return [(h1 + i * h2) % self.bits for i in range(7)]
+
+    def add(self, hexdigest):
+        for pos in self._positions(hexdigest):
+            self.array[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, hexdigest):
+        for pos in self._positions(hexdigest):
+            if not self.array[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
+def primeDictionary(zdict):
+    '''
+    Python 2 zlib doesn't have preset dictionaries, so they are emulated with raw deflate : a compressor
+    and a decompressor read the dictionary, then they are copied for each file. The window of the copies
+    already contains the dictionary, so the data can reference it. \n\
+    Returns (compressor, decompressor). Never use them directly, only their copies. \n\
+    '''
+    comp = zlib.compressobj(9, zlib.DEFLATED, -15)
+    prefix = comp.compress(zdict) + comp.flush(zlib.Z_SYNC_FLUSH)
+    decomp = zlib.decompressobj(-15)
+    decomp.decompress(prefix)
+    return comp, decomp
+
+
+def hashRestored(raw, key=None, decomp=None, hash='md4'):
+    '''
+    Decrypts and decompresses raw data from the database in small blocks, so the original data
+    is never entirely in memory. Returns the hexdigest of the original data, with one of HASHES. \n\
+    Key is the AES key used for encryption, or None if the data is not encrypted. \n\
+    For data compressed against a dictionary, decomp is the decompressor from primeDictionary. \n\
+    '''
+    md4 = HASHES[hash]()
+    for data in _restoreChunks(raw, key, decomp):
+        md4.update(data)
+    return md4.hexdigest()
+
+
+def _restoreChunks(raw, key=None, decomp=None):
+    '''
+    Decrypts and decompresses raw data from the database, or from a packfile, in small blocks.
+    Yields the original data, one part at a time. Key and decomp are the same as for hashRestored. \n\
+    '''
+    crypt = key and AES.new(key)
+    decomp = decomp and decomp.copy()
+    for i in range(0, len(raw), 65536):
+        block = raw[i:i+65536]
+        if crypt:
+            block = crypt.decrypt(block)
+        if decomp is None:
+            decomp = block[:3] == 'BZh' and bz2.BZ2Decompressor() or zlib.decompressobj()
+        try:
+            yield decomp.decompress(block)
+        except EOFError:
+            # The encryption padding, after the end of bz2 data.
+            break
+    if hasattr(decomp, 'flush'):
+        yield decomp.flush()
+
+
+def _deflateChunks(raw, key=None):
+    '''
+    Decrypts zlib data from the database in small blocks, without compressing it again.
+    Yields (data, deflated) : one part of the original data, and the same part of the raw deflate
+    stream, without the zlib header and the adler32 at the end, that can be copied into zip archives. \n\
+    '''
+    crypt = key and AES.new(key)
+    decomp = zlib.decompressobj()
+    # The last 4 bytes could be the adler32, they are kept until the next block.
+    tail = ''
+    for i in range(0, len(raw), 65536):
+        block = raw[i:i+65536]
+        if crypt:
+            block = crypt.decrypt(block)
+        data = decomp.decompress(block)
+        end = len(block) - len(decomp.unused_data)
+        block = tail + block[i == 0 and 2 or 0:end]
+        tail = block[-4:]
+        yield data, block[:-4]
+        if decomp.unused_data:
+            # The encryption padding, after the end of the zlib data.
+            break
+    yield decomp.flush(), ''
+
+
+def _sameChunks(first, second):
+    '''
+    Compares two files restored in parts, that can be split in other places.
+    Returns True if the data is the same. \n\
+    '''
+    first, second = iter(first), iter(second)
+    a = b = ''
+    i = j = 0
+    while True:
+        while a is not None and i >= len(a):
+            a, i = next(first, None), 0
+        while b is not None and j >= len(b):
+            b, j = next(second, None), 0
+        if a is None or b is None:
+            return a is None and b is None
+        n = min(len(a) - i, len(b) - j)
+        if a[i:i+n] != b[j:j+n]:
+            return False
+        i += n
+        j += n
+
+
+def _restoreRaw(raw, key=None):
+    '''
+    Decrypts and decompresses raw data from the database, without a Briefcase instance. \n\
+    '''
+    if key:
+        raw = AES.new(key).decrypt(raw)
+    try: return zlib.decompress(raw)
+    except: return bz2.decompress(raw)
+
+
+def _briefcaseUuid(database):
+    '''
+    Returns the uuid stored in one briefcase file, without a Briefcase instance. \n\
+    '''
+    try:
+        conn = sqlite3.connect(database)
+        try:
+            return conn.execute('select uuid from _info_').fetchone()[0]
+        finally:
+            conn.close()
+    except (sqlite3.Error, TypeError):
+        return None
+
+
+def _packName(database, uuid=None):
+    '''
+    The name of the packfiles of one briefcase file, without the number : the name of the briefcase
+    file and its uuid, so briefcase files with the same name can share the volume folders. If uuid
+    is None, it's read from the briefcase file ; without uuid, it's the old name. \n\
+    '''
+    if uuid is None:
+        uuid = _briefcaseUuid(database)
+    name = os.path.basename(database)
+    return uuid and '%s.%s' % (name, uuid) or name
+
+
+def _packPath(database, pack, folder=None, uuid=None):
+    '''
+    The path of one packfile, next to the briefcase file, or in folder, one of the volumes.
+    Uuid is the same as for _packName. \n\
+    '''
+    if folder is None:
+        folder = os.path.dirname(os.path.abspath(database))
+    return os.path.join(folder, '%s.%06i.pack' % (_packName(database, uuid), pack))
+
+
+def _volumeFolders(database):
+    '''
+    Returns the volume folders stored in one briefcase file, without a Briefcase instance. \n\
+    '''
+    try:
+        conn = sqlite3.connect(database)
+        try:
+            return [vElem[0] for vElem in conn.execute('select path from _volumes_ order by path')]
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return []
+
+
+def _packFiles(database, folders=None, uuid=None):
+    '''
+    Returns {number: path} with the packfiles of one briefcase file : next to it, and in all its
+    volume folders. If folders is None, the volume folders are read from the briefcase file.
+    Uuid is the same as for _packName. \n\
+    '''
+    if folders is None:
+        folders = _volumeFolders(database)
+    name = _packName(database, uuid)
+    files = {}
+    for folder in [os.path.dirname(os.path.abspath(database))] + list(folders):
+        for path in glob.glob(os.path.join(folder, name + '.*.pack')):
+            number = os.path.basename(path)[len(name)+1:-5]
+            if number.isdigit():
+                files[int(number)] = path
+    return files
+
+
+def _packBuffer(maps, path, pos, length):
+    '''
+    Returns a read-only buffer over "length" bytes of one packfile, without copying them. \n\
+    Maps is a dictionary with the packfiles already mapped in memory ; a packfile that grew
+    since it was mapped is mapped again. \n\
+    '''
+    m = maps.get(path)
+    if m is None or len(m) < pos + length:
+        f = open(path, 'rb')
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        maps[path] = m
+    if len(m) < pos + length:
+        raise IOError('Packfile "%s" is truncated!' % path)
+    return buffer(m, pos, length)
+
+
+def _copyPack(source, path):
+    '''
+    Copies one packfile. The packfiles only grow, so if path exists, only the new bytes are appended. \n\
+    Returns the number of bytes copied. \n\
+    '''
+    src = open(source, 'rb')
+    done = os.path.exists(path) and os.path.getsize(path) or 0
+    if done > os.fstat(src.fileno()).st_size:
+        done = 0
+    # A new packfile is copied into a temporary file, so it's never incomplete.
+    dst = done and open(path, 'ab') or open(path + '.tmp', 'wb')
+    try:
+        src.seek(done)
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+        copied = dst.tell() - done
+        dst.flush()
+        os.fsync(dst.fileno())
+    finally:
+        dst.close()
+        src.close()
+    if not done:
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(path + '.tmp', path)
+    return copied
+
+
+def _copyPacks(source, target, folders=None):
+    '''
+    Copies the packfiles of briefcase file source, from all its volumes, for briefcase file target.
+    The packfiles that target already has are updated where they are ; the others are copied next
+    to target, named with the uuid of target. The packfiles that don't exist in source anymore are deleted. \n\
+    Each volume of source is copied by its own thread, so volumes on different disks are read in
+    parallel. Folders are the volume folders of source, like for _packFiles. \n\
+    Returns the number of bytes copied. \n\
+    '''
+    packs = _packFiles(source, folders)
+    uuid = _briefcaseUuid(target)
+    old_packs = _packFiles(target, None, uuid)
+    volumes = {}
+    for pack, path in packs.items():
+        new_path = old_packs.get(pack) or _packPath(target, pack, None, uuid)
+        volumes.setdefault(os.path.dirname(path), []).append((path, new_path))
+
+    copied = []
+    errors = []
+    def work(pairs):
+        try:
+            for path, new_path in sorted(pairs):
+                copied.append(_copyPack(path, new_path))
+        except Exception, e:
+            errors.append(e)
+    threads = [threading.Thread(target=work, args=(pairs,)) for pairs in volumes.values()]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+
+    for pack in set(old_packs) - set(packs):
+        os.remove(old_packs[pack])
+    return sum(copied)
+
+
+# The connection and the keys used by Verify worker processes, the last solid block restored,
+# and the dictionaries.
+_verify_conn = None
+_verify_key = None
+_verify_glob_key = None
+_verify_block = (None, None)
+_verify_dicts = {}
+_verify_hash = 'md4'
+_verify_packs = {}
+_verify_maps = {}
+
+def _verifyInit(database, key, glob_key=None, hash='md4', packs=None):
+    global _verify_conn, _verify_key, _verify_glob_key, _verify_hash, _verify_packs, _verify_block
+    _verify_conn = sqlite3.connect(database, timeout=BUSY_TIMEOUT, cached_statements=CACHED_STATEMENTS,
+        factory=_Connection)
+    # The block restored for another briefcase, or by the parent process, has the same id as another block here.
+    _verify_block = (None, None)
+    _verify_packs = packs or {}
+    _verify_maps.clear()
+    _verify_key = key
+    _verify_glob_key = glob_key
+    _verify_hash = hash
+    _verify_dicts.clear()
+
+
+def _verifyDict(zdict):
+    # Returns the decompressor of one dictionary, in a Verify worker process.
+    if zdict not in _verify_dicts:
+        raw = _verify_conn.execute('select raw from _dicts_ where id=?', [zdict]).fetchone()[0]
+        _verify_dicts[zdict] = primeDictionary(_restoreRaw(raw, _verify_glob_key))[1]
+    return _verify_dicts[zdict]
+
+
+def _verifyPack(pack, pos, length):
+    if pack not in _verify_packs:
+        raise IOError('Packfile "%i" is missing!' % pack)
+    return _packBuffer(_verify_maps, _verify_packs[pack], pos, length)
+
+
+def _verifyFile(task):
+    '''
+    Checks the versions of one file, in a Verify worker process. \n\
+    Returns a list of (file, version, error), where error is None if the version is correct. \n\
+    '''
+    global _verify_block
+    fname, filename, versions = task
+    results = []
+    for version, hash in versions:
+        try:
+            raw = _verify_conn.execute(EXEC_stored_ % filename + ' where v.version=?', [version]).fetchone()
+            if raw and raw[0] is None and raw[6] is not None:
+                raw = (_verifyPack(raw[6], raw[7], raw[8]),) + tuple(raw[1:])
+            if raw and raw[1] is not None:
+                # The files from one block are usually checked one after another.
+                if _verify_block[0] != raw[1]:
+                    block = _verify_conn.execute('select raw, dict, pack, pos, length from _blocks_ where id=?',
+                        [raw[1]]).fetchone()
+                    if block and block[0] is None and block[2] is not None:
+                        block = (_verifyPack(*block[2:]), block[1])
+                    if not block:
+                        _verify_block = (raw[1], None)
+                    elif block[1]:
+                        decomp = _verifyDict(block[1]).copy()
+                        vCompressed = _verify_key and AES.new(_verify_key).decrypt(block[0]) or block[0]
+                        _verify_block = (raw[1], decomp.decompress(vCompressed) + decomp.flush())
+                    else:
+                        _verify_block = (raw[1], _restoreRaw(block[0], _verify_key))
+                data = _verify_block[1]
+                if data is None:
+                    error = 'block is missing'
+                elif HASHES[_verify_hash](data[raw[2]:raw[2]+raw[3]]).hexdigest() != hash:
+                    error = 'hash is different'
+                else:
+                    error = None
+            elif not raw:
+                error = 'version is missing'
+            elif hashRestored(raw[0], _verify_key, raw[4] and _verifyDict(raw[4]), _verify_hash) != hash:
+                error = 'hash is different'
+            else:
+                error = None
+        except Exception, e:
+            error = '%s: %s' % (e.__class__.__name__, e)
+        results.append((fname, version, error))
+    return results
+
 #
 
 class Briefcase:
     """ Main class """
 
-    def __init__(self, database='Data.prv', password=''):
+    def __init__(self, database='Data.prv', password='', readonly=False, timeout=BUSY_TIMEOUT, wal=True,
+            hash=DEFAULT_HASH, packs=False, volumes=None, volume_size=None):
         '''
         Create new Database, or connect to an old Database. \n\
         If you don't know the correct password, you cannot acces the crypted data from tables. \n\
         Just make sure you remember the password. \n\
         Valid passwords : a string, a null value, or False. \n\
         One SQLITE3 file is used for each Briefcase instance. \n\
+        Many processes can use the same briefcase file : \n\
+        - with wal=True, the file uses SQLite WAL journal, so readers never wait for the writer ; \n\
+        - only one process writes at one time ; the others wait "timeout" seconds for it,
+          then retry a few times, with backoff ; \n\
+        - a readonly Briefcase never writes anything, not even logs and statistics. It can only read
+          briefcase files that already exist and were opened at least once by this version. \n\
+        Hash is the content hash used by new briefcase files, one of HASHES. The existing files
+        keep their hash. \n\
+        If packs is true, the data of the new versions is appended to packfiles next to the briefcase
+        file, named like "Data.prv.<uuid>.000001.pack", and SQLite keeps only the metadata. The packfiles
+        are read through mmap. Once enabled, the briefcase file always uses packfiles. \n\
+        Volumes is a list of folders, maybe on different disks, where the packfiles are created instead ;
+        it enables packs. The new blocks are spread over all volumes. The folders are kept in the briefcase
+        file, the new ones are added. Volume_size is the maximum size of one packfile, for example
+        for FAT32 media ; only a block bigger than that makes a bigger packfile. \n\
         '''
         #
         if password and not type(password) == type('') or type(password) == type(u''):
@@ -145,18 +839,56 @@ class Briefcase:
             new_check = u''
             self.glob_key = u''
             self.glob_salt = u''
+        if hash not in HASHES:
+            raise Exception('The hash `%s` is not available! Use one of : %s!' % (hash, ', '.join(sorted(HASHES))))
         #
         global __version__
         self.database = str(database)
         self.verbose = 2
+        self.readonly = readonly
+        self.timeout = timeout
+        self.wal = wal
+        # Log messages, written into _logs_ at the next commit.
+        self._logs = []
+        # One connection for each thread ; only one of them writes at one time.
+        self._local = threading.local()
+        self._pool = []
+        self._pool_lock = threading.Lock()
+        self._generation = 0
+        self._gate = threading.Lock()
+        # Restored solid blocks, the most recent at the end, and their lock.
+        self._blocks = OrderedDict()
+        self._blocks_size = 0
+        self._cache_lock = threading.Lock()
+        # Primed compression dictionaries, and the id of the dictionary used for new files.
+        self._dicts = {}
+        self._dict_id = None
+        # Table names of the most recent file names.
+        self._tables = OrderedDict()
+        # The hashes of all versions, loaded by the functions that add many files.
+        self._known = None
+        # Packfiles : the volume folders, the uuid in their names, the mapped packfiles, the known packfiles
+        # {number: path}, the packfiles being appended {number: [file, not synced]}, and the last volume used.
+        self.packs = bool(packs or volumes)
+        self.volumes = []
+        self.volume_size = None
+        self.uuid = None
+        self._maps = {}
+        self._packs = {}
+        self._writers = {}
+        self._volume = 0
         #
         if os.path.exists(self.database):
             exists_db = True
+        elif readonly:
+            raise Exception('The briefcase file "%s" doesn\'t exist! It cannot be opened read-only!' % database)
         else:
             exists_db = False
         #
-        self.conn = sqlite3.connect(self.database)
-        self.c = self.conn.cursor()
+        self._connect()
+        # Derived keys and password checks, cached per password.
+        self._keys = {}
+        self._checks = {}
         #
 
         # If existing DB, must check the password. The password can be null.
@@ -179,20 +911,48 @@ class Briefcase:
         if password:
             self.glob_key = PBKDF2(password=password, salt=self.glob_salt, dkLen=32, count=1000)
 
+        if readonly:
+            if self.c.execute('pragma user_version').fetchone()[0] < SCHEMA_VERSION:
+                raise Exception('The briefcase file "%s" must be opened once without readonly, to be upgraded!' % database)
+            self._dict_id = self.c.execute('select max(id) from _dicts_').fetchone()[0]
+            self._useHash()
+            self._loadVolumes()
+            return
+
         global EXEC_info_, EXEC_files_, EXEC_statistics_, EXEC_logs_
         # Create _info_ table with database password, date created and user.
         self.c.execute(EXEC_info_)
         # Create _files_ table with original names of the files and hashed passwords.
         self.c.execute(EXEC_files_)
-        # Create _statistics_ table.
+        # Create _statistics_ table and its indexes.
         self.c.execute(EXEC_statistics_)
+        for index in EXEC_statistics_indexes_:
+            self.c.execute(index)
         # Create _logs_ table.
         self.c.execute(EXEC_logs_)
+        # Create _labels_ and _file_labels_ tables.
+        self.c.execute(EXEC_labels_)
+        self.c.execute(EXEC_file_labels_)
+        self.c.execute(EXEC_file_labels_index_)
+        # Create _exported_ and _imported_ tables, used by SyncOut and SyncIn.
+        self.c.execute(EXEC_exported_)
+        self.c.execute(EXEC_imported_)
+        # Create _retention_ and _verified_ tables, used by Prune and Verify.
+        self.c.execute(EXEC_retention_)
+        self.c.execute(EXEC_verified_)
+        # Create _blocks_ table, used by AddManyFiles with solid=True, and _dicts_ table.
+        self.c.execute(EXEC_blocks_)
+        self.c.execute(EXEC_dicts_)
+        # Create _hashes_ table and its index, and _volumes_ table.
+        self.c.execute(EXEC_hashes_)
+        self.c.execute(EXEC_hashes_index_)
+        self.c.execute(EXEC_volumes_)
 
         # If new DB, add password hash and salt in INFO table. Both the hash and the salt can be null.
         if not exists_db:
-            self.c.execute('insert into _info_ (pwd, salt, date, user, version) values (?,?,?,?,?)',
-                [new_check, self.glob_salt, strftime("%Y-%b-%d %H:%M:%S"), os.getenv('USERNAME'), __version__])
+            self.uuid = uuid4().hex
+            self.c.execute('insert into _info_ (pwd, salt, date, user, version, hash, uuid) values (?,?,?,?,?,?,?)',
+                [new_check, self.glob_salt, strftime(DATE_FORMAT), os.getenv('USERNAME'), __version__, hash, self.uuid])
             self.c.execute('insert into _logs_ (date, msg) values (?,?)',
             [strftime("%Y-%m-%d %H:%M:%S"), ('Username "%s" creates database.' % os.getenv('USERNAME'))])
         # If existing DB, write some logs.
@@ -201,19 +961,249 @@ class Briefcase:
             [strftime("%Y-%m-%d %H:%M:%S"), ('Username "%s" opens database.' % os.getenv('USERNAME'))])
 
         #
-        self.conn.commit()
+        self._commit()
+        self._upgrade()
+        self._dict_id = self.c.execute('select max(id) from _dicts_').fetchone()[0]
+        self._useHash()
+        for folder in volumes or []:
+            folder = os.path.abspath(folder)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            self.c.execute('insert or ignore into _volumes_ (path) values (?)', [folder])
+        if volume_size:
+            self.c.execute('update _info_ set pack_size = ?', [volume_size])
+        if self.packs:
+            self.c.execute('update _info_ set packs = 1 where packs is null')
+        self._commit()
+        self._loadVolumes()
         #
 
 
-    def _transformb(self, bdata, pwd='', arch='zlib'):
+    def _connect(self):
+        '''
+        Opens the connection of the current thread to the briefcase file. \n\
+        Each thread has its own connection, with its own statement cache. \n\
+        '''
+        local = self._local
+        # The connections can be closed by Close, from any thread.
+        local.conn = sqlite3.connect(self.database, timeout=self.timeout, cached_statements=CACHED_STATEMENTS,
+            check_same_thread=False, factory=_Connection)
+        local.conn.gate = self._gate
+        local.conn.wait = self.timeout
+        local.c = local.conn.cursor()
+        local.generation = self._generation
+        with self._pool_lock:
+            self._pool.append(local.conn)
+
+        if self.readonly:
+            local.c.execute('pragma query_only = 1')
+            return
+        if self.wal:
+            local.c.execute('pragma journal_mode = WAL')
+        # Write transactions take the lock when they begin, so they never fail in the middle.
+        local.conn.isolation_level = 'IMMEDIATE'
+        # Temporary table, used to change many files with one statement.
+        local.c.execute('create temp table if not exists _selected_ (file TEXT primary key)')
+        local.conn.commit()
+
+
+    def _thread(self):
+        '''
+        Returns the connection and the cursor of the current thread, connecting if needed. \n\
+        '''
+        if getattr(self._local, 'generation', None) != self._generation:
+            self._connect()
+        return self._local
+
+    conn = property(lambda self: self._thread().conn, doc='The connection of the current thread.')
+    c = property(lambda self: self._thread().c, doc='The cursor of the current thread.')
+
+
+    def _closeAll(self):
+        '''
+        Closes the connections of all threads. They will connect again when needed. \n\
+        '''
+        with self._pool_lock:
+            for conn in self._pool:
+                conn.close()
+            self._pool = []
+            self._generation += 1
+
+
+    def Close(self):
+        '''
+        Commits and closes all the connections to the briefcase file, from all threads. \n\
+        '''
+        self._commit()
+        self._packClose()
+        self._closeAll()
+
+
+    def _upgrade(self):
+        '''
+        Upgrades briefcase files created with older versions to the current schema. \n\
+        The schema version is stored in "pragma user_version", that is 0 for old files. \n\
+        '''
+        schema = self.c.execute('pragma user_version').fetchone()[0]
+        if schema >= SCHEMA_VERSION:
+            return
+        ti = clock()
+
+        if schema < 1:
+            # Labels are copied from _files_ into _labels_ and _file_labels_.
+            for fname, labels in self.c.execute('select file, labels from _files_').fetchall():
+                if labels:
+                    self._linkLabels([fname], labels.split(';'))
+
+        if schema < 2:
+            # Dates like "2012-Mar-05" sort alphabetically on the month ; they become "2012-03-05".
+            self.conn.create_function('iso_date', 1, isoDate)
+            for table in self.c.execute('select name from sqlite_master where type="table" and '\
+                'name like "t%"').fetchall():
+                self.c.execute('update %s set date = iso_date(date)' % table[0])
+                self.c.execute(EXEC_versions_index_ % (table[0], table[0]))
+            self.c.execute('update _statistics_ set date0 = iso_date(date0), date = iso_date(date)')
+            self.c.execute('update _info_ set date = iso_date(date)')
+
+        if schema < 3:
+            # The versions can be stored in solid blocks.
+            for table in self.c.execute('select name from sqlite_master where type="table" and '\
+                'name like "t%"').fetchall():
+                self.c.execute('alter table %s add column block INTEGER' % table[0])
+                self.c.execute('alter table %s add column offset INTEGER' % table[0])
+
+        if schema < 4:
+            # The versions can be compressed against a dictionary.
+            for table in self.c.execute('select name from sqlite_master where type="table" and '\
+                'name like "t%"').fetchall():
+                self.c.execute('alter table %s add column dict INTEGER' % table[0])
+
+        if schema < 5:
+            # The old files use MD4 for content hashes.
+            if 'hash' not in [vElem[1] for vElem in self.c.execute('pragma table_info(_info_)')]:
+                self.c.execute('alter table _info_ add column hash TEXT')
+            self.c.execute('update _info_ set hash = "md4" where hash is null')
+
+        if schema < 6:
+            # The hashes of all the versions are indexed, and the blocks can use dictionaries.
+            if 'dict' not in [vElem[1] for vElem in self.c.execute('pragma table_info(_blocks_)')]:
+                self.c.execute('alter table _blocks_ add column dict INTEGER')
+            for fname, in self.c.execute('select file from _files_').fetchall():
+                self.c.execute('insert or ignore into _hashes_ (hash, file, version, size) select hash, ?, '\
+                    'version, size from %s' % self._table(fname), [fname])
+
+        if schema < 7:
+            # The blocks count the versions using them, so they can be shared and deleted safely.
+            if 'refs' not in [vElem[1] for vElem in self.c.execute('pragma table_info(_blocks_)')]:
+                self.c.execute('alter table _blocks_ add column refs INTEGER default 0')
+            self._countRefs()
+
+        if schema < 9:
+            # The blocks can be stored in packfiles. This and the next steps run before step 8, that moves
+            # the data into blocks, maybe into packfiles.
+            columns = [vElem[1] for vElem in self.c.execute('pragma table_info(_blocks_)')]
+            for column in ['pack', 'pos', 'length']:
+                if column not in columns:
+                    self.c.execute('alter table _blocks_ add column %s INTEGER' % column)
+            if 'packs' not in [vElem[1] for vElem in self.c.execute('pragma table_info(_info_)')]:
+                self.c.execute('alter table _info_ add column packs INTEGER')
+
+        if schema < 10:
+            # The packfiles can be spread over volumes, with a maximum size.
+            if 'pack_size' not in [vElem[1] for vElem in self.c.execute('pragma table_info(_info_)')]:
+                self.c.execute('alter table _info_ add column pack_size INTEGER')
+
+        if schema < 11:
+            # The packfiles are named with the uuid of the briefcase file, so the briefcase files with
+            # the same name can share the volume folders. The old packfiles used by this briefcase get it.
+            if 'uuid' not in [vElem[1] for vElem in self.c.execute('pragma table_info(_info_)')]:
+                self.c.execute('alter table _info_ add column uuid TEXT')
+            self.c.execute('update _info_ set uuid = ? where uuid is null', [uuid4().hex])
+            self.uuid = self.c.execute('select uuid from _info_').fetchone()[0]
+            folders = [vElem[0] for vElem in self.c.execute('select path from _volumes_')]
+            old_packs = _packFiles(self.database, folders, '')
+            for pack, in self.c.execute('select distinct pack from _blocks_ where pack is not null').fetchall():
+                if pack in old_packs:
+                    os.rename(old_packs[pack], _packPath(self.database, pack, os.path.dirname(old_packs[pack]),
+                        self.uuid))
+
+        if schema < 8:
+            # The data of all versions is moved into _blocks_. Cleanup makes the file smaller after this.
+            for table, in self.c.execute('select name from sqlite_master where type="table" and '\
+                'name like "t%"').fetchall():
+                for version, in self.c.execute('select version from %s where raw is not null' % table).fetchall():
+                    self._shareVersion(table, version)
+
+        self.c.execute('pragma user_version = %i' % SCHEMA_VERSION)
+        self._commit()
+        self._log(1, 'Upgrading briefcase schema from %i to %i took %.4f sec.' % (schema, SCHEMA_VERSION, clock()-ti))
+
+
+    def _useHash(self):
+        '''
+        Reads the content hash of this briefcase file from _info_. \n\
+        '''
+        self.hash_name = self.c.execute('select hash from _info_').fetchone()[0] or 'md4'
+        if self.hash_name not in HASHES:
+            raise Exception('The briefcase file "%s" uses the hash `%s`, that is not available!' % \
+                (self.database, self.hash_name))
+        self._hasher = HASHES[self.hash_name]
+
+
+    def _table(self, fname):
+        '''
+        Returns the name of the table of one file : "t" + MD4 hexdigest of the file name. \n\
+        The table names of the most recent files are kept in memory. \n\
+        '''
+        with self._cache_lock:
+            filename = self._tables.pop(fname, None)
+            if filename is None:
+                filename = 't'+MD4.new(fname).hexdigest()
+            self._tables[fname] = filename
+            if len(self._tables) > TABLE_CACHE:
+                self._tables.popitem(False)
+        return filename
+
+
+    def _pwdHash(self, password):
+        '''
+        Returns the password check stored in _files_ table, for one file password. \n\
+        The PBKDF2 is calculated only once for each password. \n\
+        '''
+        if password not in self._checks:
+            self._checks[password] = buffer(PBKDF2(password=password, salt='briefcase', dkLen=16, count=5000))
+        return self._checks[password]
+
+
+    def _pwdKey(self, password):
+        '''
+        Returns the key derivation used to encrypt/ decrypt the files with one password. \n\
+        The PBKDF2 is calculated only once for each password. \n\
+        '''
+        if password not in self._keys:
+            self._keys[password] = PBKDF2(password=password, salt=self.glob_salt, dkLen=32, count=1000)
+        return self._keys[password]
+
+
+    def _transformb(self, bdata, pwd='', arch='zlib', zdict=None):
         '''
         Transforms any binary data into ready-to-write SQL information. \n\
-        zlib is faster, bz2 is stronger. \n\
+        zlib is faster, bz2 is stronger. If zdict is a dictionary id, zlib uses that dictionary. \n\
         '''
         if arch=='bz2':
             vCompressed = bz2.compress(bdata,6)
+        elif zdict:
+            comp = self._dictionary(zdict)[0].copy()
+            vCompressed = comp.compress(bdata) + comp.flush()
         else:
             vCompressed = zlib.compress(bdata,9)
+        return self._encryptb(vCompressed, pwd)
+
+
+    def _encryptb(self, vCompressed, pwd=''):
+        '''
+        Encrypts data that is already compressed, with the password. \n\
+        '''
         # If password is null in some way, do not encrypt.
         if not pwd:
             return buffer(vCompressed)
@@ -227,7 +1217,7 @@ class Briefcase:
                 pwd = self.glob_key
         # If password is provided, generate key derivation.
         else:
-            pwd = PBKDF2(password=pwd, salt=self.glob_salt, dkLen=32, count=1000)
+            pwd = self._pwdKey(pwd)
         # Encrypt and return.
         crypt = AES.new(pwd)
         padding = 'X' * ( (((len(vCompressed)/16)+1)*16) - len(vCompressed) )
@@ -235,43 +1225,74 @@ class Briefcase:
         return buffer(vCrypt)
 
 
-    def _restoreb(self, bdata, pwd=''):
+    def _restoreb(self, bdata, pwd='', zdict=None):
         '''
         Restores binary data from SQL information. \n\
+        If zdict is a dictionary id, the data was compressed against that dictionary. \n\
         '''
-        # If password is null in some way, do not encrypt.
-        if not pwd:
-            try: return zlib.decompress(bdata)
-            except: return bz2.decompress(bdata)
-        # If using global password.
-        elif pwd == 1:
-            # If global password is null, do not decrypt.
-            if not self.glob_key:
-                try: return zlib.decompress(bdata)
-                except: return bz2.decompress(bdata)
-            # If global password exists, use it.
-            else:
-                pwd = self.glob_key
-        # If password is provided, generate key derivation.
-        else:
-            pwd = PBKDF2(password=pwd, salt=self.glob_salt, dkLen=32, count=1000)
-        # Decrypt and return.
-        crypt = AES.new(pwd)
-        vCompressed = crypt.decrypt(bdata)
+        vCompressed = self._decryptb(bdata, pwd)
+        if zdict:
+            decomp = self._dictionary(zdict)[1].copy()
+            return decomp.decompress(vCompressed) + decomp.flush()
         try: return zlib.decompress(vCompressed)
         except: return bz2.decompress(vCompressed)
 
 
+    def _decryptb(self, bdata, pwd=''):
+        '''
+        Decrypts binary data from SQL information, without decompressing it. \n\
+        '''
+        key = self._aesKey(pwd)
+        # If password is null in some way, do not decrypt.
+        if not key:
+            return bdata
+        return AES.new(key).decrypt(bdata)
+
+
+    def _aesKey(self, pwd=''):
+        '''
+        Returns the AES key used for one password, or None if the data is not encrypted. \n\
+        '''
+        if not pwd or (pwd == 1 and not self.glob_key):
+            return None
+        # If using global password, or if password is provided, generate key derivation.
+        return pwd == 1 and self.glob_key or self._pwdKey(pwd)
+
+
+    def _dictionary(self, zdict):
+        '''
+        Returns the primed (compressor, decompressor) of one dictionary, kept in memory. \n\
+        '''
+        if zdict not in self._dicts:
+            raw = self.c.execute('select raw from _dicts_ where id=?', [zdict]).fetchone()[0]
+            primed = primeDictionary(self._restoreb(raw, 1))
+            with self._cache_lock:
+                self._dicts[zdict] = primed
+        return self._dicts[zdict]
+
+
+    def _commit(self):
+        '''
+        Writes the log messages into _logs_ and commits. \n\
+        '''
+        logs, self._logs = self._logs, []
+        if logs and not self.readonly:
+            self.c.executemany('insert into _logs_ (date, msg) values (?,?)', logs)
+        # The data appended to the packfiles must be on disk before the blocks that use it.
+        self._packSync()
+        self.conn.commit()
+
+
     def _log(self, level, msg, log=True):
         '''
         Prints debug and error messages. \n\
         level 1 = info message, level 2 = fatal error. \n\
         verbose 0 = silence, verbose 1 = print errors, verbose 2+ = print all. \n\
+        The messages are written in _logs_ at the next commit, so logging never locks the database. \n\
         '''
 
-        if log:
-            self.c.execute('insert into _logs_ (date, msg) values (?,?)',
-                [strftime("%Y-%m-%d %H:%M:%S"), msg])
+        if log and not self.readonly:
+            self._logs.append((strftime("%Y-%m-%d %H:%M:%S"), msg))
 
         if self.verbose <= 0:
             # Don't print anything.
@@ -287,74 +1308,161 @@ class Briefcase:
             return 2
 
 
+    def _selectFiles(self, fnames):
+        '''
+        Puts the file names in the temporary table _selected_, so many files can be
+        changed with one statement. \n\
+        '''
+        self.c.execute('delete from _selected_')
+        self.c.executemany('insert or ignore into _selected_ (file) values (?)', [(f,) for f in fnames])
+
+
+    def _linkLabels(self, fnames, lLabels):
+        '''
+        Replaces the labels of the files in _file_labels_. New labels are added in _labels_. \n\
+        '''
+        self._selectFiles(fnames)
+        self.c.execute('delete from _file_labels_ where file in (select file from _selected_)')
+        lLabels = [l for l in lLabels if l]
+        if not lLabels:
+            return
+        self.c.executemany('insert or ignore into _labels_ (label) values (?)', [(l,) for l in lLabels])
+        self.c.execute('insert or ignore into _file_labels_ (file, label) select s.file, l.id from '\
+            '_selected_ s, _labels_ l where l.label in (%s)' % ','.join('?' * len(lLabels)), lLabels)
+
+
     def SetLabels(self, fname, labels):
         '''
         Set labels/ tags/ keywords for one file. Labels can be used to sort and filter files. \n\
         Labels must be : ";" separated string, a list, or a tuple. \n\
         Any character excepting ";" can be used as label. \n\
+        Fname can also be a list of file names ; all the files get the same labels,
+        with one statement for each table. \n\
         '''
         ti = clock()
 
-        if not labels:
-            self.c.execute('update _files_ set labels=? where file=?', ['', fname])
-            return 0
+        if type(fname) == type([0,0]) or type(fname) == type((0,0)):
+            fnames = list(fname)
+        else:
+            fnames = [fname]
 
-        if type(labels) == type('') or type(labels) == type(u''):
-            lLabels = sorted([s.strip() for s in labels.split(';')])
-            sLabels = ';'.join(lLabels)
+        if not labels:
+            lLabels = []
+        elif type(labels) == type('') or type(labels) == type(u''):
+            lLabels = sorted(set([s.strip() for s in labels.split(';')]) - set(['']))
         elif type(labels) == type([0,0]) or type(labels) == type((0,0)):
-            lLabels = sorted([s.strip() for s in labels])
-            sLabels = ';'.join(lLabels)
+            lLabels = sorted(set([s.strip() for s in labels]) - set(['']))
         else:
             self._log(2, 'Func SetLabels: invalid type for the label! It must be : string, unicode, '
                 'list, or tuple. You provided type "%s".' % type(labels))
             return -1
-
-        # If file doesn't exist in database, exit.
-        if not self.c.execute('select file from _files_ where file=?', [fname]).fetchone():
-            self._log(2, 'Func SetLabels: file "%s" doesn\'t exist!' % fname)
+        sLabels = ';'.join(lLabels)
+
+        self._selectFiles(fnames)
+        # If files don't exist in database, exit.
+        existing = self.c.execute('select count(*) from _files_ where file in (select file from _selected_)').fetchone()[0]
+        if not existing:
+            # Removing the labels of a missing file is not an error.
+            if not lLabels:
+                return 0
+            self._log(2, 'Func SetLabels: file "%s" doesn\'t exist!' % ', '.join(fnames))
             return -1
-
-        # Update labels in _tables_.
-        self.c.execute('update _files_ set labels=? where file=?', [sLabels, fname])
-        self.conn.commit()
-        self._log(1, 'Setting labels for file "%s" took %.4f sec.' % (fname, clock()-ti))
+        elif existing < len(fnames):
+            self._log(2, 'Func SetLabels: %i files don\'t exist!' % (len(fnames) - existing))
+
+        # Update labels in _files_, _statistics_ and _file_labels_.
+        self.c.execute('update _files_ set labels=? where file in (select file from _selected_)', [sLabels])
+        self.c.execute('update _statistics_ set labels=? where file in (select file from _selected_)', [sLabels])
+        self._linkLabels(fnames, lLabels)
+        self._commit()
+        if lLabels:
+            self._log(1, 'Setting labels for %i files took %.4f sec.' % (existing, clock()-ti))
         return 0
 
 
-    def AddFile(self, filepath, password=1, labels='', arch='zlib', versionable=True):
+    def GetFilesByLabels(self, labels, match='all'):
         '''
-        If file doesn't exist in database, create the file. If file exists, add another row. \n\
-        Table name is "t" + MD4 Hexdigest of the file name. \n\
-        Each row contains : Version, Raw-data, Hash of original data, Size, Date Time, User Name. \n\
-        Raw-data is : original binary data -> compressed -> crypted. \n\
-        Versionable=False checks if the file is in the database. If it is, an error is raised
-        and the file is not added. \n\
+        Returns the files having all the labels (match="all"), or at least one of them (match="any"). \n\
+        Labels must be : ";" separated string, a list, or a tuple. \n\
+        It uses the _file_labels_ index. On error, it returns -1. \n\
         '''
         ti = clock()
-        fname = os.path.split(filepath)[1]
-        arch = arch.lower()
+        if type(labels) == type('') or type(labels) == type(u''):
+            labels = labels.split(';')
+        lLabels = sorted(set([s.strip() for s in labels]) - set(['']))
 
-        if not os.path.exists(filepath):
-            self._log(2, 'Func AddFile: file path "%s" doesn\'t exist!' % filepath)
+        if not lLabels or match not in ['all', 'any']:
+            self._log(2, 'Func GetFilesByLabels: no labels, or match "%s" is incorrect!' % match)
             return -1
-        if arch != 'zlib':
-            arch = 'bz2'
 
+        sql = 'select f.file from _file_labels_ f join _labels_ l on l.id = f.label '\
+            'where l.label in (%s) group by f.file' % ','.join('?' * len(lLabels))
+        if match == 'all':
+            sql += ' having count(*) = %i' % len(lLabels)
+        vList = self.c.execute(sql + ' order by f.file', lLabels).fetchall()
+
+        self._log(1, 'Get files by labels took %.4f sec.' % (clock()-ti))
+        return [vElem[0] for vElem in vList]
+
+
+    def _parsePassword(self, password):
+        '''
+        Returns the password and the password check that must be stored in _files_ table. \n\
+        The password can be : a string, 1 for the database default, or null in some way. \n\
+        '''
         # If password is a string or unicode, calculate the hash.
         if type(password) == type('') or type(password) == type(u''):
-            pwd_hash = buffer(PBKDF2(password=password, salt='briefcase', dkLen=16, count=5000))
+            return password, self._pwdHash(password)
         # If password is database default, do nothing.
         elif password == 1:
-            pwd_hash = 1
+            return password, 1
         # If password is null in some way, hash must be also null.
         else:
-            password = None
-            pwd_hash = None
+            return None, None
+
+
+    def _prepareFile(self, filepath, password=1, arch='zlib'):
+        '''
+        Reads, hashes and transforms one file, without touching the database. \n\
+        Because of this, many files can be prepared in parallel, in other threads. \n\
+        Returns a dictionary that must be passed to _storeFile. \n\
+        '''
+        # Read and transform all binary data.
+        f = open(filepath, 'rb').read()
+        return self._prepareData(os.path.split(filepath)[1], f, password, arch, filepath)
+
+
+    def _prepareData(self, fname, data, password=1, arch='zlib', filepath=None):
+        '''
+        Hashes and transforms the data of one file, already in memory, like _prepareFile. \n\
+        '''
+        password, pwd_hash = self._parsePassword(password)
+        # Small files are compressed against the latest dictionary, if any.
+        zdict = arch == 'zlib' and len(data) <= SMALL_FILE and self._dict_id or None
+        # This is the raw data.
+        raw = self._transformb(data, password, arch, zdict)
+        # This is the hash of the original file.
+        new_hash = self._hasher(data).hexdigest()
+        return {'filepath':filepath or fname, 'fname':fname, 'password':password, 'pwd_hash':pwd_hash,
+            'arch':arch, 'raw':raw, 'hash':new_hash, 'size':len(data), 'dict':zdict}
 
-        filename = 't'+MD4.new(fname).hexdigest()
 
-        old_pwd_hash = self.c.execute('select pwd from _files_ where file="%s"' % fname).fetchone()
+    def _prepareDeflated(self, fname, data, deflated, password=1, filepath=None):
+        '''
+        Prepares one file already compressed with raw deflate, for example a zip member, like _prepareData.
+        The deflate stream becomes a zlib stream, without compressing the data again. \n\
+        '''
+        password, pwd_hash = self._parsePassword(password)
+        raw = self._encryptb(ZLIB_HEADER + deflated + struct.pack('>I', zlib.adler32(data) & 0xffffffff), password)
+        return {'filepath':filepath or fname, 'fname':fname, 'password':password, 'pwd_hash':pwd_hash,
+            'arch':'zlib', 'raw':raw, 'hash':self._hasher(data).hexdigest(), 'size':len(data), 'dict':None}
+
+
+    def _checkAdd(self, fname, password, pwd_hash, versionable):
+        '''
+        Checks if a new version of the file can be added. Returns 0 or -1. \n\
+        '''
+        old_pwd_hash = self.c.execute('select pwd from _files_ where file=?', [fname]).fetchone()
 
         # If the file exists and used doesn't want new versions, exit.
         if old_pwd_hash and not versionable:
@@ -368,58 +1476,334 @@ class Briefcase:
                 self._log(2, 'Func AddFile: The password is INCORRECT! You will not be able to '\
                     'decrypt/ encrypt any data!')
                 return -1
+        return 0
 
-        self.c.execute('create table if not exists %s (version integer primary key asc, raw BLOB,'\
-            'hash TEXT, size INTEGER, date TEXT, user TEXT)' % filename)
 
-        # File size.
-        size = os.path.getsize(filepath)
-        # Read and transform all binary data.
-        f = open(filepath, 'rb').read()
-        # This is the raw data.
-        raw = self._transformb(f, password, arch)
-        md4 = MD4.new(f)
-        # This is the hash of the original file.
-        new_hash = md4.hexdigest()
-        del f, md4
+    def _createTable(self, filename):
+        '''
+        Creates the table that stores all the versions of one file, and its date index. \n\
+        '''
+        self.c.execute(EXEC_versions_ % filename)
+        self.c.execute(EXEC_versions_index_ % (filename, filename))
+
+
+    def _createTables(self, filenames):
+        '''
+        Creates the tables of many files in one transaction. The sqlite3 module commits before
+        every CREATE, so this is much faster than calling _createTable for each file. \n\
+        '''
+        if not filenames:
+            return
+        script = ''.join(['%s;%s;' % (EXEC_versions_ % f, EXEC_versions_index_ % (f, f)) for f in filenames])
+        self.conn._beginWrite()
+        try:
+            _retry(self.conn.executescript, 'begin immediate;' + script + 'commit;')
+        finally:
+            self.conn._endWrite()
+
+
+    def _loadHashes(self):
+        '''
+        Loads all the content hashes into a Bloom filter, used by the functions that add many files.
+        Most new files are not duplicates ; for them, the database is not searched at all. \n\
+        '''
+        count = self.c.execute('select count(*) from _hashes_').fetchone()[0]
+        known = _BloomFilter(count * 2)
+        for hash, in self.c.execute('select distinct hash from _hashes_'):
+            known.add(hash)
+        self._known = known
+
+
+    def _addHash(self, hash, fname, version, size):
+        '''
+        Adds the hash of a new version into _hashes_, and into the Bloom filter. \n\
+        '''
+        self.c.execute('insert or replace into _hashes_ (hash, file, version, size) values (?,?,?,?)',
+            [hash, fname, version, size])
+        if self._known is not None:
+            self._known.add(hash)
+            # Too many hashes make too many false positives.
+            if self._known.count > self._known.capacity:
+                self._known = None
+
+
+    def _putBlock(self, raw, size, zdict=None, refs=0):
+        '''
+        Stores the raw data of one new block, in _blocks_, or in the newest packfile if packs are
+        enabled. Returns the block id. \n\
+        '''
+        if not self.packs:
+            return self.c.execute('insert into _blocks_ (raw, size, dict, refs) values (?,?,?,?)',
+                [raw, size, zdict, refs]).lastrowid
+        # The insert takes the write lock, so only one process appends to the packfiles at one time.
+        block = self.c.execute('insert into _blocks_ (size, dict, refs) values (?,?,?)', [size, zdict,
+            refs]).lastrowid
+        pack, pos = self._packAppend(raw)
+        self.c.execute('update _blocks_ set pack=?, pos=?, length=? where id=?', [pack, pos, len(raw), block])
+        return block
+
+
+    def _loadVolumes(self):
+        '''
+        Reads the packfile settings and the volume folders from the briefcase file. \n\
+        '''
+        packs, self.volume_size, self.uuid = self.c.execute('select packs, pack_size, uuid from _info_').fetchone()
+        self.packs = bool(packs)
+        self.volumes = [vElem[0] for vElem in self.c.execute('select path from _volumes_ order by path')]
+        self._packs = _packFiles(self.database, self.volumes, self.uuid)
+
+
+    def _packAppend(self, raw):
+        '''
+        Appends raw data at the end of the newest packfile of the next volume, so the blocks are spread
+        over all volumes. A new packfile is started when the data doesn't fit in the volume size.
+        Returns (pack, position). The write lock must be already taken. \n\
+        The data is synced to disk by the next commit, before the database. \n\
+        '''
+        self._packs = packs = _packFiles(self.database, self.volumes, self.uuid)
+        folders = self.volumes or [os.path.dirname(os.path.abspath(self.database))]
+        self._volume = (self._volume + 1) % len(folders)
+        folder = folders[self._volume]
+        mine = [pack for pack, path in packs.items() if os.path.dirname(path) == folder]
+        pack = mine and max(mine)
+        size = pack and os.path.getsize(packs[pack])
+        if not pack or size and size + len(raw) > (self.volume_size or PACK_SIZE):
+            # The numbers are never used again, because the newest packfile of each volume is never compacted.
+            pack = max(packs.keys() + [0]) + 1
+            packs[pack] = _packPath(self.database, pack, folder, self.uuid)
+            for number, writer in self._writers.items():
+                if not writer[1]:
+                    writer[0].close()
+                    del self._writers[number]
+        writer = self._writers.get(pack)
+        if writer is None:
+            writer = self._writers[pack] = [open(packs[pack], 'ab'), False]
+        writer[0].seek(0, 2)
+        pos = writer[0].tell()
+        writer[0].write(raw)
+        writer[1] = True
+        return pack, pos
+
+
+    def _packSync(self):
+        '''
+        Syncs the packfiles written since the last commit to disk, each one in its own thread,
+        so the volumes on different disks are synced in parallel. \n\
+        '''
+        dirty = [writer for writer in self._writers.values() if writer[1]]
+        def sync(writer):
+            writer[0].flush()
+            os.fsync(writer[0].fileno())
+            writer[1] = False
+        threads = [threading.Thread(target=sync, args=(writer,)) for writer in dirty[1:]]
+        for t in threads:
+            t.start()
+        for writer in dirty[:1]:
+            sync(writer)
+        for t in threads:
+            t.join()
+
+
+    def _packClose(self):
+        #
+        self._packSync()
+        for writer in self._writers.values():
+            writer[0].close()
+        self._writers = {}
+        #
+
+
+    def _packFile(self, pack):
+        '''
+        Returns the path of one packfile, from any volume. \n\
+        '''
+        path = self._packs.get(pack)
+        if path is None:
+            self._packs = _packFiles(self.database, self.volumes, self.uuid)
+            path = self._packs.get(pack)
+            if path is None:
+                raise IOError('Packfile "%i" of "%s" is missing!' % (pack, self.database))
+        return path
+
+
+    def _packRead(self, pack, pos, length):
+        '''
+        Returns a buffer over the raw data of one block from a packfile, without copying it. \n\
+        '''
+        with self._cache_lock:
+            return _packBuffer(self._maps, self._packFile(pack), pos, length)
+
+
+    def _stored(self, row):
+        '''
+        Returns (raw, block, offset, size, dict) from one EXEC_stored_ row. \n\
+        '''
+        raw = row[0]
+        if raw is None and row[6] is not None:
+            raw = self._packRead(row[6], row[7], row[8])
+        return (raw,) + tuple(row[1:5])
+
+
+    def _shareVersion(self, filename, version):
+        '''
+        Returns (block, offset) of one version, that can be referenced by another version, or None
+        if the version doesn't exist. A version stored in its own row is moved into a block with
+        only one file, without decrypting it, so it can be shared. \n\
+        '''
+        row = self.c.execute('select raw, block, offset, size, dict from %s where version=?' % filename,
+            [version]).fetchone()
+        if not row:
+            return None
+        if row[1] is not None:
+            return row[1], row[2]
+        block = self._putBlock(row[0], row[3], row[4], 1)
+        self.c.execute('update %s set raw=null, block=?, offset=0, dict=null where version=?' % filename,
+            [block, version])
+        return block, 0
+
+
+    def _refBlocks(self, blocks, delta=1):
+        '''
+        Changes the reference counts of the blocks ; blocks is a list of block ids, with repetitions. \n\
+        When the count of one block becomes 0, the block is deleted. \n\
+        '''
+        blocks = [b for b in blocks if b is not None]
+        if not blocks:
+            return
+        self.c.executemany('update _blocks_ set refs = refs + ? where id=?', [(delta, b) for b in blocks])
+        if delta < 0:
+            for block in set(blocks):
+                self.c.execute('delete from _blocks_ where id=? and refs <= 0', [block])
+                with self._cache_lock:
+                    data = self._blocks.pop(block, None)
+                    if data is not None:
+                        self._blocks_size -= len(data)
+
+
+    def _countRefs(self):
+        '''
+        Counts again the versions using each block, and deletes the blocks that are not used. \n\
+        '''
+        refs = {}
+        for fname, in self.c.execute('select file from _files_').fetchall():
+            for block, count in self.c.execute('select block, count(*) from %s where block is not null '\
+                'group by block' % self._table(fname)).fetchall():
+                refs[block] = refs.get(block, 0) + count
+        self.c.execute('update _blocks_ set refs = 0')
+        self.c.executemany('update _blocks_ set refs=? where id=?', [(v, k) for k, v in refs.items()])
+        return self.c.execute('delete from _blocks_ where refs = 0').rowcount
+
+
+    def _findHash(self, hash, pwd, size, password, chunks):
+        '''
+        Finds a version with the same content and the same password, already stored in the database. \n\
+        The hashes can collide, so the size and then the data of the version are compared with the new
+        content, before sharing it. Chunks is a function that returns the parts of the new content. \n\
+        Returns (block, offset) that can be referenced by a new version, or None. \n\
+        '''
+        if self._known is not None and hash not in self._known:
+            return None
+        for fname, version in self.c.execute('select h.file, h.version from _hashes_ h join _files_ f '\
+            'on f.file = h.file where h.hash = ? and h.size = ? and f.pwd is ?', [hash, size, pwd]).fetchall():
+            filename = self._table(fname)
+            if not _sameChunks(self._versionChunks(self._versionRaw(filename, version), password), chunks()):
+                self._log(2, 'Func AddFile: file "%s" version "%i" has the same hash, but not the same data!' % \
+                    (fname, version))
+                continue
+            ref = self._shareVersion(filename, version)
+            if ref:
+                return ref
+        return None
+
+
+    def _storeFile(self, prepared, labels='', versionable=True, ti=None):
+        '''
+        Writes one file prepared by _prepareFile into the database. \n\
+        '''
+        if ti is None: ti = clock()
+        fname = prepared['fname']
+        password = prepared['password']
+
+        if self._checkAdd(fname, password, prepared['pwd_hash'], versionable):
+            return -1
+
+        filename = self._table(fname)
+        self._createTable(filename)
 
         # Check if the new file is identical with the latest version.
         old_hash = self.c.execute('select hash from %s order by version desc' % filename).fetchone()
-        if old_hash and new_hash == old_hash[0]:
+        if old_hash and prepared['hash'] == old_hash[0]:
             self._log(2, 'Func AddFile: file "%s" is IDENTICAL with the version stored in the '\
                 'database!' % fname)
+            self._commit()
             return -1
 
-        self.c.execute(('insert into %s (raw, hash, size, date, user) values (?,?,?,?,?)' % filename),
-            [raw, new_hash, size, strftime("%Y-%b-%d %H:%M:%S"), os.getenv('USERNAME')])
+        # If the same content is already stored, with the same password, only reference it.
+        ref = self._findHash(prepared['hash'], password and prepared['pwd_hash'], prepared['size'], password,
+            lambda: _restoreChunks(prepared['raw'], self._aesKey(password),
+                prepared['dict'] and self._dictionary(prepared['dict'])[1]))
+        if ref:
+            version = self.c.execute(('insert into %s (raw, hash, size, date, user, block, offset) values '\
+                '(?,?,?,?,?,?,?)' % filename), [None, prepared['hash'], prepared['size'], strftime(DATE_FORMAT),
+                os.getenv('USERNAME'), ref[0], ref[1]]).lastrowid
+            self._refBlocks([ref[0]])
+        else:
+            block = self._putBlock(prepared['raw'], prepared['size'], prepared['dict'], 1)
+            version = self.c.execute(('insert into %s (raw, hash, size, date, user, block, offset) values '\
+                '(?,?,?,?,?,?,?)' % filename), [None, prepared['hash'], prepared['size'], strftime(DATE_FORMAT),
+                os.getenv('USERNAME'), block, 0]).lastrowid
+        self._addHash(prepared['hash'], fname, version, prepared['size'])
 
         # If password is None, or password is False.
         if not password:
             self.c.execute('insert or ignore into _files_ (pwd, file) values (?,?)', [password, fname])
         # If password is provided by user, insert its hash in _files_ table.
         else:
-            self.c.execute('insert or ignore into _files_ (pwd, file) values (?,?)', [pwd_hash, fname])
+            self.c.execute('insert or ignore into _files_ (pwd, file) values (?,?)', [prepared['pwd_hash'], fname])
 
         # Set the labels...
         self.SetLabels(fname, labels)
         # File statistics...
         self.FileStatistics(fname)
         # Everything is fine, save.
-        self.conn.commit()
+        self._commit()
 
-        ver_max = self.c.execute('select version from %s order by version desc' % filename).fetchone()
-        self._log(1, 'Adding file "%s", arch %s, version "%i" took %.4f sec.' % (filepath, arch, ver_max[0], clock()-ti))
+        self._log(1, 'Adding file "%s", arch %s, version "%i"%s took %.4f sec.' % (prepared['filepath'],
+            prepared['arch'], version, ref and ', by reference,' or '', clock()-ti))
         return 0
 
 
-    def AddManyFiles(self, pathregex, password=1, labels='', versionable=True):
+    def AddFile(self, filepath, password=1, labels='', arch='zlib', versionable=True):
         '''
-        Add more files, using a pattern. \n\
         If file doesn't exist in database, create the file. If file exists, add another row. \n\
+        Table name is "t" + MD4 Hexdigest of the file name. \n\
+        Each row contains : Version, Raw-data, Hash of original data, Size, Date Time, User Name. \n\
+        Raw-data is : original binary data -> compressed -> crypted. \n\
         Versionable=False checks if the file is in the database. If it is, an error is raised
         and the file is not added. \n\
         '''
         ti = clock()
+        fname = os.path.split(filepath)[1]
+        arch = arch.lower()
+
+        if not os.path.exists(filepath):
+            self._log(2, 'Func AddFile: file path "%s" doesn\'t exist!' % filepath)
+            return -1
+        if arch != 'zlib':
+            arch = 'bz2'
+
+        # Check the password before reading the file.
+        if self._checkAdd(fname, *self._parsePassword(password), versionable=versionable):
+            return -1
+
+        prepared = self._prepareFile(filepath, password, arch)
+        return self._storeFile(prepared, labels, versionable, ti)
+
+
+    def _globFiles(self, pathregex):
+        '''
+        Returns the files matching the pattern, or -1 if the path doesn't exist. \n\
+        '''
         path = os.path.split(pathregex)[0]
 
         if not os.path.exists(path):
@@ -432,18 +1816,414 @@ class Briefcase:
         if not files:
             self._log(2, 'Func AddManyFiles: there are no files to match "%s"!' % pathregex)
             return -1
+        return files
 
-        for file in files:
-            self.AddFile(file, password, labels, versionable)
+
+    def _storeBlock(self, batch, password=1, labels='', versionable=True):
+        '''
+        Writes many small files into one solid block : the files are joined, then compressed
+        and encrypted together, so zlib can use the similar parts of all the files. \n\
+        Batch is a list of (file path, data, hash). Each file gets a new version, with null raw,
+        the block id and the offset of the file inside the block. \n\
+        Returns the number of files added. \n\
+        '''
+        ti = clock()
+        password, pwd_hash = self._parsePassword(password)
+
+        checked = []
+        for filepath, data, hash in batch:
+            fname = os.path.split(filepath)[1]
+            if not self._checkAdd(fname, password, pwd_hash, versionable):
+                checked.append((fname, self._table(fname), data, hash))
+        # Create all the tables before writing, because every CREATE commits.
+        self._createTables([vElem[1] for vElem in checked])
+
+        selected = []
+        for fname, filename, data, hash in checked:
+            old_hash = self.c.execute('select hash from %s order by version desc' % filename).fetchone()
+            if old_hash and hash == old_hash[0]:
+                self._log(2, 'Func AddFile: file "%s" is IDENTICAL with the version stored in the '\
+                    'database!' % fname)
+                continue
+            selected.append((fname, filename, data, hash))
+        if not selected:
+            return 0
+
+        # The content that is already stored is only referenced, also inside the new block.
+        # Inside the new block, the offsets are found by data, not by hash, so the same data is shared.
+        rows = []
+        parts = []
+        offsets = {}
+        size = 0
+        for fname, filename, data, hash in selected:
+            ref = self._findHash(hash, password and pwd_hash, len(data), password, lambda: [data])
+            if not ref and data not in offsets:
+                offsets[data] = size
+                parts.append(data)
+                size += len(data)
+            rows.append((fname, filename, data, hash, ref))
+
+        block = ''.join(parts)
+        raw = ''
+        block_id = None
+        if parts:
+            raw = self._transformb(block, password, 'zlib')
+            block_id = self._putBlock(raw, len(block))
+
+        date = strftime(DATE_FORMAT)
+        for fname, filename, data, hash, ref in rows:
+            block_ref, offset = ref or (block_id, offsets[data])
+            version = self.c.execute('insert into %s (raw, hash, size, date, user, block, offset) values '\
+                '(?,?,?,?,?,?,?)' % filename, [None, hash, len(data), date, os.getenv('USERNAME'),
+                block_ref, offset]).lastrowid
+            self._refBlocks([block_ref])
+            self._addHash(hash, fname, version, len(data))
+            self.c.execute('insert or ignore into _files_ (pwd, file) values (?,?)', [password and pwd_hash, fname])
+
+        fnames = [vElem[0] for vElem in selected]
+        self.SetLabels(fnames, labels)
+        for fname in fnames:
+            self.FileStatistics(fname)
+        self._commit()
+
+        self._log(1, 'Adding %i files in block "%s", %i bytes into %i, took %.4f sec.' % (len(selected),
+            block_id, len(block), len(raw), clock()-ti))
+        return len(selected)
+
+
+    def AddManyFiles(self, pathregex, password=1, labels='', versionable=True, progress=None, solid=False):
+        '''
+        Add more files, using a pattern. \n\
+        If file doesn't exist in database, create the file. If file exists, add another row. \n\
+        Versionable=False checks if the file is in the database. If it is, an error is raised
+        and the file is not added. \n\
+        If solid is true, the files smaller than SMALL_FILE are packed into solid blocks of about
+        BLOCK_SIZE bytes, compressed together, with one transaction for each block. This is
+        much smaller and faster for many small files. The bigger files are added like with AddFile. \n\
+        Progress is an optional function called after each file, with : files done, total files,
+        bytes done. If it returns False, the rest of the files are not added. \n\
+        '''
+        ti = clock()
+        files = self._globFiles(pathregex)
+        if files == -1:
+            return -1
+
+        nbytes = 0
+        batch = []
+        batch_size = 0
+        self._loadHashes()
+        for i, file in enumerate(files):
+            size = os.path.getsize(file)
+            if solid and size <= SMALL_FILE and os.path.isfile(file):
+                data = open(file, 'rb').read()
+                batch.append((file, data, self._hasher(data).hexdigest()))
+                batch_size += len(data)
+                if batch_size >= BLOCK_SIZE:
+                    self._storeBlock(batch, password, labels, versionable)
+                    batch = []
+                    batch_size = 0
+            else:
+                self.AddFile(file, password, labels, versionable=versionable)
+            nbytes += size
+            if progress and progress(i+1, len(files), nbytes) is False:
+                self._log(2, 'Func AddManyFiles: stopped after %i files!' % (i+1))
+                break
+        if batch:
+            self._storeBlock(batch, password, labels, versionable)
+        self._known = None
 
         self._log(1, 'Added %i files in %.4f sec.' % (len(files), clock()-ti))
         return 0
 
 
+    def _archiveMembers(self, archive, passthrough=True):
+        '''
+        Opens a tar or zip archive. Returns (number of files, or 0 for tar, iterator of (path, data, deflated)).
+        Deflated is the raw deflate stream of zip members compressed with deflate, if passthrough is true,
+        else it's None. The members are read one by one, never extracted on disk. \n\
+        '''
+        if isinstance(archive, basestring):
+            is_zip = zipfile.is_zipfile(archive)
+        else:
+            # Streams that cannot seek can only be tar streams.
+            try:
+                archive.seek(0)
+                is_zip = zipfile.is_zipfile(archive)
+                archive.seek(0)
+            except (IOError, AttributeError):
+                is_zip = None
+
+        if is_zip:
+            zf = zipfile.ZipFile(archive)
+            infos = [info for info in zf.infolist() if not info.filename.endswith('/')]
+            def members():
+                for info in infos:
+                    if info.flag_bits & 1:
+                        self._log(2, 'Func AddArchive: member "%s" is encrypted! Skipped!' % info.filename)
+                        continue
+                    if not passthrough or info.compress_type != zipfile.ZIP_DEFLATED:
+                        yield info.filename, zf.read(info), None
+                        continue
+                    # Read the compressed data after the local header, like zipfile does.
+                    zf.fp.seek(info.header_offset)
+                    header = struct.unpack('<4s2B4HL2L2H', zf.fp.read(30))
+                    zf.fp.seek(header[10] + header[11], 1)
+                    deflated = zf.fp.read(info.compress_size)
+                    decomp = zlib.decompressobj(-15)
+                    data = decomp.decompress(deflated) + decomp.flush()
+                    if zlib.crc32(data) & 0xffffffff != info.CRC:
+                        self._log(2, 'Func AddArchive: member "%s" is corrupted! Skipped!' % info.filename)
+                        continue
+                    yield info.filename, data, deflated
+                zf.close()
+            return len(infos), members()
+
+        if is_zip is None:
+            tf = tarfile.open(fileobj=archive, mode='r|*')
+        elif isinstance(archive, basestring):
+            tf = tarfile.open(archive, 'r:*')
+        else:
+            tf = tarfile.open(fileobj=archive, mode='r:*')
+        def members():
+            for info in tf:
+                if info.isfile():
+                    yield info.name, tf.extractfile(info).read(), None
+            tf.close()
+        return 0, members()
+
+
+    def AddArchive(self, archive, password=1, labels='', arch='zlib', versionable=True, path_labels=False,
+            solid=False, progress=None):
+        '''
+        Add all the files from a tar, tar.gz, tar.bz2 or zip archive, without extracting it on disk. \n\
+        Archive is a path, or a file object ; file objects that cannot seek, like stdin, must be tar streams. \n\
+        The file names are the paths inside the archive, with "~" instead of "/", like in SyncIn.
+        If path_labels is true, the folders of each file are also used as labels. \n\
+        If arch is zlib, zip members compressed with deflate are stored without compressing them again. \n\
+        If solid is true, the small files are packed like in AddManyFiles. \n\
+        Progress is an optional function called after each file, with : files done, total files
+        (0 for tar archives), bytes done. If it returns False, the rest of the files are not added. \n\
+        '''
+        ti = clock()
+        arch = arch.lower()
+        if arch != 'zlib':
+            arch = 'bz2'
+        if type(labels) == type('') or type(labels) == type(u''):
+            labels = labels.split(';')
+        lLabels = [l for l in labels if l]
+
+        try:
+            total, members = self._archiveMembers(archive, arch == 'zlib')
+        except (IOError, OSError, tarfile.TarError, zipfile.BadZipfile), e:
+            self._log(2, 'Func AddArchive: cannot read the archive "%s"! %s' % (archive, e))
+            return -1
+
+        done = 0
+        added = 0
+        passed = 0
+        nbytes = 0
+        batches = {}
+        self._loadHashes()
+        try:
+            for path, data, deflated in members:
+                parts = [p for p in path.replace('\\', '/').split('/') if p and p != '.']
+                fname = '~'.join(parts)
+                if not parts or not validFileName(fname):
+                    self._log(2, 'Func AddArchive: member "%s" doesn\'t have a valid file name! Skipped!' % path)
+                    continue
+                file_labels = lLabels + (path_labels and parts[:-1] or [])
+
+                if solid and len(data) <= SMALL_FILE:
+                    # The files with the same labels are packed together.
+                    batch = batches.setdefault(';'.join(file_labels), [[], 0])
+                    batch[0].append((fname, data, self._hasher(data).hexdigest()))
+                    batch[1] += len(data)
+                    if batch[1] >= BLOCK_SIZE:
+                        added += self._storeBlock(batch[0], password, file_labels, versionable)
+                        del batches[';'.join(file_labels)]
+                else:
+                    if deflated is not None:
+                        prepared = self._prepareDeflated(fname, data, deflated, password)
+                        passed += 1
+                    else:
+                        prepared = self._prepareData(fname, data, password, arch)
+                    if not self._storeFile(prepared, file_labels, versionable):
+                        added += 1
+
+                done += 1
+                nbytes += len(data)
+                if progress and progress(done, total, nbytes) is False:
+                    self._log(2, 'Func AddArchive: stopped after %i files!' % done)
+                    break
+        except (IOError, tarfile.TarError, zipfile.BadZipfile, zlib.error), e:
+            self._log(2, 'Func AddArchive: cannot read the archive "%s"! %s' % (archive, e))
+            return -1
+        finally:
+            for key, batch in batches.items():
+                added += self._storeBlock(batch[0], password, key.split(';'), versionable)
+            self._known = None
+
+        self._log(1, 'Adding archive "%s" : %i files, %i added, %i without compressing again, took %.4f sec.' % \
+            (archive, done, added, passed, clock()-ti))
+        return 0
+
+
+    def _walkFiles(self, root):
+        '''
+        Returns a list of (file name, file path, size, mtime) for all the files from root
+        and its subfolders. The file name is the relative path, with "~" instead of "/". \n\
+        Uses scandir if available, so every file is checked with only one system call. \n\
+        '''
+        files = []
+        folders = [(root, '')]
+        while folders:
+            folder, prefix = folders.pop()
+            if scandir:
+                for entry in scandir(folder):
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append((entry.path, prefix + entry.name + '~'))
+                    elif entry.is_file():
+                        st = entry.stat()
+                        files.append((prefix + entry.name, entry.path, st.st_size, st.st_mtime))
+            else:
+                for name in os.listdir(folder):
+                    filepath = os.path.join(folder, name)
+                    st = os.lstat(filepath)
+                    if stat.S_ISDIR(st.st_mode):
+                        folders.append((filepath, prefix + name + '~'))
+                    elif stat.S_ISREG(st.st_mode):
+                        files.append((prefix + name, filepath, st.st_size, st.st_mtime))
+        return files
+
+
+    def _checkFile(self, filepath, fname, old_hash, password, arch):
+        '''
+        Hashes the file, reading it in small blocks. If the hash is the same as old hash,
+        returns None. Else, returns the file prepared by _prepareFile. Doesn't touch the database. \n\
+        '''
+        if old_hash:
+            hasher = self._hasher()
+            f = open(filepath, 'rb')
+            for block in iter(lambda: f.read(65536), ''):
+                hasher.update(block)
+            f.close()
+            if hasher.hexdigest() == old_hash:
+                return None
+        prepared = self._prepareFile(filepath, password, arch)
+        prepared['fname'] = fname
+        return prepared
+
+
+    def SyncIn(self, path, password=1, labels='', arch='zlib', workers=4, progress=None):
+        '''
+        Add all the files from one folder and its subfolders. Only the files that are new, or changed
+        since the last sync from the same folder, are added. \n\
+        The file names are the relative paths, with "~" instead of "/", for example "docs~a.txt". \n\
+        The size and modification time of each file are kept in _imported_ table. Only the files
+        with another size, or time, are hashed, and only the files with another hash are added. \n\
+        The files are hashed and transformed by "workers" threads. \n\
+        Progress is an optional function called after each checked file, with : files done,
+        files to check, bytes done. If it returns False, the rest of the files are not checked. \n\
+        '''
+        ti = clock()
+        if not os.path.isdir(path):
+            self._log(2, 'Func SyncIn: path "%s" doesn\'t exist!' % path)
+            return -1
+
+        root = os.path.abspath(path)
+        arch = arch.lower()
+        if arch != 'zlib':
+            arch = 'bz2'
+        files = self._walkFiles(root)
+        imported = dict([(vElem[0], vElem[1:]) for vElem in self.c.execute('select file, size, mtime '\
+            'from _imported_ where path=?', [root])])
+
+        candidates = []
+        for fname, filepath, size, mtime in files:
+            if imported.get(fname) == (size, mtime):
+                continue
+            if not validFileName(fname):
+                self._log(2, 'Func SyncIn: file name "%s" is not valid!' % fname)
+                continue
+            old_hash = None
+            if self.c.execute('select file from _files_ where file=?', [fname]).fetchone():
+                filename = self._table(fname)
+                old_hash = self.c.execute('select hash from %s order by version desc' % filename).fetchone()[0]
+            candidates.append((fname, filepath, size, mtime, old_hash))
+
+        # The worker threads check the files, this thread writes them in the database.
+        self._loadHashes()
+        tasks = Queue.Queue()
+        results = Queue.Queue()
+        def work():
+            for task in iter(tasks.get, None):
+                try:
+                    results.put((task, self._checkFile(task[1], task[0], task[4], password, arch)))
+                except Exception, e:
+                    results.put((task, e))
+        threads = [threading.Thread(target=work) for i in range(max(workers, 1))]
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+
+        # Only a few prepared files are kept in memory at one time.
+        queued = iter(candidates)
+        pending = 0
+        for task in queued:
+            tasks.put(task)
+            pending += 1
+            if pending >= len(threads) * 2: break
+
+        added = 0
+        nbytes = 0
+        done = 0
+        while pending:
+            task, prepared = results.get()
+            pending -= 1
+            for next_task in queued:
+                tasks.put(next_task)
+                pending += 1
+                break
+            fname, filepath, size, mtime, old_hash = task
+            if isinstance(prepared, Exception):
+                self._log(2, 'Func SyncIn: cannot read file "%s"! %s' % (filepath, prepared))
+                ok = False
+            elif prepared is None:
+                ok = True
+            else:
+                ok = not self._storeFile(prepared, labels)
+                added += ok
+            if ok:
+                self.c.execute('insert or replace into _imported_ (path, file, size, mtime) values (?,?,?,?)',
+                    [root, fname, size, mtime])
+            done += 1
+            nbytes += size
+            if progress and progress(done, len(candidates), nbytes) is False:
+                self._log(2, 'Func SyncIn: stopped after %i files!' % done)
+                queued = iter([])
+                while pending:
+                    results.get()
+                    pending -= 1
+
+        for t in threads:
+            tasks.put(None)
+        self._known = None
+
+        # Forget the files that don't exist in the folder anymore.
+        self._selectFiles([f[0] for f in files])
+        self.c.execute('delete from _imported_ where path=? and file not in (select file from _selected_)', [root])
+        self._commit()
+        self._log(1, 'Sync in from "%s" : %i files, %i checked, %i added, took %.4f sec.' % \
+            (root, len(files), done, added, clock()-ti))
+        return 0
+
+
     def CopyIntoNew(self, fname, version, new_fname):
         '''
         Copy one version of one file, into a new file, that will have version 1. \n\
         The password will be the same as in the original file. \n\
+        The data is not copied ; both files reference the same block, that is deleted only
+        when the last version using it is deleted. \n\
         '''
         ti = clock()
         if not validFileName(new_fname):
@@ -451,12 +2231,8 @@ class Briefcase:
                 'characters  \\ / : * ? " < > |')
             return -1
 
-        md4 = MD4.new(fname)
-        filename = 't'+md4.hexdigest()
-        del md4
-        md4 = MD4.new(new_fname)
-        new_filename = 't'+md4.hexdigest()
-        del md4
+        filename = self._table(fname)
+        new_filename = self._table(new_fname)
 
         if version < 0 : version = 0
 
@@ -474,27 +2250,166 @@ class Briefcase:
 
         # If version was specified, get that version.
         if version:
-            data = self.c.execute('select raw, hash, size from %s where version=%i' % \
+            data = self.c.execute('select version, hash, size from %s where version=%i' % \
                 (filename, version)).fetchone()
         # Else, get the latest version.
         else:
-            data = self.c.execute('select raw, hash, size from %s order by version desc' % \
+            data = self.c.execute('select version, hash, size from %s order by version desc' % \
                 filename).fetchone()
+        if not data:
+            self._log(2, 'Func CopyIntoNew: there is no version "%i" for file "%s"!' % (version, fname))
+            return -1
 
-        self.c.execute('create table %s (version integer primary key asc, raw BLOB, hash TEXT,'
-            'size INTEGER, date TEXT, user TEXT)' % new_filename)
-        self.c.execute(('insert into %s (raw, hash, size, date, user) values (?,?,?,?,?)' % new_filename),
-            [data[0], data[1], data[2], strftime("%Y-%b-%d %H:%M:%S"), os.getenv('USERNAME')])
+        # The new version only references the data of the original version.
+        block, offset = self._shareVersion(filename, data[0])
+        self._createTable(new_filename)
+        self.c.execute(('insert into %s (raw, hash, size, date, user, block, offset) values '\
+            '(?,?,?,?,?,?,?)' % new_filename), [None, data[1], data[2], strftime(DATE_FORMAT),
+            os.getenv('USERNAME'), block, offset])
+        self._refBlocks([block])
+        self._addHash(data[1], new_fname, 1, data[2])
 
         # Use original password and labels of file.
         more = self.c.execute('select pwd, labels from _files_ where file=?', [fname]).fetchone()
 
-        self.c.execute('insert into _files_ (file, pwd, labels) values (?,?,?)', (new_fname,)+more)
-        self.FileStatistics(new_fname)
-        self.conn.commit()
+        self.c.execute('insert into _files_ (file, pwd, labels) values (?,?,?)', (new_fname,)+more)
+        self.c.execute('insert into _file_labels_ (file, label) select ?, label from _file_labels_ '\
+            'where file=?', [new_fname, fname])
+        self.FileStatistics(new_fname)
+        self._commit()
+
+        self._log(1, 'Copying file "%s" into "%s" took %.4f sec.' % (fname, new_fname, clock()-ti))
+        return 0
+
+
+    def _fetchFile(self, fname, password=1, version=0):
+        '''
+        Reads one version of one file from the database and checks the password. \n\
+        If version is not null, that specific version is used. Else, the most recent version is used. \n\
+        Returns (stored, hash, password) that can be restored in any thread, or -1 on error.
+        Stored is (raw, block, offset, size, dict), as returned by _versionRaw. \n\
+        '''
+        filename = self._table(fname)
+
+        # If version is a positive number, get that version.
+        if version > 0:
+            try:
+                selected_version = self.c.execute(EXEC_stored_ % filename + ' where v.version=?',
+                    [version]).fetchone()
+            except:
+                self._log(2, 'Func ExportFile: cannot find version "%i" for file "%s"!' % \
+                    (version, fname))
+                return -1
+        # Else, get the latest version.
+        else:
+            try:
+                selected_version = self.c.execute(EXEC_stored_ % filename + ' order by v.version desc '\
+                    'limit 1').fetchone()
+            except:
+                self._log(2, 'Func ExportFile: cannot find the file called "%s"!' % fname)
+                return -1
+        if not selected_version:
+            self._log(2, 'Func ExportFile: cannot find version "%i" for file "%s"!' % (version, fname))
+            return -1
+
+        # Get file password hash. It can be None, (Zero), or (some hash string).
+        old_pwd_hash = self.c.execute('select pwd from _files_ where file=?', [fname]).fetchone()
+
+        if old_pwd_hash:
+            old_pwd_hash = old_pwd_hash[0]
+
+        password, pwd_hash = self._parsePassword(password)
+
+        # If provided password != stored password...
+        if old_pwd_hash != pwd_hash:
+            self._log(2, 'Func ExportFile: Password for file "%s" is INCORRECT! You will not be '\
+                'able to decrypt any data!' % fname)
+            return -1
+
+        return self._stored(selected_version), selected_version[5], password
+
+
+    def _versionRaw(self, filename, version=0):
+        '''
+        Returns (raw, block, offset, size, dict) for one version, or for the latest version if version
+        is null, without checking the password. This is everything needed to restore the version. \n\
+        '''
+        if version > 0:
+            stored = self.c.execute(EXEC_stored_ % filename + ' where v.version=?', [version]).fetchone()
+        else:
+            stored = self.c.execute(EXEC_stored_ % filename + ' order by v.version desc limit 1').fetchone()
+        return stored and self._stored(stored)
+
+
+    def _blockData(self, block, password):
+        '''
+        Returns the original data of one solid block. The most recent blocks are kept in memory,
+        so reading many files from the same block restores it only once. \n\
+        The password must be already checked. \n\
+        '''
+        with self._cache_lock:
+            data = self._blocks.pop(block, None)
+            if data is not None:
+                self._blocks[block] = data
+                return data
+
+        raw, zdict, pack, pos, length = self.c.execute('select raw, dict, pack, pos, length from _blocks_ '\
+            'where id=?', [block]).fetchone()
+        if raw is None and pack is not None:
+            raw = self._packRead(pack, pos, length)
+        data = self._restoreb(raw, password, zdict)
+        # Big files shared by reference are not kept in memory.
+        if len(data) > BLOCK_CACHE:
+            return data
+
+        with self._cache_lock:
+            if block not in self._blocks:
+                self._blocks[block] = data
+                self._blocks_size += len(data)
+            # Drop the oldest blocks, but always keep the last one.
+            while self._blocks_size > BLOCK_CACHE and len(self._blocks) > 1:
+                self._blocks_size -= len(self._blocks.popitem(False)[1])
+        return data
+
+
+    def _restoreVersion(self, stored, password):
+        '''
+        Restores one version, returned by _versionRaw. Doesn't touch the database, unless the
+        solid block or the dictionary of the version are not in memory. \n\
+        '''
+        raw, block, offset, size, zdict = stored
+        if block is not None:
+            return self._blockData(block, password)[offset:offset+size]
+        return self._restoreb(raw, password, zdict)
+
+
+    def _versionChunks(self, stored, password):
+        '''
+        Restores one version, returned by _versionRaw, in small parts, so big files are never
+        entirely in memory. Yields the original data, one part at a time. \n\
+        '''
+        raw, block, offset, size, zdict = stored
+        if block is not None:
+            yield self._blockData(block, password)[offset:offset+size]
+            return
+        for data in _restoreChunks(raw, self._aesKey(password), zdict and self._dictionary(zdict)[1]):
+            yield data
+
 
-        self._log(1, 'Copying file "%s" into "%s" took %.4f sec.' % (fname, new_fname, clock()-ti))
-        return 0
+    def _writeFile(self, stored, password, filename):
+        '''
+        Restores one version and writes it into the file. \n\
+        Returns the number of bytes written. \n\
+        '''
+        w = open(filename, 'wb')
+        try:
+            nbytes = 0
+            for data in self._versionChunks(stored, password):
+                w.write(data)
+                nbytes += len(data)
+            return nbytes
+        finally:
+            w.close()
 
 
     def ExportFile(self, fname, password=1, version=0, path='', execute=False):
@@ -505,9 +2420,6 @@ class Briefcase:
         is executed from a temporary folder, or from the specified path, then the file is deleted. \n\
         '''
         ti = clock()
-        md4 = MD4.new(fname)
-        filename = 't'+md4.hexdigest()
-        del md4
 
         if version < 0 : version = 0
 
@@ -519,45 +2431,8 @@ class Briefcase:
             self._log(2, 'Func ExportFile: no path and no execute! The file will be generated and deleted immediately!')
             return -1
 
-        # If version is a positive number, get that version.
-        if version > 0:
-            try:
-                selected_version = self.c.execute('select raw, hash from %s where version=%s' % \
-                    (filename, version)).fetchone()
-            except:
-                self._log(2, 'Func ExportFile: cannot find version "%i" for file "%s"!' % \
-                    (version, fname))
-                return -1
-        # Else, get the latest version.
-        else:
-            try:
-                selected_version = self.c.execute('select raw, hash from %s order by version desc' % \
-                    filename).fetchone()
-            except:
-                self._log(2, 'Func ExportFile: cannot find the file called "%s"!' % fname)
-                return -1
-
-        # Get file password hash. It can be None, (Zero), or (some hash string).
-        old_pwd_hash = self.c.execute('select pwd from _files_ where file="%s"' % fname).fetchone()
-
-        if old_pwd_hash:
-            old_pwd_hash = old_pwd_hash[0]
-
-        # If password is a string or unicode, get the hash.
-        if type(password) == type('') or type(password) == type(u''):
-            pwd_hash = buffer(PBKDF2(password=password, salt='briefcase', dkLen=16, count=5000))
-        # If password is database default, do nothing.
-        elif password == 1:
-            pwd_hash = 1
-        # If password is null in some way, hash must be also null.
-        else:
-            password = None
-            pwd_hash = None
-
-        # If provided password != stored password...
-        if old_pwd_hash != pwd_hash:
-            self._log(2, 'Func ExportFile: Password for file "%s" is INCORRECT! You will not be '\
-                'able to decrypt any data!' % fname)
+        selected_version = self._fetchFile(fname, password, version)
+        if selected_version == -1:
             return -1
 
         # If the path is specified, use it
@@ -570,9 +2445,7 @@ class Briefcase:
             filename = tmpd + '/' + fname
             del tmpd
 
-        w = open(filename, 'wb')
-        w.write(self._restoreb(selected_version[0], password))
-        w.close() ; del w
+        self._writeFile(selected_version[0], selected_version[2], filename)
         self._log(1, 'Exporting file "%s" took %.4f sec.' % (fname, clock()-ti))
 
         if execute:
@@ -586,11 +2459,35 @@ class Briefcase:
         return selected_version[1]
 
 
-    def ExportAll(self, path, password=1):
+    def _exportList(self, password=1, caller='ExportAll'):
+        '''
+        Returns the files that can be exported with this password. \n\
+        The files that use another password are logged and skipped ; the log starts with the
+        name of the caller. \n\
+        '''
+        pwd_hash = self._parsePassword(password)[1]
+        all_files = self.c.execute('select pwd, file from _files_ order by file').fetchall()
+        good_files = []
+
+        # Temp_file[0] = pwd, Temp_file[1] = fname.
+        for temp_file in all_files:
+            # If provided password != stored password...
+            if temp_file[0] != pwd_hash:
+                self._log(2, 'Func %s: Password for file "%s" is INCORRECT! You will not be'\
+                    ' able to decrypt any data!' % (caller, temp_file[1]))
+                continue
+            good_files.append(temp_file[1])
+
+        return good_files
+
+
+    def ExportAll(self, path, password=1, progress=None):
         '''
         Export all files into one folder. \n\
         Only the most recent version of each file is exported. \n\
         The files that don't use the global password, will fail to export. \n\
+        Progress is an optional function called after each file, with : files done, total files,
+        bytes done. If it returns False, the rest of the files are not exported. \n\
         '''
         #
         ti = clock()
@@ -599,39 +2496,609 @@ class Briefcase:
             self._log(2, 'Func ExportAll: path "%s" doesn\'t exist!' % path)
             return -1
 
-        # If password is a string or unicode, get the hash.
-        if type(password) == type('') or type(password) == type(u''):
-            pwd_hash = buffer(PBKDF2(password=password, salt='briefcase', dkLen=16, count=5000))
-        # If password is database default, do nothing.
-        elif password == 1:
-            pwd_hash = 1
-        # If password is null in some way, hash must be also null.
+        password = self._parsePassword(password)[0]
+        all_files = self._exportList(password)
+
+        nbytes = 0
+        for i, fname in enumerate(all_files):
+            # At this point, password is correct.
+            filename = self._table(fname)
+            latest_version = self._versionRaw(filename)
+            # Now write decompressed/ decrypted data.
+            nbytes += self._writeFile(latest_version, password, path + '/' + fname)
+            self._log(2, 'Func ExportAll: File "%s" exported successfully.' % fname)
+            if progress and progress(i+1, len(all_files), nbytes) is False:
+                self._log(2, 'Func ExportAll: stopped after %i files!' % (i+1))
+                break
+
+        self._log(1, 'Exporting %i files took %.4f sec.' % (len(all_files), clock()-ti))
+        return 0
+
+
+    def _deflatedChunks(self, stored, password):
+        '''
+        For the zlib versions returned by _versionRaw, returns the (data, deflated) parts from
+        _deflateChunks, that can be copied into zip archives. Returns None for the other versions. \n\
+        '''
+        raw, block, offset, size, zdict = stored
+        if block is not None or zdict:
+            return None
+        # zlib header without preset dictionary ; bz2 data starts with "BZh".
+        header = self._decryptb(raw[:16], password)
+        if header[:1] != '\x78' or ord(header[1:2]) & 0x20:
+            return None
+        return _deflateChunks(raw, self._aesKey(password))
+
+
+    def _zipWrite(self, zf, zinfo, chunks, size, deflated=False):
+        '''
+        Writes one file into a zip archive, one part at a time. The sizes and the CRC are written
+        after the data, so the file doesn't have to be in memory. \n\
+        Chunks are the parts of the original data ; if deflated is true, they are the (data, deflated)
+        parts from _deflatedChunks, and the deflate stream is written as it is, without compressing
+        the data again. Size is the original size, used to choose the zip64 headers. \n\
+        Returns the number of bytes written. \n\
+        '''
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.flag_bits |= 0x08
+        zinfo.header_offset = zf.fp.tell()
+        zf._writecheck(zinfo)
+        zf._didModify = True
+        # Like zipfile.write, the compressed data can be a little bigger than the original.
+        zip64 = zf._allowZip64 and size * 1.05 > zipfile.ZIP64_LIMIT
+        zf.fp.write(zinfo.FileHeader(zip64))
+
+        comp = not deflated and zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        crc = usize = csize = 0
+        for data in chunks:
+            if deflated:
+                data, part = data
+            else:
+                part = comp.compress(data)
+            crc = zlib.crc32(data, crc)
+            usize += len(data)
+            csize += len(part)
+            zf.fp.write(part)
+        if comp:
+            part = comp.flush()
+            csize += len(part)
+            zf.fp.write(part)
+
+        if not zip64 and max(usize, csize) > zipfile.ZIP64_LIMIT:
+            raise zipfile.LargeZipFile('Filesize would require ZIP64 extensions')
+        zinfo.CRC = crc & 0xffffffff
+        zinfo.file_size = usize
+        zinfo.compress_size = csize
+        zf.fp.write(struct.pack(zip64 and '<LLQQ' or '<LLLL', 0x08074b50, zinfo.CRC, csize, usize))
+        zf.filelist.append(zinfo)
+        zf.NameToInfo[zinfo.filename] = zinfo
+        return usize
+
+
+    def ExportArchive(self, target, password=1, format=None, labels=None, ffilter='', folders=True,
+            progress=None):
+        '''
+        Export the latest version of the files into one tar or zip archive, without writing them on disk. \n\
+        Target is a path, or any writable file object, like sys.stdout. Format is "zip", "tar", "tar.gz"
+        or "tar.bz2" ; for paths, the default is guessed from the extension, else it's "zip". \n\
+        If labels are specified, only the files having all the labels are exported. If ffilter is
+        specified, only the files matching the filter, like in GetFileList. \n\
+        If folders is true, "~" from the file names becomes "/", like the names from SyncIn and AddArchive. \n\
+        The zlib versions are copied into zip archives, without compressing them again. \n\
+        Progress is an optional function called after each file, with : files done, total files,
+        bytes done. If it returns False, the rest of the files are not exported. \n\
+        '''
+        ti = clock()
+        if not format:
+            name = isinstance(target, basestring) and target.lower() or ''
+            for ext, fmt in [('.tar', 'tar'), ('.tar.gz', 'tar.gz'), ('.tgz', 'tar.gz'), ('.tar.bz2', 'tar.bz2'),
+                    ('.tbz2', 'tar.bz2')]:
+                if name.endswith(ext):
+                    format = fmt
+            format = format or 'zip'
+        if format not in ['zip', 'tar', 'tar.gz', 'tar.bz2']:
+            self._log(2, 'Func ExportArchive: format "%s" is incorrect!' % format)
+            return -1
+
+        password = self._parsePassword(password)[0]
+        all_files = self._exportList(password, 'ExportArchive')
+        if labels:
+            selected = self.GetFilesByLabels(labels)
+            if selected == -1:
+                return -1
+            all_files = [f for f in all_files if f in set(selected)]
+        if ffilter:
+            selected = self.GetFileList(ffilter=ffilter)
+            if selected == -1:
+                return -1
+            all_files = [f for f in all_files if f in set(selected)]
+        dates = dict(self.c.execute('select file, date from _statistics_').fetchall())
+
+        fp = isinstance(target, basestring) and open(target, 'wb') or target
+        if format == 'zip':
+            archive = zipfile.ZipFile(_Counter(fp), 'w', zipfile.ZIP_DEFLATED, True)
         else:
-            password = None
-            pwd_hash = None
+            # Stream mode, so the target doesn't have to seek.
+            archive = tarfile.open(fileobj=fp, mode='w|' + format[4:])
 
-        all_files = self.c.execute('select pwd, file from _files_ order by file').fetchall()
+        nbytes = 0
+        passed = 0
+        try:
+            for i, fname in enumerate(all_files):
+                stored = self._versionRaw(self._table(fname))
+                name = fname
+                if folders and '' not in fname.split('~'):
+                    name = fname.replace('~', '/')
+                date = strptime(dates.get(fname) or strftime(DATE_FORMAT), DATE_FORMAT)
+
+                # The files are restored and written one part at a time, never entirely in memory.
+                if format == 'zip':
+                    deflated = self._deflatedChunks(stored, password)
+                    zinfo = zipfile.ZipInfo(name, max(date[:6], (1980, 1, 1, 0, 0, 0)))
+                    zinfo.external_attr = 0600 << 16
+                    nbytes += self._zipWrite(archive, zinfo, deflated or self._versionChunks(stored, password),
+                        stored[3], deflated is not None)
+                    passed += deflated is not None
+                else:
+                    tinfo = tarfile.TarInfo(name)
+                    tinfo.size = stored[3]
+                    tinfo.mtime = mktime(date)
+                    tinfo.mode = 0600
+                    archive.addfile(tinfo, _Reader(self._versionChunks(stored, password)))
+                    nbytes += tinfo.size
+
+                if progress and progress(i+1, len(all_files), nbytes) is False:
+                    self._log(2, 'Func ExportArchive: stopped after %i files!' % (i+1))
+                    break
+        finally:
+            archive.close()
+            if fp is not target:
+                fp.close()
+            else:
+                fp.flush()
 
-        # Temp_file[0] = pwd, Temp_file[1] = fname.
-        for temp_file in all_files:
-            # If provided password != stored password...
-            if temp_file[0] != pwd_hash:
-                self._log(2, 'Func ExportAll: Password for file "%s" is INCORRECT! You will not be'\
-                    ' able to decrypt any data!' % temp_file[1])
+        self._log(1, 'Exporting %i files into %s archive, %i without compressing again, took %.4f sec.' % \
+            (len(all_files), format, passed, clock()-ti))
+        return 0
+
+
+    def SyncOut(self, path, password=1, delete=False, progress=None):
+        '''
+        Mirror the briefcase into one folder. Only the files that are new, or changed since the
+        last sync into the same folder, are exported. \n\
+        The exported version and hash of each file are kept in _exported_ table, except for readonly
+        briefcases. Changes are found using the stored hashes, so the unchanged files are never decrypted. \n\
+        If an exported file was deleted, or its size changed in the folder, it's exported again. \n\
+        If delete is true, the files that were deleted from the briefcase are also deleted from the
+        folder ; only the files exported by SyncOut are deleted. \n\
+        Progress is an optional function called after each exported file, with : files done,
+        files to export, bytes done. If it returns False, the rest of the files are not exported. \n\
+        '''
+        ti = clock()
+        if not os.path.isdir(path):
+            self._log(2, 'Func SyncOut: path "%s" doesn\'t exist!' % path)
+            return -1
+
+        root = os.path.abspath(path)
+        password = self._parsePassword(password)[0]
+        all_files = self._exportList(password, 'SyncOut')
+        exported = dict([(vElem[0], vElem[1:]) for vElem in self.c.execute('select file, hash, size '\
+            'from _exported_ where path=?', [root])])
+
+        # Compare the latest hash of each file, with the exported hash.
+        changed = []
+        for fname in all_files:
+            filename = self._table(fname)
+            version, hash = self.c.execute('select version, hash from %s order by version desc' % \
+                filename).fetchone()
+            old = exported.get(fname)
+            target = os.path.join(root, fname)
+            if old and old[0] == hash and os.path.isfile(target) and os.path.getsize(target) == old[1]:
                 continue
+            changed.append((fname, filename, version, hash))
+
+        nbytes = 0
+        stopped = False
+        for i, (fname, filename, version, hash) in enumerate(changed):
+            size = self._writeFile(self._versionRaw(filename, version), password, os.path.join(root, fname))
+            # A readonly briefcase cannot remember the exported files ; the next sync compares them again.
+            if not self.readonly:
+                self.c.execute('insert or replace into _exported_ (path, file, version, hash, size) '\
+                    'values (?,?,?,?,?)', [root, fname, version, hash, size])
+            nbytes += size
+            if progress and progress(i+1, len(changed), nbytes) is False:
+                self._log(2, 'Func SyncOut: stopped after %i files!' % (i+1))
+                stopped = True
+                break
+
+        removed = 0
+        if delete and not stopped:
+            existing = set([vElem[0] for vElem in self.c.execute('select file from _files_')])
+            for fname in set(exported) - existing:
+                target = os.path.join(root, fname)
+                if os.path.isfile(target):
+                    os.remove(target)
+                if not self.readonly:
+                    self.c.execute('delete from _exported_ where path=? and file=?', [root, fname])
+                removed += 1
+
+        self._commit()
+        self._log(1, 'Sync out into "%s" : %i exported, %i unchanged, %i deleted, took %.4f sec.' % \
+            (root, i+1 if changed else 0, len(all_files)-len(changed), removed, clock()-ti))
+        return 0
 
-            # At this point, password is correct.
-            fname = path + '/' + temp_file[1]
-            w = open(fname, 'wb')
-            md4 = MD4.new(temp_file[1])
-            filename = 't'+md4.hexdigest()
-            latest_version = self.c.execute('select raw from %s order by version desc' % filename).fetchone()
-            # Now write decompressed/ decrypted data.
-            w.write(self._restoreb(latest_version[0], password))
-            w.close()
-            self._log(2, 'Func ExportAll: File "%s" exported successfully.' % temp_file[1])
 
-        self._log(1, 'Exporting %i files took %.4f sec.' % (len(all_files), clock()-ti))
+    def Verify(self, password=1, sample=0, days=0, workers=None, progress=None):
+        '''
+        Checks that the versions of all files still restore to the stored hash, and runs the
+        SQLite integrity check. Only the files using this password can be checked. \n\
+        The versions are checked by "workers" processes, default is the number of CPUs.
+        With workers=1, everything runs in this process. \n\
+        Sample is a number between 0 and 1 : only that fraction of versions is checked, at random. \n\
+        If days is specified, the versions checked without errors in the last days are skipped. \n\
+        The result of each version is stored in _verified_ table, after each file ; not for readonly
+        briefcases. \n\
+        Returns a report : {"integrity", "volumes", "checked", "skipped", "bad":[(file, version, error)]}.
+        Integrity is "ok", or the list of SQLite errors. Volumes is "ok", or the list of packfiles
+        that are missing, or shorter than the blocks stored in them, from all volumes. \n\
+        Progress is an optional function called after each file, with : versions done,
+        versions to check, bytes done. If it returns False, the rest of the files are not checked. \n\
+        If sample is not between 0 and 1, it returns -1. \n\
+        '''
+        ti = clock()
+        if type(sample) not in [type(0), type(0L), type(0.0)] or not 0 <= sample <= 1:
+            self._log(2, 'Func Verify: sample must be a number between 0 and 1! You provided "%s".' % (sample,))
+            return -1
+
+        integrity = [vElem[0] for vElem in self.c.execute('pragma integrity_check')]
+        report = {'integrity': integrity == ['ok'] and 'ok' or integrity, 'checked':0, 'skipped':0, 'bad':[]}
+
+        # Every packfile used by the blocks must exist in one volume, and must be long enough.
+        packs = _packFiles(self.database, self.volumes, self.uuid)
+        volumes = []
+        for pack, end in self.c.execute('select pack, max(pos + length) from _blocks_ where pack is not null '\
+            'group by pack').fetchall():
+            if pack not in packs:
+                volumes.append('packfile %i is missing' % pack)
+            elif os.path.getsize(packs[pack]) < end:
+                volumes.append('packfile "%s" is truncated' % packs[pack])
+        report['volumes'] = volumes or 'ok'
+
+        password, pwd_hash = self._parsePassword(password)
+        if password == 1:
+            key = self.glob_key or None
+        elif password:
+            key = self._pwdKey(password)
+        else:
+            key = None
+
+        recent = set()
+        if days:
+            cutoff = strftime(DATE_FORMAT, localtime(time() - days * 86400))
+            recent = set(self.c.execute('select file, version from _verified_ where error is null '\
+                'and date >= ?', [cutoff]).fetchall())
+
+        candidates = []
+        for fname, pwd in self.c.execute('select file, pwd from _files_ order by file').fetchall():
+            filename = self._table(fname)
+            versions = self.c.execute('select version, hash, size from %s' % filename).fetchall()
+            if pwd != pwd_hash:
+                report['skipped'] += len(versions)
+                continue
+            candidates.extend([(fname, filename) + v for v in versions if (fname, v[0]) not in recent])
+            report['skipped'] += len(versions)
+        if sample:
+            candidates = random.sample(candidates, int(round(len(candidates) * sample)))
+            candidates.sort()
+        total = len(candidates)
+        report['skipped'] -= total
+
+        # One task for each file, with all its versions.
+        tasks = []
+        sizes = {}
+        for fname, filename, version, hash, size in candidates:
+            if not tasks or tasks[-1][0] != fname:
+                tasks.append((fname, filename, []))
+                sizes[fname] = 0
+            tasks[-1][2].append((version, hash))
+            sizes[fname] += size
+        # The worker processes must see everything.
+        self._commit()
+
+        if workers is None:
+            try:
+                import multiprocessing
+                workers = multiprocessing.cpu_count()
+            except (ImportError, NotImplementedError):
+                workers = 1
+        if workers > 1 and len(tasks) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(workers, _verifyInit, (self.database, key, self.glob_key or None,
+                self.hash_name, packs))
+            results = pool.imap_unordered(_verifyFile, tasks)
+        else:
+            pool = None
+            _verifyInit(self.database, key, self.glob_key or None, self.hash_name, packs)
+            results = (_verifyFile(task) for task in tasks)
+
+        nbytes = 0
+        try:
+            for result in results:
+                now = strftime(DATE_FORMAT)
+                if not self.readonly:
+                    self.c.executemany('insert or replace into _verified_ (file, version, date, error) '\
+                        'values (?,?,?,?)', [(r[0], r[1], now, r[2]) for r in result])
+                    self._commit()
+                report['checked'] += len(result)
+                report['bad'].extend([r for r in result if r[2]])
+                nbytes += sizes[result[0][0]]
+                if progress and progress(report['checked'], total, nbytes) is False:
+                    self._log(2, 'Func Verify: stopped after %i versions!' % report['checked'])
+                    break
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        for fname, version, error in report['bad']:
+            self._log(2, 'Func Verify: file "%s" version "%i" is corrupted! %s' % (fname, version, error))
+        if report['integrity'] != 'ok':
+            self._log(2, 'Func Verify: the integrity check failed! %s' % '; '.join(integrity))
+        if report['volumes'] != 'ok':
+            self._log(2, 'Func Verify: the volumes check failed! %s' % '; '.join(volumes))
+        self._log(1, 'Verify : %i versions checked, %i bad, %i skipped, took %.4f sec.' % (report['checked'],
+            len(report['bad']), report['skipped'], clock()-ti))
+        self._commit()
+        return report
+
+
+    def _copyPages(self, source, target, pages=100, delay=0.01, progress=None):
+        '''
+        Copies the database file source into target, a few pages at a time, like the SQLite backup API. \n\
+        Each step runs in a read transaction on source, so the pages are consistent, and other
+        connections can write between the steps. If source was changed by a write, the copy starts again. \n\
+        In WAL mode, the new pages are in the WAL file : before copying, they are moved into the database
+        file with a checkpoint, and the writes are found with "pragma data_version". \n\
+        Returns 0, or -1 on error, or if it was stopped by progress. \n\
+        '''
+        conn = sqlite3.connect(source, timeout=self.timeout)
+        conn.isolation_level = None
+        wal = conn.execute('pragma journal_mode').fetchone()[0] == 'wal'
+        src = open(source, 'rb')
+        dst = open(target, 'wb')
+        counter = None
+        page = 0
+        try:
+            while True:
+                if wal and counter is None:
+                    # A write after this is found by data_version, so the checkpoint cannot miss it.
+                    counter = conn.execute('pragma data_version').fetchone()[0]
+                    busy, log, done = conn.execute('pragma wal_checkpoint(PASSIVE)').fetchone()
+                    if busy or log != done:
+                        # The pages used by other readers are not moved yet.
+                        counter = None
+                        sleep(delay)
+                        continue
+                # The read transaction keeps the writers away, or the checkpoints in WAL mode,
+                # until this step is done.
+                conn.execute('begin')
+                conn.execute('select count(*) from sqlite_master').fetchone()
+                page_size = conn.execute('pragma page_size').fetchone()[0]
+                page_count = conn.execute('pragma page_count').fetchone()[0]
+                if wal:
+                    changed = conn.execute('pragma data_version').fetchone()[0]
+                else:
+                    # The file change counter, from the database header.
+                    src.seek(24)
+                    changed = src.read(4)
+                if changed != counter:
+                    if counter is not None:
+                        self._log(1, 'Func Backup: "%s" was changed, restarting the copy.' % source, False)
+                    page = 0
+                    dst.seek(0)
+                    dst.truncate()
+                    if wal:
+                        # Checkpoint again, before the next step.
+                        counter = None
+                        conn.execute('commit')
+                        continue
+                    counter = changed
+                step = min(pages, page_count - page)
+                src.seek(page * page_size)
+                dst.write(src.read(step * page_size))
+                page += step
+                conn.execute('commit')
+
+                if progress and progress(page, page_count, page * page_size) is False:
+                    self._log(2, 'Func Backup: stopped after %i pages!' % page)
+                    return -1
+                if page >= page_count:
+                    return 0
+                sleep(delay)
+        finally:
+            dst.close()
+            src.close()
+            conn.close()
+
+
+    def _checkBackup(self, path):
+        '''
+        Checks that path is a valid copy of this briefcase : SQLite integrity check, the same password
+        and the same salt. Returns 0 or -1. \n\
+        '''
+        try:
+            conn = sqlite3.connect(path)
+            try:
+                integrity = [vElem[0] for vElem in conn.execute('pragma integrity_check')]
+                info = conn.execute('select pwd, salt from _info_').fetchone()
+                schema = conn.execute('pragma user_version').fetchone()[0]
+            finally:
+                conn.close()
+        except sqlite3.Error, e:
+            self._log(2, 'Func Backup: "%s" is not a briefcase file! %s' % (path, e))
+            return -1
+
+        if integrity != ['ok']:
+            self._log(2, 'Func Backup: the integrity check of "%s" failed! %s' % (path, '; '.join(integrity)))
+            return -1
+        if info != self.c.execute('select pwd, salt from _info_').fetchone():
+            self._log(2, 'Func Backup: "%s" is not a copy of this briefcase!' % path)
+            return -1
+        if schema != SCHEMA_VERSION:
+            self._log(2, 'Func Backup: "%s" has another schema version ; open it once to upgrade it!' % path)
+            return -1
+        return 0
+
+
+    def _backupFiles(self, target, progress=None):
+        '''
+        Copies the new versions into target, an older backup of this briefcase, and deletes the versions
+        and the files that were deleted. The raw data is copied, without decrypting. \n\
+        '''
+        if self._checkBackup(target):
+            return -1
+        self._commit()
+        self.c.execute('attach database ? as backup', [target])
+        try:
+            tables = set([v[0] for v in self.c.execute('select name from main.sqlite_master where '\
+                'type="table" and name like "t%"')])
+            old_tables = set([v[0] for v in self.c.execute('select name from backup.sqlite_master where '\
+                'type="table" and name like "t%"')])
+            for filename in tables - old_tables:
+                self.c.execute(EXEC_versions_ % ('backup.' + filename))
+                self.c.execute(EXEC_versions_index_ % ('backup.' + filename, filename))
+
+            # Everything is copied in one transaction ; the new blocks before the versions using them.
+            self.c.execute('insert into backup._blocks_ select * from main._blocks_ where id not in '\
+                '(select id from backup._blocks_)')
+            self.c.execute('insert into backup._dicts_ select * from main._dicts_ where id not in '\
+                '(select id from backup._dicts_)')
+            copied = 0
+            for i, filename in enumerate(sorted(tables)):
+                copied += self.c.execute('insert into backup.%s select * from main.%s where version not in '\
+                    '(select version from backup.%s)' % (filename, filename, filename)).rowcount
+                self.c.execute('delete from backup.%s where version not in (select version from main.%s)' % \
+                    (filename, filename))
+                if progress and progress(i+1, len(tables), 0) is False:
+                    self._log(2, 'Func Backup: stopped after %i files!' % (i+1))
+                    self.conn.rollback()
+                    return -1
+            for table in ['_files_', '_statistics_', '_labels_', '_file_labels_', '_retention_', '_hashes_']:
+                self.c.execute('delete from backup.%s' % table)
+                self.c.execute('insert into backup.%s select * from main.%s' % (table, table))
+            self.c.execute('delete from backup._blocks_ where id not in (select id from main._blocks_)')
+            self.c.execute('update backup._blocks_ set refs = (select m.refs from main._blocks_ m where '\
+                'm.id = backup._blocks_.id)')
+            self._commit()
+
+            for filename in old_tables - tables:
+                self.c.execute('drop table backup.%s' % filename)
+            self.c.execute('pragma backup.user_version = %i' % SCHEMA_VERSION)
+        finally:
+            self._commit()
+            self.c.execute('detach database backup')
+
+        self._log(1, 'Func Backup: %i versions copied, %i files deleted.' % (copied, len(old_tables - tables)))
+        return 0
+
+
+    def Backup(self, target, pages=100, delay=0.01, incremental=False, progress=None):
+        '''
+        Copy this briefcase into target, while it's used by other connections. \n\
+        The file is copied "pages" pages at a time, with "delay" seconds between the steps, so other
+        programs using the briefcase can continue to work. This works for rollback journal and WAL
+        files ; in WAL mode, the WAL file is checkpointed before copying. If the briefcase is changed
+        by a write, the copy starts again. The copy is checked before replacing target. \n\
+        If incremental is true and target exists, target must be an older backup of this briefcase.
+        Only the new versions are copied into it, and the deleted versions and files are deleted. \n\
+        Progress is an optional function called after each step, with : pages done, total pages,
+        bytes done ; or with : files done, total files, 0 for incremental backups.
+        If it returns False, the backup is stopped and target is not changed. \n\
+        The packfiles are copied after the database, from all volumes in parallel, next to target ;
+        only their new bytes are copied. The backup doesn't use the volumes of this briefcase. \n\
+        '''
+        ti = clock()
+        self._commit()
+
+        if incremental and os.path.exists(target):
+            ret = self._backupFiles(target, progress)
+        else:
+            temp = target + '.tmp'
+            ret = self._copyPages(self.database, temp, pages, delay, progress) or self._checkBackup(temp)
+            if ret:
+                os.remove(temp)
+            else:
+                # A new backup gets its own uuid ; an old one keeps it, so only the new bytes of its packfiles are copied.
+                self._clearVolumes(temp, os.path.exists(target) and _briefcaseUuid(target) or uuid4().hex)
+                if os.path.exists(target):
+                    os.remove(target)
+                os.rename(temp, target)
+        if not ret:
+            _copyPacks(self.database, target, self.volumes)
+
+        if not ret:
+            self._log(1, 'Backup into "%s" took %.4f sec.' % (target, clock()-ti))
+        return ret
+
+
+    def _clearVolumes(self, path, uuid):
+        '''
+        Deletes the volume folders from a copy of this briefcase, and sets its uuid, so it uses its
+        own packfiles. \n\
+        '''
+        conn = sqlite3.connect(path)
+        try:
+            conn.execute('delete from _volumes_')
+            conn.execute('update _info_ set uuid = ?', [uuid])
+            conn.commit()
+        finally:
+            conn.close()
+
+
+    def Restore(self, source, pages=100, delay=0.01, progress=None):
+        '''
+        Replace this briefcase with source, a backup created by Backup, with its packfiles. \n\
+        The packfiles are restored in the volumes of this briefcase, where they were ; the new ones
+        are restored next to this briefcase. \n\
+        The backup is checked before and after copying : integrity check, password and salt.
+        If anything is wrong, this briefcase is not changed. \n\
+        Progress is the same as for Backup. \n\
+        '''
+        ti = clock()
+        if not os.path.exists(source) or self._checkBackup(source):
+            self._log(2, 'Func Restore: "%s" cannot be restored!' % source)
+            return -1
+
+        temp = self.database + '.tmp'
+        if self._copyPages(source, temp, pages, delay, progress) or self._checkBackup(temp):
+            os.remove(temp)
+            return -1
+        # The packfiles are restored with the uuid of this briefcase.
+        self._clearVolumes(temp, self.uuid)
+
+        self._closeAll()
+        self._packClose()
+        with self._cache_lock:
+            self._maps.clear()
+        _copyPacks(source, self.database)
+        volumes = self.volumes
+        # The WAL file of the old database must not be applied to the new one.
+        for path in [self.database, self.database + '-wal', self.database + '-shm']:
+            if os.path.exists(path):
+                os.remove(path)
+        os.rename(temp, self.database)
+        with self._cache_lock:
+            self._blocks.clear()
+            self._blocks_size = 0
+            self._dicts.clear()
+        self._connect()
+        self._upgrade()
+        self._dict_id = self.c.execute('select max(id) from _dicts_').fetchone()[0]
+        self.c.executemany('insert or ignore into _volumes_ (path) values (?)', [(v,) for v in volumes])
+        self._commit()
+        self._loadVolumes()
+        self._log(1, 'Restore from "%s" took %.4f sec.' % (source, clock()-ti))
+        self._commit()
         return 0
 
 
@@ -651,7 +3118,7 @@ class Briefcase:
         #
 
         #
-        self._log(1, 'Joining databases took %.4f sec.' % clock()-ti)
+        self._log(1, 'Joining databases took %.4f sec.' % (clock()-ti))
         return 0
 
 
@@ -665,12 +3132,8 @@ class Briefcase:
                 ' \\ / : * ? " < > |')
             return -1
 
-        md4 = MD4.new(fname)
-        filename = 't'+md4.hexdigest()
-        del md4
-        md4 = MD4.new(new_fname)
-        new_filename = 't'+md4.hexdigest()
-        del md4
+        filename = self._table(fname)
+        new_filename = self._table(new_fname)
 
         # Check file existence.
         if self.c.execute('select file from _files_ where file = ?', [new_fname]).fetchone():
@@ -679,12 +3142,18 @@ class Briefcase:
 
         try:
             self.c.execute('alter table %s rename to %s' % (filename, new_filename))
+            # The index keeps its old name, that would block a new file with the old name.
+            self.c.execute('drop index if exists %s_date_' % filename)
+            self.c.execute(EXEC_versions_index_ % (new_filename, new_filename))
             self.c.execute('update _files_ set file = ? where file = ?', [new_fname, fname])
             self.c.execute('update _statistics_ set file = ? where file = ?', [new_fname, fname])
-            self.conn.commit()
+            self.c.execute('update _file_labels_ set file = ? where file = ?', [new_fname, fname])
+            self.c.execute('update _hashes_ set file = ? where file = ?', [new_fname, fname])
+            self._commit()
             self._log(1, 'Renaming from "%s" into "%s" took %.4f sec.' % (fname, new_fname, clock()-ti))
             return 0
         except:
+            self.conn.rollback()
             self._log(2, 'Func RenFile: cannot find the file called "%s"!' % fname)
             return -1
 
@@ -696,25 +3165,31 @@ class Briefcase:
         This cannot be undone, so be careful. \n\
         '''
         ti = clock()
-        md4 = MD4.new(fname)
-        filename = 't'+md4.hexdigest()
-        del md4
+        filename = self._table(fname)
 
         if version > 0:
+            blocks = [vElem[0] for vElem in self.c.execute('select block from %s where version=?' % \
+                filename, [version])]
             self.c.execute('delete from %s where version=%s' % (filename, version))
-            self.c.execute('reindex %s' % filename)
-            self.conn.commit()
+            self.c.execute('delete from _hashes_ where file=? and version=?', [fname, version])
+            self._refBlocks(blocks, -1)
+            self._commit()
             self._log(1, 'Deleting file "%s" version "%i" took %.4f sec.' % (fname, version, clock()-ti))
             return 0
         else:
             try:
+                blocks = [vElem[0] for vElem in self.c.execute('select block from %s' % filename)]
                 self.c.execute('drop table %s' % filename)
+                self._refBlocks(blocks, -1)
                 self.c.execute('delete from _files_ where file="%s"' % fname)
-                self.c.execute('delete from _statistics_ where file="%s"' % fname)
-                self.conn.commit()
+                self.c.execute('delete from _statistics_ where file=?', [fname])
+                self.c.execute('delete from _file_labels_ where file=?', [fname])
+                self.c.execute('delete from _hashes_ where file=?', [fname])
+                self._commit()
                 self._log(1, 'Deleting file "%s" took %.4f sec.' % (fname, clock()-ti))
                 return 0
             except:
+                self.conn.rollback()
                 self._log(2, 'Func DelFile: cannot find the file called "%s"!' % fname)
                 return -1
 
@@ -729,9 +3204,7 @@ class Briefcase:
         On error, it returns an empty dictionary. \n\
         '''
         ti = clock()
-        md4 = MD4.new(fname)
-        filename = 't'+md4.hexdigest()
-        del md4
+        filename = self._table(fname)
 
         # Check file existence.
         if not self.c.execute('select file from _files_ where file = ?', [fname]).fetchone():
@@ -759,10 +3232,17 @@ class Briefcase:
             fname).fetchone()[0]
         versions = len( self.c.execute('select version from %s' % filename).fetchall() )
 
-        self.c.execute('insert or replace into _statistics_ (file, size0, size, sizeB, '
-            'date0, date, user0, user, labels) values (?,?,?,?,?,?,?,?,?)', [fname,
-            firstFileSize, lastFileSize, biggestSize, firstFileDate, lastFileDate,
-            firstFileUser, lastFileUser, labels])
+        stats = (fname, firstFileSize, lastFileSize, biggestSize, firstFileDate, lastFileDate,
+            firstFileUser, lastFileUser, labels)
+        # Only the changed statistics are written. If they are not part of a bigger change,
+        # they are committed here, so reading the statistics never keeps the write lock.
+        if not self.readonly and self.c.execute('select file, size0, size, sizeB, date0, date, user0, user, '\
+                'labels from _statistics_ where file=?', [fname]).fetchone() != stats:
+            alone = not self.conn.pending
+            self.c.execute('insert or replace into _statistics_ (file, size0, size, sizeB, '
+                'date0, date, user0, user, labels) values (?,?,?,?,?,?,?,?,?)', stats)
+            if alone:
+                self._commit()
 
         if not silent:
             self._log(1, 'Get properties for file "%s" took %.4f sec.' % (fname, clock()-ti))
@@ -773,64 +3253,493 @@ class Briefcase:
             'labels':labels, 'versions':versions}
 
 
-    def GetFileList(self, ssort='', ffilter=''):
+    def _compileFilter(self, expr, params):
+        '''
+        Compiles a structured filter into an SQL expression on _statistics_. The values are
+        appended into params, they are never written into the SQL. \n\
+        A filter is a tuple (field, operator, value), ("and", filter, ...), ("or", filter, ...),
+        ("not", filter), or a list of filters, that must all match. \n\
+        Raises ValueError if the filter is incorrect. \n\
+        '''
+        if type(expr) == type([0,0]):
+            expr = ['and'] + expr
+        if type(expr) not in [type([0,0]), type((0,0))] or not expr:
+            raise ValueError('filter %r is incorrect' % (expr,))
+
+        head = expr[0]
+        if head in ['and', 'or']:
+            if len(expr) < 2:
+                raise ValueError('"%s" without filters' % head)
+            return '(' + (' %s ' % head).join([self._compileFilter(e, params) for e in expr[1:]]) + ')'
+        elif head == 'not':
+            if len(expr) != 2:
+                raise ValueError('"not" needs exactly one filter')
+            return '(not %s)' % self._compileFilter(expr[1], params)
+
+        if len(expr) != 3 or str(head).lower() not in QUERY_FIELDS or str(expr[1]).lower() not in QUERY_OPERATORS:
+            raise ValueError('filter %r is incorrect' % (expr,))
+        field = QUERY_FIELDS[head.lower()]
+        op = expr[1].lower()
+        value = expr[2]
+        if op == 'in' and (type(value) == type('') or type(value) == type(u'')):
+            if field != 'labels':
+                raise ValueError('operator "in" needs a list of values')
+            value = value.split(';')
+
+        if field == 'labels' and op in ['has', 'in']:
+            # Labels are searched in _file_labels_ index, not in the joined string.
+            if op == 'has':
+                value = [value]
+            params.extend(value)
+            return 'exists (select 1 from _file_labels_ f join _labels_ l on l.id = f.label where '\
+                'f.file = _statistics_.file and l.label in (%s))' % ','.join('?' * len(value))
+        elif op == 'has':
+            raise ValueError('operator "has" works only with labels')
+        elif op == 'in':
+            if not value:
+                raise ValueError('operator "in" needs at least one value')
+            params.extend(value)
+            return '%s in (%s)' % (field, ','.join('?' * len(value)))
+        elif op == 'between':
+            params.extend(value[:2])
+            return '%s between ? and ?' % field
+        else:
+            params.append(value)
+            return '%s %s ?' % (field, op)
+
+
+    def _compileSort(self, ssort):
+        '''
+        Returns a list of (column, "asc"/"desc") from a sort expression like "date desc",
+        or a list of sort expressions. The file name is always the last key, so the order is unique. \n\
+        Raises ValueError if the sort is incorrect. \n\
+        '''
+        if not ssort:
+            ssort = []
+        elif type(ssort) == type('') or type(ssort) == type(u''):
+            ssort = [ssort]
+        keys = []
+        for key in ssort:
+            words = key.lower().split()
+            if len(words) == 1:
+                words.append('asc')
+            if len(words) != 2 or words[0] not in QUERY_FIELDS or words[0] == 'labels' or \
+                words[1] not in ['asc', 'desc']:
+                raise ValueError('sort "%s" is incorrect' % key)
+            keys.append((QUERY_FIELDS[words[0]], words[1]))
+        if not keys:
+            keys.append(('file', 'asc'))
+        elif 'file' not in [k[0] for k in keys]:
+            keys.append(('file', keys[-1][1]))
+        return keys
+
+
+    def GetFileList(self, ssort='', ffilter='', limit=0, offset=0, after=None):
         '''
         Returns a list with all the files from current Briefcase file. \n\
-        Can sort/ filter after file name, size, date added. \n\
-        Labels and user name can only be used as ffilter. \n\
+        Can sort/ filter after file name, size, date added, user and labels. \n\
+        Ssort is a sort expression like "date desc", or a list of them. \n\
+        Ffilter is a structured filter, for example : \n\
+        ("and", ("size", ">", 1024), ("or", ("labels", "has", "work"), ("user", "=", "cristi"))). \n\
+        Operators are : =, !=, <, <=, >, >=, like, glob, in, between, has (only for labels). \n\
+        For old scripts, ffilter can still be an SQL expression string. \n\
+        Limit and offset return only one page. After is the last file of the previous page ;
+        the next page starts right after it, using the indexes, so it's faster than offset. \n\
         On error, it returns -1. \n\
         '''
         ti = clock()
 
-        if (not ssort) and (not ffilter):
+        if (not ssort) and (not ffilter) and (not limit) and (not after):
             vList = self.c.execute('select file from _files_ order by file asc').fetchall()
             self._log(1, 'Get file list took %.4f sec.' % (clock()-ti))
             return [vElem[0] for vElem in vList]
 
-        # Validate sort expression.
-        if ssort and ssort.lower() not in ['file asc', 'file desc', 'size0 asc', 'size0 desc',
-            'size asc', 'size desc', 'sizeb asc', 'sizeb desc',
-            'date0 asc', 'date0 desc', 'date asc', 'date desc']:
-            self._log(2, 'Func GetFileList: sort "%s" is incorrect!' % ssort)
-            return -1
-        # Validate filter expression.
-        if ffilter and not re.match('(file|labels|size0|size|sizeb|date0|date|user0|user)[ ]*',
-            ffilter.lower()):
-            self._log(2, 'Func GetFileList: filter "%s" is incorrect!' % ffilter)
+        params = []
+        where = []
+        try:
+            keys = self._compileSort(ssort)
+            if type(ffilter) == type('') or type(ffilter) == type(u''):
+                # Validate the old filter expression.
+                if ffilter and not re.match('(file|labels|size0|size|sizeb|date0|date|user0|user)[ ]*',
+                    ffilter.lower()):
+                    raise ValueError('filter "%s" is incorrect' % ffilter)
+                if ffilter:
+                    where.append('(%s)' % ffilter)
+            elif ffilter:
+                where.append(self._compileFilter(ffilter, params))
+        except (ValueError, TypeError, AttributeError), e:
+            self._log(2, 'Func GetFileList: %s!' % e)
             return -1
 
-        if ssort:
-            ssort = 'order by ' + ssort
-        if ffilter:
-            ffilter = 'where ' + ffilter
+        if after is not None:
+            # Keyset pagination : the rows that come after the last row of the previous page.
+            anchor = self.c.execute('select %s from _statistics_ where file = ?' %
+                ', '.join([k[0] for k in keys]), [after]).fetchone()
+            if not anchor:
+                self._log(2, 'Func GetFileList: there is no such file called "%s"!' % after)
+                return -1
+            ors = []
+            for i in range(len(keys)):
+                ands = ['%s = ?' % k[0] for k in keys[:i]]
+                ands.append('%s %s ?' % (keys[i][0], keys[i][1] == 'asc' and '>' or '<'))
+                ors.append('(%s)' % ' and '.join(ands))
+                params.extend(anchor[:i+1])
+            where.append('(%s)' % ' or '.join(ors))
+
+        sql = 'select file from _statistics_'
+        if where:
+            sql += ' where ' + ' and '.join(where)
+        sql += ' order by ' + ', '.join(['%s %s' % k for k in keys])
+        if limit or offset:
+            sql += ' limit ? offset ?'
+            params.extend([limit or -1, offset])
 
         try:
-            vList = self.c.execute('select file from _statistics_ %s %s' % (ffilter, ssort)).fetchall()
-        except:
-            self._log(2, 'Func GetFileList: sql expression "%s %s" incorrect in context!' % (ffilter, ssort))
+            vList = self.c.execute(sql, params).fetchall()
+        except sqlite3.Error, e:
+            self._log(2, 'Func GetFileList: sql expression "%s" incorrect in context! %s' % (sql, e))
             return -1
 
         self._log(1, 'Get file list took %.4f sec.' % (clock()-ti))
         return [vElem[0] for vElem in vList]
 
 
+    def GetFileDetails(self, fnames=None):
+        '''
+        Returns a list of (file, size, date, labels) for all the files from current Briefcase file,
+        or only for the files in fnames. The size and date are from the latest version. \n\
+        All the information comes from _statistics_ table, in one query. \n\
+        '''
+        ti = clock()
+
+        if fnames is None:
+            # Files without statistics, from older briefcase files.
+            missing = self.c.execute('select file from _files_ where file not in '\
+                '(select file from _statistics_)').fetchall()
+            for fname in missing:
+                self.FileStatistics(fname[0])
+            if missing:
+                self._commit()
+            vList = self.c.execute('select file, size, date, labels from _statistics_').fetchall()
+        else:
+            vList = []
+            fnames = list(fnames)
+            # SQLite cannot have more than 999 variables in one query.
+            for i in range(0, len(fnames), 500):
+                chunk = fnames[i:i+500]
+                vList.extend(self.c.execute('select file, size, date, labels from _statistics_ '\
+                    'where file in (%s)' % ','.join('?' * len(chunk)), chunk).fetchall())
+
+        self._log(1, 'Get file details took %.4f sec.' % (clock()-ti))
+        return vList
+
+
+    def _dateArg(self, date):
+        '''
+        Dates can be : seconds since epoch, or strings like "2012-03-05 10:20:30". \n\
+        '''
+        if type(date) in [type(0), type(0L), type(0.0)]:
+            return strftime(DATE_FORMAT, localtime(date))
+        return isoDate(date)
+
+
+    def GetFilesChanged(self, since, until=None):
+        '''
+        Returns the files that have a new version added since that date, and until the
+        second date, if specified. Both dates are included. \n\
+        Dates can be : seconds since epoch, or strings like "2012-03-05 10:20:30". \n\
+        Uses the date index of _statistics_. \n\
+        '''
+        ti = clock()
+        if until is None:
+            vList = self.c.execute('select file from _statistics_ where date >= ? order by date, file',
+                [self._dateArg(since)]).fetchall()
+        else:
+            vList = self.c.execute('select file from _statistics_ where date between ? and ? '\
+                'order by date, file', [self._dateArg(since), self._dateArg(until)]).fetchall()
+        self._log(1, 'Get files changed took %.4f sec.' % (clock()-ti))
+        return [vElem[0] for vElem in vList]
+
+
+    def GetVersionsBetween(self, since, until=None, fname=None):
+        '''
+        Returns a list of (file, version, hash, size, date, user) for all the versions added
+        between the two dates, included. If fname is specified, only for that file. \n\
+        Only the files changed since the first date are searched, using the date index of each file. \n\
+        On error, it returns -1. \n\
+        '''
+        ti = clock()
+        if until is None:
+            where, params = 'date >= ?', [self._dateArg(since)]
+        else:
+            where, params = 'date between ? and ?', [self._dateArg(since), self._dateArg(until)]
+
+        if fname is None:
+            fnames = self.GetFilesChanged(params[0])
+        elif self.c.execute('select file from _files_ where file = ?', [fname]).fetchone():
+            fnames = [fname]
+        else:
+            self._log(2, 'Func GetVersionsBetween: there is no such file called "%s"!' % fname)
+            return -1
+
+        vList = []
+        for f in fnames:
+            filename = self._table(f)
+            vList.extend([(f,) + row for row in self.c.execute('select version, hash, size, date, user '\
+                'from %s where %s order by version' % (filename, where), params)])
+
+        self._log(1, 'Get versions between dates took %.4f sec.' % (clock()-ti))
+        return vList
+
+
     def GetLabelsList(self):
         '''
         Returns a list with all the labels from current Briefcase file. \n\
         Cannot have errors. \n\
         '''
         ti = clock()
-        vList = self.c.execute('select distinct labels from _files_').fetchall()
-        vFinal = [vElem[0] for vElem in vList]
-        vList = ';'.join(vFinal)
-        vFinal = vList.split(';')
-        vList = sorted(list(set(vFinal)))
-        if str(vList[0]) == '':
-            del vList[0]
+        vList = self.c.execute('select label from _labels_ l where exists (select 1 from _file_labels_ f '\
+            'where f.label = l.id) order by label').fetchall()
         self._log(1, 'Get labels list took %.4f sec.' % (clock()-ti))
+        return [vElem[0] for vElem in vList]
+
+
+    def GetLabelCounts(self):
+        '''
+        Returns a dictionary with all the labels from current Briefcase file, and the number of
+        files for each label. \n\
+        Cannot have errors. \n\
+        '''
+        ti = clock()
+        vList = self.c.execute('select l.label, count(*) from _file_labels_ f join _labels_ l '\
+            'on l.id = f.label group by f.label').fetchall()
+        self._log(1, 'Get labels count took %.4f sec.' % (clock()-ti))
+        return dict(vList)
+
+
+    def GetDuplicates(self, limit=0):
+        '''
+        Returns a list with the contents stored more than once : (hash, size, [(file, version), ...]),
+        the biggest size multiplied by the number of copies first. \n\
+        The new copies are stored by reference, so they are not stored again ; the older briefcase
+        files can have real copies. If limit is a positive number, only the first results are returned. \n\
+        Cannot have errors. \n\
+        '''
+        ti = clock()
+        dups = {}
+        for hash, size, fname, version in self.c.execute('select h.hash, h.size, h.file, h.version from _hashes_ h '\
+            'join (select hash from _hashes_ group by hash having count(*) > 1) d on d.hash = h.hash '\
+            'order by h.file, h.version'):
+            dups.setdefault(hash, [size, []])[1].append((fname, version))
+        vList = sorted([(hash, v[0], v[1]) for hash, v in dups.items()], key=lambda d: d[1] * (len(d[2]) - 1),
+            reverse=True)
+        if limit > 0:
+            vList = vList[:limit]
+        self._log(1, 'Get duplicates took %.4f sec.' % (clock()-ti))
         return vList
 
 
+    def SetRetention(self, label='', keep_last=0, daily=0, weekly=0, monthly=0, max_bytes=0):
+        '''
+        Set the versions that Prune will keep, for the files with this label,
+        or for all the other files, if label is empty. \n\
+        Keep_last : the most recent versions. Daily, weekly, monthly : the latest version from each
+        of the most recent days, weeks, months. A version is kept if any of them keeps it. \n\
+        Max_bytes : the most recent of the kept versions, that fit in this size. \n\
+        The latest version of a file is always kept. If all the values are 0, the policy is deleted. \n\
+        '''
+        values = [keep_last, daily, weekly, monthly, max_bytes]
+        if [v for v in values if type(v) not in [type(0), type(0L)] or v < 0]:
+            self._log(2, 'Func SetRetention: all the values must be integers, 0 or bigger!')
+            return -1
+
+        if not [v for v in values if v]:
+            self.c.execute('delete from _retention_ where label=?', [label])
+        else:
+            self.c.execute('insert or replace into _retention_ (label, keep_last, daily, weekly, monthly, '\
+                'max_bytes) values (?,?,?,?,?,?)', [label] + values)
+        self._commit()
+        return 0
+
+
+    def GetRetention(self):
+        '''
+        Returns a dictionary with all the retention policies : label -> dictionary with
+        keep_last, daily, weekly, monthly, max_bytes. The global policy has the label "". \n\
+        '''
+        vList = self.c.execute('select label, keep_last, daily, weekly, monthly, max_bytes from _retention_').fetchall()
+        return dict([(v[0], {'keep_last':v[1], 'daily':v[2], 'weekly':v[3], 'monthly':v[4],
+            'max_bytes':v[5]}) for v in vList])
+
+
+    def _keepVersions(self, versions, policy):
+        '''
+        Returns the set of versions kept by one policy. \n\
+        Versions is a list of (version, date, stored bytes), the most recent first. \n\
+        '''
+        keep_last, daily, weekly, monthly, max_bytes = policy
+
+        def week(date):
+            try: return strftime('%Y-%W', strptime(date[:10], '%Y-%m-%d'))
+            except ValueError: return date
+
+        if not (keep_last or daily or weekly or monthly):
+            keep = set([v[0] for v in versions])
+        else:
+            keep = set([v[0] for v in versions[:keep_last]])
+            for count, period in [(daily, lambda d: d[:10]), (weekly, week), (monthly, lambda d: d[:7])]:
+                # The first version from each period is the latest one.
+                seen = set()
+                for v in versions:
+                    if len(seen) >= count:
+                        break
+                    if period(v[1]) not in seen:
+                        seen.add(period(v[1]))
+                        keep.add(v[0])
+        keep.add(versions[0][0])
+
+        if max_bytes:
+            total = 0
+            for v in versions[1:]:
+                if v[0] in keep:
+                    total += v[2]
+                    if total + versions[0][2] > max_bytes:
+                        keep.discard(v[0])
+        return keep
+
+
+    def Prune(self, dry_run=False, progress=None):
+        '''
+        Delete the versions that are not kept by the retention policies, in one transaction. \n\
+        Each file uses the policies of its labels ; a version is kept if any of them keeps it.
+        The files without such labels use the global policy. Files without any policy are not changed. \n\
+        Returns a report : {"files", "versions", "bytes", "pruned":{file: [versions]}}, where bytes
+        is the stored size of the deleted versions. If dry_run is true, nothing is deleted. \n\
+        The briefcase file becomes smaller only after Cleanup. \n\
+        Progress is an optional function called after each file, with : files done, total files,
+        bytes. If it returns False, the rest of the files are not checked. \n\
+        '''
+        ti = clock()
+        policies = dict([(v[0], v[1:]) for v in self.c.execute('select label, keep_last, daily, weekly, '\
+            'monthly, max_bytes from _retention_')])
+        report = {'files':0, 'versions':0, 'bytes':0, 'pruned':{}}
+        if not policies:
+            return report
+
+        # The policies of each file, from its labels.
+        file_policies = {}
+        for fname, label in self.c.execute('select f.file, l.label from _file_labels_ f join _labels_ l '\
+            'on l.id = f.label where l.label in (%s)' % ','.join('?' * len(policies)), policies.keys()):
+            file_policies.setdefault(fname, []).append(policies[label])
+
+        all_files = self.c.execute('select file from _files_ order by file').fetchall()
+        for i, (fname,) in enumerate(all_files):
+            file_policy = file_policies.get(fname) or ([policies['']] if '' in policies else [])
+            if not file_policy:
+                continue
+            filename = self._table(fname)
+            # Only the blocks used by one version are deleted with it. The blocks in packfiles have a length.
+            versions = self.c.execute('select v.version, v.date, ifnull(length(v.raw), case when b.refs = 1 then '\
+                'ifnull(b.length, length(b.raw)) else 0 end) from %s v left join _blocks_ b on b.id = v.block '\
+                'order by v.version desc' % filename).fetchall()
+            keep = set()
+            for policy in file_policy:
+                keep |= self._keepVersions(versions, policy)
+            pruned = [v for v in versions if v[0] not in keep]
+
+            if pruned:
+                report['files'] += 1
+                report['versions'] += len(pruned)
+                report['bytes'] += sum([v[2] for v in pruned])
+                report['pruned'][fname] = sorted([v[0] for v in pruned])
+                if not dry_run:
+                    self._refBlocks([vElem[0] for vElem in self.c.execute('select block from %s where '\
+                        'version in (%s)' % (filename, ','.join([str(v[0]) for v in pruned])))], -1)
+                    self.c.execute('delete from %s where version in (%s)' % (filename,
+                        ','.join([str(v[0]) for v in pruned])))
+                    self.c.execute('delete from _hashes_ where file=? and version in (%s)' % \
+                        ','.join([str(v[0]) for v in pruned]), [fname])
+                    self.FileStatistics(fname)
+            if progress and progress(i+1, len(all_files), report['bytes']) is False:
+                self._log(2, 'Func Prune: stopped after %i files!' % (i+1))
+                break
+
+        self._commit()
+        self._log(1, 'Prune%s : %i versions from %i files, %i bytes, took %.4f sec.' % (dry_run and
+            ' (dry run)' or '', report['versions'], report['files'], report['bytes'], clock()-ti))
+        return report
+
+
+    def TrainDictionary(self, size=DICT_SIZE, sample=DICT_SAMPLE):
+        '''
+        Trains a new compression dictionary from a random sample of the small files that use the
+        global password, like zstd does : the sample is split in one part for each segment of the
+        dictionary, and from each part, the segment with the substrings found in most files is chosen.
+        The common parts don't have to be whole lines, so JSON, XML and log files that are a little
+        different in each file work too. The best segments are at the end, closest to the data. \n\
+        From now on, the new small files added with zlib are compressed against this dictionary.
+        The old versions keep their dictionary. \n\
+        Size is at most 32 KB, the zlib window. Returns the dictionary id, or -1 on error. \n\
+        '''
+        ti = clock()
+        size = min(size, 32 * 1024)
+        all_files = [vElem[0] for vElem in self.c.execute('select s.file from _statistics_ s join _files_ f '\
+            'on f.file = s.file where f.pwd = 1 and s.size <= ?', [SMALL_FILE])]
+        if len(all_files) < 2:
+            self._log(2, 'Func TrainDictionary: there are not enough small files to train a dictionary!')
+            return -1
+        random.shuffle(all_files)
+
+        # Count in how many files each substring appears.
+        counts = {}
+        corpus = []
+        total = 0
+        files = 0
+        for fname in all_files[:sample]:
+            data = self._restoreVersion(self._versionRaw(self._table(fname)), 1)
+            for gram in set([data[i:i+DICT_GRAM] for i in xrange(len(data) - DICT_GRAM + 1)]):
+                counts[gram] = counts.get(gram, 0) + 1
+            corpus.append(data)
+            total += len(data)
+            files += 1
+            if total >= size * DICT_CORPUS:
+                break
+        counts = dict([(gram, n) for gram, n in counts.iteritems() if n > 1])
+        corpus = ''.join(corpus)
+
+        # The best segment from each part. The substrings of a chosen segment don't count anymore,
+        # so the same parts are not chosen again.
+        chosen = []
+        step = max(len(corpus) // max(size // DICT_SEGMENT, 1), DICT_SEGMENT)
+        for start in xrange(0, len(corpus) - DICT_SEGMENT + 1, step):
+            part = corpus[start:start+step+DICT_GRAM-1]
+            scores = [counts.get(part[i:i+DICT_GRAM], 0) for i in xrange(len(part) - DICT_GRAM + 1)]
+            window = DICT_SEGMENT - DICT_GRAM + 1
+            score = best = sum(scores[:window])
+            pos = 0
+            for i in xrange(1, len(scores) - window + 1):
+                score += scores[i+window-1] - scores[i-1]
+                if score > best:
+                    best, pos = score, i
+            if not best:
+                continue
+            segment = part[pos:pos+DICT_SEGMENT]
+            for i in xrange(len(segment) - DICT_GRAM + 1):
+                counts.pop(segment[i:i+DICT_GRAM], None)
+            chosen.append((best, segment))
+        if not chosen:
+            self._log(2, 'Func TrainDictionary: the files don\'t have common parts!')
+            return -1
+        zdict = ''.join([vElem[1] for vElem in sorted(chosen)])[-size:]
+
+        self._dict_id = self.c.execute('insert into _dicts_ (raw, size, files, date) values (?,?,?,?)',
+            [self._transformb(zdict, 1), len(zdict), files, strftime(DATE_FORMAT)]).lastrowid
+        self._commit()
+        self._log(1, 'Training dictionary "%i" from %i files, %i bytes, took %.4f sec.' % (self._dict_id,
+            files, len(zdict), clock()-ti))
+        return self._dict_id
+
+
     def Info(self):
         '''
         Returns a dictionary containing the following information for this Briefcase file : \n\
@@ -838,7 +3747,9 @@ class Briefcase:
         - date created \n\
         - user that created it \n\
         - all labels used \n\
-        - version of program used to create the file. \n\
+        - version of program used to create the file \n\
+        - the content hash \n\
+        - the number of packfiles, 0 if packs are not enabled, and the volume folders. \n\
         Cannot have errors. \n\
         '''
         ti = clock()
@@ -851,32 +3762,136 @@ class Briefcase:
 
         self._log(1, 'Get database info took %.4f sec.' % (clock()-ti))
         return {'numberOfFiles':numberOfFiles, 'dateCreated':dateCreated , 'userCreated':userCreated,
-            'allLabels':allLabels, 'versionCreated':versionCreated}
+            'allLabels':allLabels, 'versionCreated':versionCreated, 'hash':self.hash_name,
+            'packs':len(_packFiles(self.database, self.volumes, self.uuid)), 'volumes':self.volumes}
+
+
+    def CompactPacks(self, progress=None):
+        '''
+        Moves the blocks still used from the packfiles that have less than PACK_LIVE of their bytes
+        used, to the newest packfiles, then deletes the old packfiles. For the data in packfiles, this
+        replaces VACUUM : only the used blocks are copied. The newest packfile of each volume is never
+        compacted. \n\
+        If packs are enabled, the blocks still stored in the database are moved into packfiles too. \n\
+        Each packfile is moved in one transaction ; it's deleted only after the commit. \n\
+        Progress is an optional function called after each packfile, with : packfiles done,
+        total packfiles, bytes moved. If it returns False, the rest of the packfiles are not compacted. \n\
+        '''
+        ti = clock()
+        packs = _packFiles(self.database, self.volumes, self.uuid)
+        newest = {}
+        for pack, path in packs.items():
+            newest[os.path.dirname(path)] = max(pack, newest.get(os.path.dirname(path), 0))
+        live = dict(self.c.execute('select pack, sum(length) from _blocks_ where pack is not null '\
+            'group by pack').fetchall())
+        selected = [pack for pack in sorted(packs) if pack not in newest.values() and live.get(pack, 0) < \
+            PACK_LIVE * os.path.getsize(packs[pack])]
+        # None means the blocks from the database.
+        if self.packs and self.c.execute('select id from _blocks_ where raw is not null limit 1').fetchone():
+            selected.append(None)
+
+        moved = 0
+        freed = 0
+        for i, pack in enumerate(selected):
+            # This update changes nothing, but it takes the write lock, before appending to the packfiles.
+            self.c.execute('update _blocks_ set pack = pack where id is null')
+            if pack is None:
+                blocks = self.c.execute('select id from _blocks_ where raw is not null').fetchall()
+            else:
+                blocks = self.c.execute('select id, pos, length from _blocks_ where pack=?', [pack]).fetchall()
+            for vElem in blocks:
+                if pack is None:
+                    raw = self.c.execute('select raw from _blocks_ where id=?', [vElem[0]]).fetchone()[0]
+                else:
+                    raw = self._packRead(pack, vElem[1], vElem[2])
+                new_pack, pos = self._packAppend(raw)
+                self.c.execute('update _blocks_ set raw=null, pack=?, pos=?, length=? where id=?',
+                    [new_pack, pos, len(raw), vElem[0]])
+                moved += len(raw)
+            self._commit()
+
+            if pack is not None:
+                path = packs[pack]
+                freed += os.path.getsize(path)
+                with self._cache_lock:
+                    self._maps.pop(path, None)
+                writer = self._writers.pop(pack, None)
+                if writer:
+                    writer[0].close()
+                try:
+                    os.remove(path)
+                except OSError, e:
+                    self._log(2, 'Func CompactPacks: cannot delete packfile "%s"! %s' % (path, e))
+            if progress and progress(i+1, len(selected), moved) is False:
+                self._log(2, 'Func CompactPacks: stopped after %i packfiles!' % (i+1))
+                break
+
+        self._commit()
+        self._log(1, 'Compacting %i packfiles : %i bytes moved, %i bytes freed, took %.4f sec.' % (len(selected),
+            moved, freed, clock()-ti))
+        return 0
 
 
-    def Cleanup(self):
+    def Cleanup(self, progress=None):
         '''
         Deletes table _statistics_. \n\
         Cleans the main database by copying its contents to a temporary database file and
         reloading the original database file from the copy. \n\
         This eliminates free pages, aligns table data to be contiguous, and otherwise
         cleans up the database file structure. \n\
+        Progress is an optional function called after each file statistics and during VACUUM,
+        with : files done, total files, 0. If it returns False, the VACUUM is interrupted. \n\
+        The statistics are always rebuilt. \n\
+        If the briefcase uses packfiles, they are compacted with CompactPacks, so VACUUM only
+        rewrites the metadata. \n\
         '''
         ti = clock()
 
         global EXEC_statistics_, EXEC_logs_
         self.c.execute('drop table _statistics_') # Delete table _statistics_.
         self.c.execute(EXEC_statistics_.replace(' if not exists', ''))
+        for index in EXEC_statistics_indexes_:
+            self.c.execute(index)
 
         self.c.execute('drop table _logs_') # Delete table _logs_.
         self.c.execute(EXEC_logs_.replace(' if not exists', ''))
 
-        # Rebuilding statistics.
-        for fname in self.c.execute('select file from _files_ order by file asc').fetchall():
+        # Delete labels and verify results that are not used anymore.
+        self.c.execute('delete from _labels_ where id not in (select label from _file_labels_)')
+        self.c.execute('delete from _verified_ where file not in (select file from _files_)')
+        self.c.execute('delete from _hashes_ where file not in (select file from _files_)')
+        self._known = None
+
+        # Rebuilding statistics, and the reference counts of the blocks.
+        all_files = self.c.execute('select file from _files_ order by file asc').fetchall()
+        stopped = False
+        for i, fname in enumerate(all_files):
             self.FileStatistics(fname[0])
+            if progress and progress(i+1, len(all_files), 0) is False:
+                stopped = True
+        if not stopped:
+            self._countRefs()
+        self._commit()
+
+        if stopped:
+            self._log(2, 'Func Cleanup: stopped before VACUUM!')
+            return -1
+        if self.packs or _packFiles(self.database, self.volumes, self.uuid):
+            self.CompactPacks()
+
+        if progress:
+            # A non zero return value interrupts the VACUUM, without any damage.
+            self.conn.set_progress_handler(lambda: progress(len(all_files), len(all_files), 0) is False, 100000)
+        try:
+            self.c.execute('VACUUM')
+        except sqlite3.OperationalError, e:
+            self._log(2, 'Func Cleanup: VACUUM interrupted! %s' % e)
+            return -1
+        finally:
+            self.conn.set_progress_handler(None, 0)
 
-        self.c.execute('VACUUM')
         self._log(1, 'Cleanup took %.4f sec.' % (clock()-ti))
+        return 0
 
 
 #
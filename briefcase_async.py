@@ -0,0 +1,404 @@
+#!/usr/local/bin/python
+# -*- coding: latin-1 -*-
+
+'''
+    Briefcase-Project v1.0 \n\
+    Copyright (C) 2009-2012, Cristi Constantin. All rights reserved. \n\
+    This module contains AsyncBriefcase class, that runs Briefcase operations in background. \n\
+    The writes and the file lists run in one dedicated SQLite thread. Compression, encryption and
+    hashing run on a pool of crypto threads. When they restore files, the crypto threads also read
+    the solid blocks and the dictionaries they need, each one with its own connection, like every
+    thread that uses a Briefcase. \n\
+    Every operation returns a Job immediately. Jobs can be waited for, cancelled, and they
+    report progress. \n\
+'''
+
+# Standard libraries.
+import os
+import Queue
+import threading
+from time import clock
+
+from briefcase import Briefcase
+
+__all__ = ['AsyncBriefcase', 'Job', 'Cancelled']
+
+#
+
+class Cancelled(Exception):
+    """ Raised by Job.result when the job was cancelled """
+    pass
+
+#
+
+class Job:
+    """ The result of one operation, running in background """
+
+    def __init__(self):
+        #
+        self._event = threading.Event()
+        self._result = None
+        self._error = None
+        self._cancelled = False
+        self._progress = Queue.Queue()
+        self._callbacks = []
+        self._lock = threading.Lock()
+        #
+
+
+    def cancel(self):
+        '''
+        Ask the job to stop. Jobs stop between files, never in the middle of one file. \n\
+        Returns False if the job is already finished. \n\
+        '''
+        if self._event.isSet():
+            return False
+        self._cancelled = True
+        return True
+
+
+    def cancelled(self):
+        return self._cancelled
+
+
+    def done(self):
+        return self._event.isSet()
+
+
+    def result(self, timeout=None):
+        '''
+        Wait for the job and return its result. Raises the error of the job, if any,
+        or Cancelled if the job was cancelled. \n\
+        '''
+        if not self._event.wait(timeout):
+            raise Exception('The job is not finished after %s sec!' % timeout)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+    def add_done_callback(self, func):
+        '''
+        Func will be called with the job as argument, when the job finishes. \n\
+        It runs in the thread that finished the job. \n\
+        '''
+        with self._lock:
+            if not self._event.isSet():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+
+    def progress(self):
+        '''
+        Iterates over progress tuples : (done, total, bytes done), until the job finishes. \n\
+        Only one consumer should iterate the progress of one job. \n\
+        '''
+        while True:
+            try:
+                item = self._progress.get(True, 0.1)
+            except Queue.Empty:
+                continue
+            if item is None:
+                return
+            yield item
+
+
+    def _report(self, done, total, nbytes):
+        # Used as progress function for Briefcase. Returns False to stop the Briefcase operation.
+        self._progress.put((done, total, nbytes))
+        return not self._cancelled
+
+
+    def _finish(self, result=None, error=None):
+        #
+        with self._lock:
+            self._result = result
+            self._error = error
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        self._progress.put(None)
+        for func in callbacks:
+            func(self)
+        #
+
+#
+
+class _Executor:
+    """ A pool of threads executing functions from one queue """
+
+    def __init__(self, workers, name):
+        #
+        self.tasks = Queue.Queue()
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._work, name='%s-%i' % (name, i))
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+        #
+
+
+    def _work(self):
+        #
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            job, func, args, kwargs = task
+            if job.cancelled():
+                job._finish(error=Cancelled())
+                continue
+            try:
+                result = func(*args, **kwargs)
+            except Exception, e:
+                job._finish(error=e)
+            else:
+                job._finish(result)
+        #
+
+
+    def submit(self, func, *args, **kwargs):
+        job = Job()
+        self.tasks.put((job, func, args, kwargs))
+        return job
+
+
+    def submit_job(self, job, func, *args, **kwargs):
+        # Finish an existing job with the result of func.
+        self.tasks.put((job, func, args, kwargs))
+        return job
+
+
+    def shutdown(self, wait=True):
+        #
+        for t in self.threads:
+            self.tasks.put(None)
+        if wait:
+            for t in self.threads:
+                t.join()
+        #
+
+#
+
+class AsyncBriefcase:
+    """ Runs Briefcase operations in background threads """
+
+    def __init__(self, database='Data.prv', password='', workers=None):
+        '''
+        Opens the briefcase in the SQLite thread and waits for it, so a wrong password
+        raises here, like for Briefcase. \n\
+        Workers is the number of crypto threads. Default is the number of CPUs. \n\
+        '''
+        if not workers:
+            try:
+                import multiprocessing
+                workers = multiprocessing.cpu_count()
+            except (ImportError, NotImplementedError):
+                workers = 2
+        #
+        self.workers = workers
+        self._sqlite = _Executor(1, 'briefcase-sqlite')
+        self._crypto = _Executor(workers, 'briefcase-crypto')
+        try:
+            self._b = self._sqlite.submit(Briefcase, database, password).result()
+        except:
+            self.close()
+            raise
+        #
+
+
+    def __getattr__(self, name):
+        '''
+        All the other Briefcase functions (GetFileList, FileStatistics, RenFile, ...)
+        simply run in the SQLite thread and return a Job. \n\
+        '''
+        if name.startswith('_') or not name[:1].isupper():
+            raise AttributeError(name)
+        func = getattr(self._b, name)
+        return lambda *args, **kwargs: self._sqlite.submit(func, *args, **kwargs)
+
+
+    def close(self):
+        '''
+        Stop all threads and close the database. Queued jobs are executed first. \n\
+        '''
+        self._crypto.shutdown()
+        if hasattr(self, '_b'):
+            self._sqlite.submit(self._b.Close)
+        self._sqlite.shutdown()
+
+
+    def _spawn(self, func, *args):
+        '''
+        Run func(job, *args) in a new thread, that coordinates the SQLite and crypto threads. \n\
+        '''
+        job = Job()
+        def run():
+            try:
+                result = func(job, *args)
+            except Exception, e:
+                job._finish(error=e)
+            else:
+                job._finish(result)
+        t = threading.Thread(target=run)
+        t.setDaemon(True)
+        t.start()
+        return job
+
+
+    def _add(self, job, files, password, labels, arch, versionable):
+        '''
+        Files are prepared by the crypto threads and stored in order, by the SQLite thread. \n\
+        Only a few prepared files are kept in memory at one time. \n\
+        '''
+        ti = clock()
+        arch = arch.lower()
+        if arch != 'zlib':
+            arch = 'bz2'
+        files = [f for f in files if os.path.isfile(f)]
+        pending = []
+        queued = iter(files)
+        nbytes = 0
+        ret = 0
+
+        def queue_next():
+            for filepath in queued:
+                pending.append(self._crypto.submit(self._b._prepareFile, filepath, password, arch))
+                return
+
+        for i in range(self.workers * 2):
+            queue_next()
+
+        done = 0
+        while pending:
+            if job.cancelled():
+                for p in pending: p.cancel()
+                raise Cancelled()
+            prepared = pending.pop(0).result()
+            queue_next()
+            if self._sqlite.submit(self._b._storeFile, prepared, labels, versionable).result():
+                ret = -1
+            done += 1
+            nbytes += prepared['size']
+            job._report(done, len(files), nbytes)
+
+        if len(files) > 1:
+            self._b._log(1, 'Added %i files in %.4f sec.' % (len(files), clock()-ti), False)
+        return ret
+
+
+    def AddFile(self, filepath, password=1, labels='', arch='zlib', versionable=True):
+        '''
+        Same as Briefcase.AddFile. The job result is 0, or -1 on error. \n\
+        '''
+        def run(job):
+            if not os.path.exists(filepath):
+                self._b._log(2, 'Func AddFile: file path "%s" doesn\'t exist!' % filepath, False)
+                return -1
+            return self._add(job, [filepath], password, labels, arch, versionable)
+        return self._spawn(run)
+
+
+    def AddManyFiles(self, pathregex, password=1, labels='', versionable=True, arch='zlib'):
+        '''
+        Same as Briefcase.AddManyFiles. Progress is reported after each file. \n\
+        '''
+        def run(job):
+            files = self._sqlite.submit(self._b._globFiles, pathregex).result()
+            if files == -1:
+                return -1
+            # The hashes of the stored files are loaded once, to find the duplicates faster.
+            self._sqlite.submit(self._b._loadHashes).result()
+            try:
+                self._add(job, files, password, labels, arch, versionable)
+            finally:
+                self._sqlite.submit(setattr, self._b, '_known', None)
+            return 0
+        return self._spawn(run)
+
+
+    def ExportFile(self, fname, password=1, version=0, path='', execute=False):
+        '''
+        Same as Briefcase.ExportFile. The data is restored by a crypto thread. \n\
+        The job result is the hash of the file, or -1 on error. \n\
+        '''
+        if execute:
+            return self._sqlite.submit(self._b.ExportFile, fname, password, version, path, execute)
+
+        def run(job):
+            if not path or not os.path.exists(path):
+                self._b._log(2, 'Func ExportFile: path "%s" doesn\'t exist!' % path, False)
+                return -1
+            selected = self._sqlite.submit(self._b._fetchFile, fname, password, max(version, 0)).result()
+            if selected == -1:
+                return -1
+            if job.cancelled():
+                raise Cancelled()
+            size = self._crypto.submit(self._b._writeFile, selected[0], selected[2], path + '/' + fname).result()
+            job._report(1, 1, size)
+            return selected[1]
+        return self._spawn(run)
+
+
+    def ExportAll(self, path, password=1):
+        '''
+        Same as Briefcase.ExportAll. The SQLite thread reads the next files,
+        while the crypto threads restore and write the previous ones. \n\
+        '''
+        def run(job):
+            ti = clock()
+            if not os.path.exists(path):
+                self._b._log(2, 'Func ExportAll: path "%s" doesn\'t exist!' % path, False)
+                return -1
+            all_files = self._sqlite.submit(self._b._exportList, password).result()
+            pending = []
+            nbytes = 0
+            done = 0
+
+            for fname in all_files:
+                if job.cancelled():
+                    for p in pending: p.cancel()
+                    raise Cancelled()
+                selected = self._sqlite.submit(self._b._fetchFile, fname, password).result()
+                if selected == -1:
+                    continue
+                pending.append(self._crypto.submit(self._b._writeFile, selected[0], selected[2], path + '/' + fname))
+                # Don't keep too many files in memory.
+                while len(pending) >= self.workers * 2 or (pending and pending[0].done()):
+                    nbytes += pending.pop(0).result()
+                    done += 1
+                    job._report(done, len(all_files), nbytes)
+
+            for p in pending:
+                nbytes += p.result()
+                done += 1
+                job._report(done, len(all_files), nbytes)
+
+            self._b._log(1, 'Exporting %i files took %.4f sec.' % (len(all_files), clock()-ti), False)
+            return 0
+        return self._spawn(run)
+
+
+    def Cleanup(self):
+        '''
+        Same as Briefcase.Cleanup. Cancelling the job interrupts the VACUUM, and the job raises
+        Cancelled, like the other jobs. \n\
+        '''
+        job = Job()
+        def run():
+            ret = self._b.Cleanup(progress=job._report)
+            if job.cancelled():
+                raise Cancelled()
+            return ret
+        return self._sqlite.submit_job(job, run)
+
+
+    def Join(self, path1, **args):
+        '''
+        Same as Briefcase.Join. \n\
+        '''
+        return self._sqlite.submit(self._b.Join, path1, **args)
+
+
+# Eof()
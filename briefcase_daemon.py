@@ -0,0 +1,382 @@
+#!/usr/local/bin/python
+# -*- coding: latin-1 -*-
+
+'''
+    Briefcase-Project v1.0 \n\
+    Copyright (C) 2009-2012, Cristi Constantin. All rights reserved. \n\
+    This module contains the Briefcase daemon and the client used to talk with it. \n\
+    The daemon keeps one briefcase file open, with the password already validated,
+    so short-lived scripts don't pay for PBKDF2 and table creation on every run. \n\
+    Works only on systems with Unix sockets. \n\
+'''
+
+'''
+    The protocol is binary and very simple. \n\
+    Every request is : 4 bytes payload length, 1 byte operation code, payload. \n\
+    Every response is : 4 bytes payload length, 1 byte status (0 = ok, 1 = error), payload. \n\
+    The payload is a marshal-ed (args, kwargs) tuple for requests, and the marshal-ed result for responses. \n\
+    If the status is error, the payload is the error message. \n\
+'''
+
+# Standard libraries.
+import os, sys
+import socket
+import select
+import struct
+import marshal
+import getpass
+import tempfile
+import thread
+from time import clock
+
+from briefcase import Briefcase, threaded_execute
+
+__all__ = ['BriefcaseServer', 'BriefcaseClient', 'default_address']
+
+#
+
+HEADER = struct.Struct('!IB')
+
+OP_PING = 1
+OP_ADD = 2
+OP_ADD_MANY = 3
+OP_EXPORT = 4
+OP_LIST = 5
+OP_STATS = 6
+OP_LABELS = 7
+OP_SET_LABELS = 8
+OP_INFO = 9
+OP_SHUTDOWN = 10
+OP_BY_LABELS = 11
+OP_LABEL_COUNTS = 12
+OP_CHANGED = 13
+OP_VERSIONS = 14
+
+# Operation code -> Briefcase function name.
+OPERATIONS = {
+    OP_ADD: 'AddFile',
+    OP_ADD_MANY: 'AddManyFiles',
+    OP_EXPORT: 'ExportFile',
+    OP_LIST: 'GetFileList',
+    OP_STATS: 'FileStatistics',
+    OP_LABELS: 'GetLabelsList',
+    OP_SET_LABELS: 'SetLabels',
+    OP_INFO: 'Info',
+    OP_BY_LABELS: 'GetFilesByLabels',
+    OP_LABEL_COUNTS: 'GetLabelCounts',
+    OP_CHANGED: 'GetFilesChanged',
+    OP_VERSIONS: 'GetVersionsBetween',
+}
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+#
+
+def default_address(database):
+    '''
+    The socket used for one briefcase file is created next to it. \n\
+    '''
+    return os.path.abspath(database) + '.sock'
+
+
+def _recv_exactly(sock, length):
+    # Read exactly "length" bytes from a blocking socket.
+    chunks = []
+    while length:
+        chunk = sock.recv(min(length, 65536))
+        if not chunk:
+            raise Exception('Connection closed by the briefcase daemon!')
+        chunks.append(chunk)
+        length -= len(chunk)
+    return ''.join(chunks)
+
+#
+
+class BriefcaseServer:
+    """ Keeps one Briefcase open and serves it over a Unix socket """
+
+    def __init__(self, database='Data.prv', password='', address=None, verbose=1):
+        '''
+        Open the briefcase file and validate the password, only once. \n\
+        If address is not specified, the socket is created next to the briefcase file. \n\
+        '''
+        if not hasattr(socket, 'AF_UNIX'):
+            raise Exception('The briefcase daemon needs Unix sockets! System `%s` is not supported!' % os.name)
+        #
+        self.b = Briefcase(database, password)
+        self.b.verbose = verbose
+        self.address = address or default_address(database)
+        self.sock = None
+        self.clients = {}
+        self.running = False
+        #
+
+
+    def _bind(self):
+        '''
+        Create the listening socket. Only the current user can connect. \n\
+        '''
+        if os.path.exists(self.address):
+            # If another daemon is listening, don't steal its socket.
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.address)
+                probe.close()
+                raise Exception('There is already a daemon listening on "%s"!' % self.address)
+            except socket.error:
+                os.remove(self.address)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0177)
+        try:
+            self.sock.bind(self.address)
+        finally:
+            os.umask(old_umask)
+        self.sock.listen(16)
+
+
+    def _handle(self, op, payload):
+        '''
+        Execute one request and return (status, result). \n\
+        '''
+        if op == OP_PING:
+            return STATUS_OK, 0
+        elif op == OP_SHUTDOWN:
+            self.running = False
+            return STATUS_OK, 0
+        elif op not in OPERATIONS:
+            return STATUS_ERROR, 'Unknown operation code `%i`!' % op
+
+        try:
+            args, kwargs = marshal.loads(payload)
+        except Exception, e:
+            return STATUS_ERROR, 'Invalid request payload! %s' % e
+
+        # The daemon must never open files on its own screen.
+        if op == OP_EXPORT and (kwargs.get('execute') or args[4:5] and args[4]):
+            return STATUS_ERROR, 'The daemon cannot execute files! Export them into a path!'
+
+        # Every operation is committed, or rolled back, so the daemon never keeps the write lock
+        # between requests, and the other processes can use the file.
+        try:
+            result = getattr(self.b, OPERATIONS[op])(*args, **kwargs)
+            self.b._commit()
+            return STATUS_OK, result
+        except Exception, e:
+            self.b.conn.rollback()
+            return STATUS_ERROR, str(e)
+
+
+    def _serve_client(self, conn):
+        '''
+        Read everything available from one client and answer all complete requests. \n\
+        Returns False when the client disconnected. \n\
+        '''
+        data = conn.recv(65536)
+        if not data:
+            return False
+
+        buff = self.clients[conn] + data
+        while len(buff) >= HEADER.size:
+            length, op = HEADER.unpack_from(buff)
+            if len(buff) < HEADER.size + length:
+                break
+            payload = buff[HEADER.size:HEADER.size + length]
+            buff = buff[HEADER.size + length:]
+
+            status, result = self._handle(op, payload)
+            try:
+                result = marshal.dumps(result, 2)
+            except ValueError:
+                status, result = STATUS_ERROR, marshal.dumps('Result cannot be sent to the client!', 2)
+            conn.sendall(HEADER.pack(len(result), status) + result)
+
+        self.clients[conn] = buff
+        return True
+
+
+    def serve_forever(self):
+        '''
+        Serve requests until a client asks for shutdown. \n\
+        All clients are served from one thread, so the briefcase is never used concurrently. \n\
+        '''
+        self._bind()
+        self.running = True
+        self.b._log(1, 'Briefcase daemon listening on "%s".' % self.address)
+
+        try:
+            while self.running:
+                readable = select.select([self.sock] + self.clients.keys(), [], [], 1.0)[0]
+                for sock in readable:
+                    if sock is self.sock:
+                        conn = self.sock.accept()[0]
+                        self.clients[conn] = ''
+                        continue
+                    try:
+                        alive = self._serve_client(sock)
+                    except socket.error:
+                        alive = False
+                    if not alive:
+                        sock.close()
+                        del self.clients[sock]
+        finally:
+            self.close()
+
+
+    def close(self):
+        #
+        for conn in self.clients:
+            conn.close()
+        self.clients = {}
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+            try: os.remove(self.address)
+            except: pass
+        self.b._commit()
+        #
+
+#
+
+class BriefcaseClient:
+    """ Mirrors the Briefcase API, using a running daemon """
+
+    def __init__(self, database='Data.prv', address=None):
+        '''
+        Connect to the daemon serving the briefcase file. \n\
+        The password was already provided when the daemon started. \n\
+        '''
+        self.database = str(database)
+        self.address = address or default_address(database)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(self.address)
+        except socket.error, e:
+            raise Exception('Cannot connect to the briefcase daemon on "%s"! %s' % (self.address, e))
+
+
+    def _call(self, op, *args, **kwargs):
+        '''
+        Send one request and wait for the response. \n\
+        '''
+        payload = marshal.dumps((args, kwargs), 2)
+        self.sock.sendall(HEADER.pack(len(payload), op) + payload)
+        length, status = HEADER.unpack(_recv_exactly(self.sock, HEADER.size))
+        result = marshal.loads(_recv_exactly(self.sock, length))
+        if status != STATUS_OK:
+            raise Exception(result)
+        return result
+
+
+    def close(self):
+        #
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+        #
+
+
+    def Ping(self):
+        '''
+        Returns the round-trip time to the daemon, in seconds. \n\
+        '''
+        ti = clock()
+        self._call(OP_PING)
+        return clock()-ti
+
+
+    def Shutdown(self):
+        '''
+        Stop the daemon. The briefcase file is closed. \n\
+        '''
+        self._call(OP_SHUTDOWN)
+        self.close()
+
+
+    def AddFile(self, filepath, password=1, labels='', arch='zlib', versionable=True):
+        # The daemon can run in another folder.
+        return self._call(OP_ADD, os.path.abspath(filepath), password, labels, arch, versionable)
+
+
+    def AddManyFiles(self, pathregex, password=1, labels='', versionable=True, solid=False):
+        return self._call(OP_ADD_MANY, os.path.abspath(pathregex), password, labels, versionable, None, solid)
+
+
+    def ExportFile(self, fname, password=1, version=0, path='', execute=False):
+        '''
+        Same as Briefcase.ExportFile. \n\
+        If execute is true, the file is exported into a temporary folder and executed locally. \n\
+        '''
+        if not execute:
+            return self._call(OP_EXPORT, fname, password, version, os.path.abspath(path) if path else '')
+
+        if not path:
+            path = tempfile.mkdtemp('__', '__py')
+        ret = self._call(OP_EXPORT, fname, password, version, os.path.abspath(path))
+        if ret != -1:
+            thread.start_new_thread(threaded_execute, (path + '/' + fname,),)
+        return ret
+
+
+    def GetFileList(self, ssort='', ffilter='', limit=0, offset=0, after=None):
+        return self._call(OP_LIST, ssort, ffilter, limit, offset, after)
+
+
+    def FileStatistics(self, fname, silent=True):
+        return self._call(OP_STATS, fname, silent)
+
+
+    def GetLabelsList(self):
+        return self._call(OP_LABELS)
+
+
+    def SetLabels(self, fname, labels):
+        return self._call(OP_SET_LABELS, fname, labels)
+
+
+    def GetFilesByLabels(self, labels, match='all'):
+        return self._call(OP_BY_LABELS, labels, match)
+
+
+    def GetLabelCounts(self):
+        return self._call(OP_LABEL_COUNTS)
+
+
+    def GetFilesChanged(self, since, until=None):
+        return self._call(OP_CHANGED, since, until)
+
+
+    def GetVersionsBetween(self, since, until=None, fname=None):
+        return self._call(OP_VERSIONS, since, until, fname)
+
+
+    def Info(self):
+        return self._call(OP_INFO)
+
+#
+
+if __name__ == '__main__':
+
+    from optparse import OptionParser
+    usage = "Usage: %prog --db <briefcase-file> [--pwd-env <variable>] [--socket <path>]"
+    parser = OptionParser(usage=usage)
+
+    parser.add_option("--db", "--file", dest="database", default="Data.prv", help="The name of the briefcase file.")
+    # The password is never an argument, because the arguments of all processes can be seen by all users.
+    parser.add_option("--pwd-env", dest="pwd_env", default=None, help="Read the password of the briefcase file "\
+        "from this environment variable. Default is to ask for it, or to read it from stdin.")
+    parser.add_option("--socket", dest="address", default=None, help="The Unix socket. Default is <briefcase-file>.sock")
+    parser.add_option("-v", "--verbose", dest="verbose", type="int", default=1, help="0 = silence, 1 = errors, 2 = all.")
+    (options, args) = parser.parse_args()
+
+    if options.pwd_env:
+        password = os.environ.get(options.pwd_env, '')
+    else:
+        password = getpass.getpass('Password for "%s": ' % options.database)
+
+    server = BriefcaseServer(options.database, password, options.address, options.verbose)
+    server.serve_forever()
+
+
+# Eof()
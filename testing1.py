@@ -17,17 +17,39 @@ Testing strategy :
 -	Export a few "cloned" files and check with the original;
 -	Rename a few files and check the number of files;
 -	Export a few renamed files and check with the original;
+-	Backup, change and restore the briefcase, then backup incrementally;
+-	Verify many briefcases with solid blocks, in one process, then corrupt one file;
+-	Export the briefcase into zip and tar archives, then add the archives in new briefcases;
+-	Add the same content with many names, then a different content with the same hash;
+-	Copy one version into many files, without copying the data, then delete them;
+-	Prune and compact the versions of a briefcase with packfiles;
+-	Use two briefcases with the same name, with packfiles in the same volume folder;
+-	Serve a briefcase with the daemon, add, list and export files, then stop it;
+-	Run background operations with AsyncBriefcase, with progress, then cancel them;
+-	Set labels and filter the files by labels, then upgrade the labels of an old briefcase;
+-	List the files with structured filters, sort and pages;
+-	Upgrade the dates of an old briefcase, then search the versions between two dates;
+-	Sync out the briefcase into a folder, then sync again after changes;
+-	Sync in a folder tree, then sync again after changing one file;
+-	Read a briefcase with a readonly instance, while a second writer waits for the first one;
+-	Train a compression dictionary, then add, export and verify files compressed with it, with any password;
+-	Add a zip archive made by another program, with deflated and stored members, and path labels;
 
 '''
 
 import os, sys, shutil
+import threading, tempfile
+import sqlite3, struct, zipfile, zlib
+from time import sleep, time
 from glob import glob
 from random import randrange
 
-from Crypto.Hash import MD5
+from Crypto.Hash import MD4, MD5
 from Crypto.Random import get_random_bytes
 
-from briefcase import Briefcase
+from briefcase import Briefcase, isoDate
+from briefcase_daemon import BriefcaseServer, BriefcaseClient
+from briefcase_async import AsyncBriefcase, Cancelled
 
 #
 
@@ -60,6 +82,30 @@ def RandPassword():
 		pwd.append( chr(randrange(32, 126)) )
 	return ''.join(pwd)
 
+def OldBriefcase(database, files):
+	# Creates a briefcase file like the first versions of Briefcase : schema 0, without password,
+	# with dates like "2012-Mar-05". Files is a list of (file name, data, labels, date).
+	conn = sqlite3.connect(database)
+	conn.execute('create table _info_ (pwd BLOB, salt BLOB, date TEXT, user TEXT, version TEXT)')
+	conn.execute('create table _files_ (file TEXT unique, pwd BLOB, labels TEXT)')
+	conn.execute('create table _statistics_ (file TEXT unique, size0 INTEGER, size INTEGER, sizeB INTEGER, '\
+		'date0 TEXT, date TEXT, user0 TEXT, user TEXT, labels TEXT)')
+	conn.execute('create table _logs_ (date TEXT, msg TEXT)')
+	conn.execute('insert into _info_ (pwd, salt, date, user, version) values (?,?,?,?,?)',
+		['', '', '2012-Mar-05 10:00:00', 'user', '1.0'])
+	for fname, data, labels, date in files:
+		table = 't' + MD4.new(fname).hexdigest()
+		conn.execute('create table %s (version integer primary key asc, raw BLOB, hash TEXT, size INTEGER, '\
+			'date TEXT, user TEXT)' % table)
+		raw = buffer(zlib.compress(data, 9))
+		conn.execute('insert into %s (raw, hash, size, date, user) values (?,?,?,?,?)' % table,
+			[raw, MD4.new(data).hexdigest(), len(data), date, 'user'])
+		conn.execute('insert into _files_ (file, pwd, labels) values (?,?,?)', [fname, 1, labels])
+		conn.execute('insert into _statistics_ (file, size0, size, sizeB, date0, date, user0, user, labels) '\
+			'values (?,?,?,?,?,?,?,?,?)', [fname, len(data), len(data), len(raw), date, date, 'user', 'user', labels])
+	conn.commit()
+	conn.close()
+
 #
 TESTS = 10
 TEST_PASS = True
@@ -330,6 +376,1105 @@ print
 b.Cleanup()
 print
 
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #')
+print('Test:: backup, change and restore the briefcase, then backup incrementally.')
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #\n')
+
+
+try: os.remove('test_backup.prv')
+except: pass
+
+for i in range(TESTS):
+	short = 'file%i.rnd' % i
+	RandFile(os.getcwd()+'/temp_test/'+short)
+	b.AddFile(os.getcwd()+'/temp_test/'+short)
+
+if b.Backup('test_backup.prv') != 0:
+	print('This is wrong man, the backup failed!')
+	TEST_PASS = False
+
+# Change the briefcase, then restore the backup.
+for i in range(TESTS):
+	b.DelFile('file%i.rnd' % i)
+
+if b.Restore('test_backup.prv') != 0:
+	print('This is wrong man, the restore failed!')
+	TEST_PASS = False
+
+shutil.rmtree(os.getcwd()+'/temp_test_exp')
+os.mkdir(os.getcwd()+'/temp_test_exp')
+b.ExportAll(os.getcwd()+'/temp_test_exp')
+
+for i in range(TESTS):
+	short = 'file%i.rnd' % i
+	fname = os.getcwd()+'/temp_test/'+short
+	ename = os.getcwd()+'/temp_test_exp/'+short
+	if not os.path.exists(ename) or MD5.new(open(fname, 'rb').read()).digest() != MD5.new(open(ename, 'rb').read()).digest():
+		print('This is wrong man, file `%s` is not the same after backup/ restore!' % fname)
+		TEST_PASS = False
+
+# The incremental backup copies only the new version, and deletes the deleted file.
+RandFile(os.getcwd()+'/temp_test/file0.rnd', True)
+b.AddFile(os.getcwd()+'/temp_test/file0.rnd')
+b.DelFile('file1.rnd')
+if b.Backup('test_backup.prv', incremental=True) != 0:
+	print('This is wrong man, the incremental backup failed!')
+	TEST_PASS = False
+
+k = Briefcase('test_backup.prv', GLOB_PWD)
+k.verbose = 0
+if k.Info()['numberOfFiles'] != TESTS - 1 or k.FileStatistics('file0.rnd')['versions'] != 2:
+	print('This is wrong man, the incremental backup is not the same as the briefcase!')
+	TEST_PASS = False
+k.ExportFile('file0.rnd', path=os.getcwd()+'/temp_test_exp')
+if MD5.new(open(os.getcwd()+'/temp_test/file0.rnd', 'rb').read()).digest() != \
+	MD5.new(open(os.getcwd()+'/temp_test_exp/file0.rnd', 'rb').read()).digest():
+	print('This is wrong man, file `file0.rnd` is not the same after the incremental backup!')
+	TEST_PASS = False
+k.Close()
+del k
+
+for i in range(TESTS):
+	b.DelFile('file%i.rnd' % i)
+b.Cleanup()
+os.remove('test_backup.prv')
+
+if TEST_PASS:
+	print('Test Ok, next test...\n')
+else:
+	print('Test Failed, next test...\n')
+
+
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #')
+print('Test:: verify many briefcases with solid blocks, in one process, then corrupt one file.')
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #\n')
+
+
+for name in ['test2.prv', 'test3.prv']:
+	try: os.remove(name)
+	except: pass
+
+for i in range(TESTS):
+	RandFile(os.getcwd()+'/temp_test/file%i.rnd' % i)
+b.AddManyFiles(os.getcwd()+'/temp_test/file?.rnd', solid=True)
+
+# Two new briefcases, with other files in blocks with the same ids, checked in the same process.
+b2 = Briefcase('test2.prv', GLOB_PWD)
+b2.verbose = 0
+b2.AddManyFiles(os.getcwd()+'/temp_test/file?.rnd', solid=True)
+b3 = Briefcase('test3.prv', GLOB_PWD)
+b3.verbose = 0
+for i in range(TESTS):
+	RandFile(os.getcwd()+'/temp_test/file%i.rnd' % i)
+b3.AddManyFiles(os.getcwd()+'/temp_test/file?.rnd', solid=True)
+
+for bc in [b, b2, b3, b2]:
+	report = bc.Verify(workers=1)
+	if report['integrity'] != 'ok' or report['bad'] or report['checked'] != TESTS:
+		print('This is wrong man, the verify of `%s` failed! %s' % (bc.database, report))
+		TEST_PASS = False
+b3.Close()
+del b3
+os.remove('test3.prv')
+
+report = b2.Verify(workers=2)
+if report['bad'] or report['checked'] != TESTS:
+	print('This is wrong man, the verify with 2 processes failed! %s' % report)
+	TEST_PASS = False
+report = b2.Verify(sample=0.5, workers=1)
+if report['bad'] or report['checked'] != TESTS // 2 or report['skipped'] != TESTS - TESTS // 2:
+	print('This is wrong man, the verify of half the versions failed! %s' % report)
+	TEST_PASS = False
+if b2.Verify(sample=2) != -1 or b2.Verify(sample=-0.5) != -1 or b2.Verify(sample='all') != -1:
+	print('This is wrong man, the verify with a wrong sample must return -1!')
+	TEST_PASS = False
+
+# Change the hash of one version, so it doesn't match the data anymore.
+b2.c.execute('update %s set hash="0"' % b2.FileStatistics('file3.rnd')['internFileName'])
+b2._commit()
+report = b2.Verify(workers=1)
+if [r[:2] for r in report['bad']] != [('file3.rnd', 1)]:
+	print('This is wrong man, the verify didn\'t find the bad file! %s' % report)
+	TEST_PASS = False
+b2.Close()
+del b2
+os.remove('test2.prv')
+
+for i in range(TESTS):
+	b.DelFile('file%i.rnd' % i)
+b.Cleanup()
+
+if TEST_PASS:
+	print('Test Ok, next test...\n')
+else:
+	print('Test Failed, next test...\n')
+
+
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #')
+print('Test:: export the briefcase into zip and tar archives, then add the archives in new briefcases.')
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #\n')
+
+
+for i in range(TESTS):
+	RandFile(os.getcwd()+'/temp_test/file%i.rnd' % i)
+	b.AddFile(os.getcwd()+'/temp_test/file%i.rnd' % i)
+# One big file, restored and written into the archives in many parts.
+for i in range(99):
+	RandFile(os.getcwd()+'/temp_test/file.rnd', True)
+b.AddFile(os.getcwd()+'/temp_test/file.rnd')
+b.AddFile(os.getcwd()+'/temp_test/file.rnd', arch='bz2')
+
+for name in ['test.zip', 'test.tar.gz']:
+	if b.ExportArchive(name) != 0:
+		print('This is wrong man, the export into `%s` failed!' % name)
+		TEST_PASS = False
+		continue
+
+	try: os.remove('test2.prv')
+	except: pass
+	b2 = Briefcase('test2.prv', GLOB_PWD)
+	b2.verbose = 0
+	if b2.AddArchive(name) != 0 or b2.Info()['numberOfFiles'] != TESTS + 1:
+		print('This is wrong man, adding `%s` failed!' % name)
+		TEST_PASS = False
+
+	shutil.rmtree(os.getcwd()+'/temp_test_exp')
+	os.mkdir(os.getcwd()+'/temp_test_exp')
+	b2.ExportAll(os.getcwd()+'/temp_test_exp')
+	for short in ['file.rnd'] + ['file%i.rnd' % i for i in range(TESTS)]:
+		fname = os.getcwd()+'/temp_test/'+short
+		ename = os.getcwd()+'/temp_test_exp/'+short
+		if not os.path.exists(ename) or MD5.new(open(fname, 'rb').read()).digest() != MD5.new(open(ename, 'rb').read()).digest():
+			print('This is wrong man, file `%s` is not the same after `%s`!' % (fname, name))
+			TEST_PASS = False
+	b2.Close()
+	del b2
+	os.remove('test2.prv')
+	os.remove(name)
+
+b.DelFile('file.rnd')
+for i in range(TESTS):
+	b.DelFile('file%i.rnd' % i)
+b.Cleanup()
+
+if TEST_PASS:
+	print('Test Ok, next test...\n')
+else:
+	print('Test Failed, next test...\n')
+
+
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #')
+print('Test:: adding the same content with many names, then a different content with the same hash.')
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #\n')
+
+
+RandFile(os.getcwd()+'/temp_test/file0.rnd')
+data = open(os.getcwd()+'/temp_test/file0.rnd', 'rb').read()
+for i in range(1, TESTS):
+	open(os.getcwd()+'/temp_test/file%i.rnd' % i, 'wb').write(data)
+
+b.AddFile(os.getcwd()+'/temp_test/file0.rnd')
+b.AddManyFiles(os.getcwd()+'/temp_test/file?.rnd', solid=True)
+
+# All the names reference the same block.
+blocks = set()
+for i in range(TESTS):
+	table = b.FileStatistics('file%i.rnd' % i)['internFileName']
+	blocks.update([r[0] for r in b.c.execute('select block from %s' % table)])
+if len(blocks) != 1 or b.c.execute('select refs from _blocks_ where id=?', [blocks.pop()]).fetchone()[0] != TESTS:
+	print('This is wrong man, the same content is not stored only once!')
+	TEST_PASS = False
+
+# The same size and the same hash, but not the same data, must be stored again.
+b.c.execute('delete from _hashes_ where file!="file0.rnd"')
+new_data = data[:-1] + chr(ord(data[-1]) ^ 1)
+hash = b._hasher(new_data).hexdigest()
+b.c.execute('update _hashes_ set hash=?', [hash])
+b._commit()
+open(os.getcwd()+'/temp_test/file1.rnd', 'wb').write(new_data)
+open(os.getcwd()+'/temp_test/file2.rnd', 'wb').write(new_data)
+b.AddFile(os.getcwd()+'/temp_test/file1.rnd')
+b.AddManyFiles(os.getcwd()+'/temp_test/file2.rnd', solid=True)
+
+for i in range(TESTS):
+	short = 'file%i.rnd' % i
+	fname = os.getcwd()+'/temp_test/'+short
+	ename = os.getcwd()+'/temp_test_exp/'+short
+	b.ExportFile(short, path=os.getcwd()+'/temp_test_exp')
+	if MD5.new(open(fname, 'rb').read()).digest() != MD5.new(open(ename, 'rb').read()).digest():
+		print('This is wrong man, file `%s` is not the same after adding the same hash!' % fname)
+		TEST_PASS = False
+
+for i in range(TESTS):
+	b.DelFile('file%i.rnd' % i)
+b.Cleanup()
+
+if TEST_PASS:
+	print('Test Ok, next test...\n')
+else:
+	print('Test Failed, next test...\n')
+
+
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #')
+print('Test:: copy one version into many files, without copying the data, then delete them.')
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #\n')
+
+
+short = 'file0.rnd'
+for i in range(3):
+	RandFile(os.getcwd()+'/temp_test/'+short, True)
+	b.AddFile(os.getcwd()+'/temp_test/'+short)
+	if i == 1:
+		data = open(os.getcwd()+'/temp_test/'+short, 'rb').read()
+
+for i in range(1, TESTS):
+	b.CopyIntoNew(short, 2, 'file%i.rnd' % i)
+
+# The copies and the original version reference the same block.
+table = b.FileStatistics(short)['internFileName']
+block = b.c.execute('select block from %s where version=2' % table).fetchone()[0]
+refs = lambda: (b.c.execute('select refs from _blocks_ where id=?', [block]).fetchone() or [0])[0]
+if refs() != TESTS:
+	print('This is wrong man, the block of the version is referenced `%i` times, not `%i`!' % (refs(), TESTS))
+	TEST_PASS = False
+
+# The copies don't change when the original is deleted.
+b.DelFile(short)
+for i in range(1, TESTS):
+	short_clone = 'file%i.rnd' % i
+	ename = os.getcwd()+'/temp_test_exp/'+short_clone
+	b.ExportFile(short_clone, path=os.getcwd()+'/temp_test_exp')
+	if MD5.new(data).digest() != MD5.new(open(ename, 'rb').read()).digest():
+		print('This is wrong man, file `%s` is not the same after deleting the original!' % short_clone)
+		TEST_PASS = False
+	b.DelFile(short_clone)
+	if refs() != TESTS - 1 - i:
+		print('This is wrong man, the block is referenced `%i` times after deleting `%s`!' % (refs(), short_clone))
+		TEST_PASS = False
+
+# After the last copy, the block is deleted.
+if b.c.execute('select count(*) from _blocks_ where id=?', [block]).fetchone()[0]:
+	print('This is wrong man, the block is not deleted with the last copy!')
+	TEST_PASS = False
+b.Cleanup()
+
+if TEST_PASS:
+	print('Test Ok, next test...\n')
+else:
+	print('Test Failed, next test...\n')
+
+
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #')
+print('Test:: briefcase with packfiles, prune and compact the versions.')
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #\n')
+
+
+try: os.remove('test2.prv')
+except: pass
+for name in glob('test2.prv.*pack'):
+	os.remove(name)
+
+b2 = Briefcase('test2.prv', GLOB_PWD, packs=True)
+b2.verbose = 0
+short = 'file0.rnd'
+for i in range(TESTS):
+	RandFile(os.getcwd()+'/temp_test/'+short, True)
+	b2.AddFile(os.getcwd()+'/temp_test/'+short)
+if not glob('test2.prv.*pack') or b2.c.execute('select count(*) from _blocks_ where raw is not null').fetchone()[0]:
+	print('This is wrong man, the data is not stored in packfiles!')
+	TEST_PASS = False
+
+# The dry run counts the bytes of the blocks in packfiles, and doesn't delete anything.
+b2.SetRetention(keep_last=3)
+report = b2.Prune(dry_run=True)
+if report['versions'] != TESTS - 3 or not report['bytes'] or b2.FileStatistics(short)['versions'] != TESTS:
+	print('This is wrong man, the prune dry run is not correct! %s' % report)
+	TEST_PASS = False
+
+# Only the latest version fits in max_bytes.
+b2.SetRetention(keep_last=3, max_bytes=1)
+report = b2.Prune()
+if report['versions'] != TESTS - 1 or b2.FileStatistics(short)['versions'] != 1:
+	print('This is wrong man, the prune with max_bytes is not correct! %s' % report)
+	TEST_PASS = False
+
+b2.CompactPacks()
+fname = os.getcwd()+'/temp_test/'+short
+ename = os.getcwd()+'/temp_test_exp/'+short
+b2.ExportFile(short, path=os.getcwd()+'/temp_test_exp')
+if MD5.new(open(fname, 'rb').read()).digest() != MD5.new(open(ename, 'rb').read()).digest():
+	print('This is wrong man, file `%s` is not the same after prune and compact!' % fname)
+	TEST_PASS = False
+b2.Close()
+del b2
+
+os.remove('test2.prv')
+for name in glob('test2.prv.*pack'):
+	os.remove(name)
+
+if TEST_PASS:
+	print('Test Ok, next test...\n')
+else:
+	print('Test Failed, next test...\n')
+
+
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #')
+print('Test:: two briefcases with the same name, with packfiles in the same volume folder.')
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #\n')
+
+
+vol = os.getcwd()+'/temp_test_vol'
+other = os.getcwd()+'/temp_test_other'
+for folder in [vol, other]:
+	try: shutil.rmtree(folder)
+	except: pass
+os.mkdir(other)
+try: os.remove('test2.prv')
+except: pass
+
+bcs = [Briefcase('test2.prv', GLOB_PWD, volumes=[vol], volume_size=4096),
+	Briefcase(other+'/test2.prv', GLOB_PWD, volumes=[vol], volume_size=4096)]
+for j, bc in enumerate(bcs):
+	bc.verbose = 0
+	for i in range(TESTS):
+		RandFile(os.getcwd()+'/temp_test/file%i_%i.rnd' % (j, i))
+		bc.AddFile(os.getcwd()+'/temp_test/file%i_%i.rnd' % (j, i))
+
+# Deleting the files of the first briefcase and compacting its packfiles doesn't touch the second one.
+for i in range(TESTS // 2):
+	bcs[0].DelFile('file0_%i.rnd' % i)
+bcs[0].Cleanup()
+
+for j, bc in enumerate(bcs):
+	shutil.rmtree(os.getcwd()+'/temp_test_exp')
+	os.mkdir(os.getcwd()+'/temp_test_exp')
+	bc.ExportAll(os.getcwd()+'/temp_test_exp')
+	for i in range(j == 0 and TESTS // 2 or 0, TESTS):
+		short = 'file%i_%i.rnd' % (j, i)
+		fname = os.getcwd()+'/temp_test/'+short
+		ename = os.getcwd()+'/temp_test_exp/'+short
+		if not os.path.exists(ename) or MD5.new(open(fname, 'rb').read()).digest() != MD5.new(open(ename, 'rb').read()).digest():
+			print('This is wrong man, file `%s` is not the same with a shared volume!' % fname)
+			TEST_PASS = False
+	report = bc.Verify(workers=1)
+	if report['bad'] or report['checked'] != (j == 0 and TESTS - TESTS // 2 or TESTS):
+		print('This is wrong man, the verify of `%s` failed! %s' % (bc.database, report))
+		TEST_PASS = False
+	bc.Close()
+del bcs, bc
+
+os.remove('test2.prv')
+shutil.rmtree(vol)
+shutil.rmtree(other)
+
+if TEST_PASS:
+	print('Test Ok, next test...\n')
+else:
+	print('Test Failed, next test...\n')
+
+
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #')
+print('Test:: briefcase daemon, serving one briefcase over a Unix socket.')
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #\n')
+
+
+try: os.remove('test2.prv')
+except: pass
+address = tempfile.gettempdir() + '/briefcase_test_%i.sock' % os.getpid()
+server = BriefcaseServer('test2.prv', GLOB_PWD, address, verbose=0)
+t = threading.Thread(target=server.serve_forever)
+t.start()
+for i in range(100):
+	if os.path.exists(address):
+		break
+	sleep(0.05)
+
+client = BriefcaseClient('test2.prv', address)
+RandFile(os.getcwd()+'/temp_test/file0.rnd')
+if client.AddFile(os.getcwd()+'/temp_test/file0.rnd') != 0 or client.GetFileList() != ['file0.rnd']:
+	print('This is wrong man, the daemon didn\'t add the file!')
+	TEST_PASS = False
+
+shutil.rmtree(os.getcwd()+'/temp_test_exp')
+os.mkdir(os.getcwd()+'/temp_test_exp')
+client.ExportFile('file0.rnd', path=os.getcwd()+'/temp_test_exp')
+if MD5.new(open(os.getcwd()+'/temp_test/file0.rnd', 'rb').read()).digest() != \
+	MD5.new(open(os.getcwd()+'/temp_test_exp/file0.rnd', 'rb').read()).digest():
+	print('This is wrong man, file `file0.rnd` is not the same after the daemon export!')
+	TEST_PASS = False
+
+# An unknown operation is an error, and the daemon continues to work.
+try:
+	client._call(99)
+	print('This is wrong man, the daemon accepted an unknown operation!')
+	TEST_PASS = False
+except Exception, e:
+	if 'Unknown operation' not in str(e):
+		print('This is wrong man, the daemon returned `%s` for an unknown operation!' % e)
+		TEST_PASS = False
+if client.FileStatistics('file0.rnd')['versions'] != 1:
+	print('This is wrong man, the daemon doesn\'t work after an error!')
+	TEST_PASS = False
+
+client.Shutdown()
+t.join(10)
+if t.isAlive() or os.path.exists(address):
+	print('This is wrong man, the daemon didn\'t stop!')
+	TEST_PASS = False
+server.b.Close()
+del server, client
+os.remove('test2.prv')
+
+if TEST_PASS:
+	print('Test Ok, next test...\n')
+else:
+	print('Test Failed, next test...\n')
+
+
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #')
+print('Test:: background operations with AsyncBriefcase, progress and cancel.')
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #\n')
+
+
+try: os.remove('test2.prv')
+except: pass
+a = AsyncBriefcase('test2.prv', GLOB_PWD, workers=2)
+a._b.verbose = 0
+for i in range(TESTS):
+	RandFile(os.getcwd()+'/temp_test/file%i.rnd' % i)
+
+job = a.AddManyFiles(os.getcwd()+'/temp_test/file?.rnd')
+steps = list(job.progress())
+if job.result() != 0 or [s[:2] for s in steps] != [(i+1, TESTS) for i in range(TESTS)]:
+	print('This is wrong man, the progress of AddManyFiles is not correct! %s' % steps)
+	TEST_PASS = False
+if len(a.GetFileList().result()) != TESTS:
+	print('This is wrong man, AddManyFiles didn\'t add all the files!')
+	TEST_PASS = False
+
+shutil.rmtree(os.getcwd()+'/temp_test_exp')
+os.mkdir(os.getcwd()+'/temp_test_exp')
+if a.ExportAll(os.getcwd()+'/temp_test_exp').result() != 0:
+	print('This is wrong man, ExportAll failed!')
+	TEST_PASS = False
+for i in range(TESTS):
+	short = 'file%i.rnd' % i
+	fname = os.getcwd()+'/temp_test/'+short
+	ename = os.getcwd()+'/temp_test_exp/'+short
+	if not os.path.exists(ename) or MD5.new(open(fname, 'rb').read()).digest() != MD5.new(open(ename, 'rb').read()).digest():
+		print('This is wrong man, file `%s` is not the same after the async export!' % fname)
+		TEST_PASS = False
+
+# The cancelled jobs raise Cancelled, and nothing is added. The SQLite thread waits,
+# so the jobs are cancelled before they start.
+for i in range(TESTS):
+	RandFile(os.getcwd()+'/temp_test/file%i.rnd' % i, True)
+gate = threading.Event()
+a._sqlite.submit(gate.wait)
+jobs = [a.AddManyFiles(os.getcwd()+'/temp_test/file?.rnd'), a.Cleanup()]
+for job in jobs:
+	job.cancel()
+gate.set()
+for job in jobs:
+	try:
+		job.result()
+		print('This is wrong man, the cancelled job didn\'t raise Cancelled!')
+		TEST_PASS = False
+	except Cancelled:
+		pass
+if a.FileStatistics('file0.rnd').result()['versions'] != 1:
+	print('This is wrong man, the cancelled job added files!')
+	TEST_PASS = False
+
+# Cleanup cancelled while it runs : the first file statistics waits until the job is cancelled.
+started, go = threading.Event(), threading.Event()
+stats = a._b.FileStatistics
+def slow_stats(fname):
+	started.set()
+	go.wait()
+	return stats(fname)
+a._b.FileStatistics = slow_stats
+job = a.Cleanup()
+started.wait()
+job.cancel()
+go.set()
+try:
+	job.result()
+	print('This is wrong man, the cancelled Cleanup didn\'t raise Cancelled!')
+	TEST_PASS = False
+except Cancelled:
+	pass
+del a._b.FileStatistics
+
+a.close()
+del a
+os.remove('test2.prv')
+
+if TEST_PASS:
+	print('Test Ok, next test...\n')
+else:
+	print('Test Failed, next test...\n')
+
+
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #')
+print('Test:: labels, filter files by labels, then upgrade the labels of an old briefcase.')
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #\n')
+
+
+try: os.remove('test2.prv')
+except: pass
+b2 = Briefcase('test2.prv', GLOB_PWD)
+b2.verbose = 0
+for i in range(TESTS):
+	RandFile(os.getcwd()+'/temp_test/file%i.rnd' % i)
+	b2.AddFile(os.getcwd()+'/temp_test/file%i.rnd' % i, labels=(i % 2 and 'odd' or 'even'))
+	if i % 3 == 0:
+		b2.SetLabels('file%i.rnd' % i, [i % 2 and 'odd' or 'even', 'three'])
+
+odd = ['file%i.rnd' % i for i in range(TESTS) if i % 2]
+three = ['file%i.rnd' % i for i in range(TESTS) if i % 3 == 0]
+if b2.GetFilesByLabels('odd') != odd or b2.GetFilesByLabels('odd;three') != [f for f in odd if f in three]:
+	print('This is wrong man, GetFilesByLabels returned the wrong files!')
+	TEST_PASS = False
+if b2.GetFilesByLabels(['odd', 'three'], match='any') != sorted(set(odd + three)):
+	print('This is wrong man, GetFilesByLabels with match "any" returned the wrong files!')
+	TEST_PASS = False
+if b2.GetLabelCounts() != {'odd': len(odd), 'even': TESTS - len(odd), 'three': len(three)}:
+	print('This is wrong man, the label counts are not correct! %s' % b2.GetLabelCounts())
+	TEST_PASS = False
+if b2.GetFilesByLabels('') != -1 or b2.GetFilesByLabels('odd', match='some') != -1 or b2.SetLabels('file0.rnd', 1) != -1:
+	print('This is wrong man, the wrong labels must return -1!')
+	TEST_PASS = False
+
+# Removing the labels of many files at once, and setting labels for a missing file.
+b2.SetLabels(three, '')
+if b2.GetFilesByLabels('three') != [] or 'three' in b2.GetLabelCounts() or b2.FileStatistics('file0.rnd')['labels']:
+	print('This is wrong man, the labels were not removed!')
+	TEST_PASS = False
+if b2.SetLabels('missing.rnd', 'odd') != -1:
+	print('This is wrong man, SetLabels for a missing file must return -1!')
+	TEST_PASS = False
+
+# Cleanup deletes the labels without files, in _labels_.
+b2.Cleanup()
+if b2.c.execute('select label from _labels_ order by label').fetchall() != [('even',), ('odd',)]:
+	print('This is wrong man, Cleanup didn\'t delete the unused labels!')
+	TEST_PASS = False
+b2.Close()
+del b2
+os.remove('test2.prv')
+
+# The old briefcase files keep the labels in a text column of _files_ ; they are copied into
+# _labels_ and _file_labels_ when the file is opened.
+OldBriefcase('test2.prv', [('a.txt', 'a' * 500, 'red;blue', '2012-Mar-05 10:00:00'),
+	('b.txt', 'b' * 500, 'blue', '2012-Dec-01 10:00:00'), ('c.txt', 'c' * 500, '', '2013-Jan-01 10:00:00')])
+b2 = Briefcase('test2.prv', '')
+b2.verbose = 0
+if b2.GetFilesByLabels('blue') != ['a.txt', 'b.txt'] or b2.GetFilesByLabels('red;blue') != ['a.txt'] or \
+	b2.GetLabelCounts() != {'red': 1, 'blue': 2}:
+	print('This is wrong man, the labels of the old briefcase were not upgraded!')
+	TEST_PASS = False
+b2.SetLabels('c.txt', 'red')
+if b2.GetFilesByLabels('red') != ['a.txt', 'c.txt']:
+	print('This is wrong man, the labels of the upgraded briefcase cannot be changed!')
+	TEST_PASS = False
+b2.Close()
+del b2
+os.remove('test2.prv')
+
+if TEST_PASS:
+	print('Test Ok, next test...\n')
+else:
+	print('Test Failed, next test...\n')
+
+
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #')
+print('Test:: list files with structured filters, sort and pages.')
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #\n')
+
+
+try: os.remove('test2.prv')
+except: pass
+b2 = Briefcase('test2.prv', GLOB_PWD)
+b2.verbose = 0
+# File i has 100 * (i+1) bytes ; the names with quotes and percents must be used as plain values.
+names = ['file%i.rnd' % i for i in range(TESTS - 2)] + ['it\'s.rnd', '100%.rnd']
+for i, short in enumerate(names):
+	open(os.getcwd()+'/temp_test/'+short, 'wb').write(get_random_bytes(100 * (i+1)))
+	b2.AddFile(os.getcwd()+'/temp_test/'+short, labels=(i % 2 and 'odd' or 'even'))
+
+by_size = list(reversed(names))
+if b2.GetFileList(ssort='size desc') != by_size:
+	print('This is wrong man, the files are not sorted by size!')
+	TEST_PASS = False
+if b2.GetFileList(ffilter=('file', '=', 'it\'s.rnd')) != ['it\'s.rnd'] or \
+	b2.GetFileList(ffilter=('file', 'like', '%\'%')) != ['it\'s.rnd'] or \
+	b2.GetFileList(ffilter=('file', 'in', ['100%.rnd', 'file0.rnd'])) != ['100%.rnd', 'file0.rnd']:
+	print('This is wrong man, the filter values with quotes or percents are not correct!')
+	TEST_PASS = False
+big = [names[i] for i in range(TESTS) if 100 * (i+1) > 500 and i % 2]
+if b2.GetFileList(ffilter=('and', ('size', '>', 500), ('labels', 'has', 'odd'))) != sorted(big) or \
+	b2.GetFileList(ffilter=[('size', '>', 500), ('not', ('labels', 'has', 'even'))]) != sorted(big):
+	print('This is wrong man, the structured filter returned the wrong files!')
+	TEST_PASS = False
+if b2.GetFileList(ffilter=('or', ('size', 'between', (100, 200)), ('labels', 'in', 'nothing;odd'))) != \
+	sorted(set(names[:2] + [names[i] for i in range(TESTS) if i % 2])):
+	print('This is wrong man, the "or" filter returned the wrong files!')
+	TEST_PASS = False
+if b2.GetFileList(ffilter=('size', 'has', 1)) != -1 or b2.GetFileList(ffilter=('pwd', '=', 1)) != -1 or \
+	b2.GetFileList(ssort='labels') != -1 or b2.GetFileList(ssort='size', after='missing.rnd') != -1:
+	print('This is wrong man, the wrong filters must return -1!')
+	TEST_PASS = False
+
+# The pages with offset and the pages after the last file are the same.
+pages, last = [], None
+while True:
+	page = b2.GetFileList(ssort='size desc', limit=3, after=last)
+	if not page:
+		break
+	if page != b2.GetFileList(ssort='size desc', limit=3, offset=len(pages) * 3):
+		print('This is wrong man, the page after `%s` is not the same with offset!' % last)
+		TEST_PASS = False
+	pages.append(page)
+	last = page[-1]
+if sum(pages, []) != by_size or len(pages) != (TESTS + 2) // 3:
+	print('This is wrong man, the pages don\'t contain all the files! %s' % pages)
+	TEST_PASS = False
+b2.Close()
+del b2
+os.remove('test2.prv')
+
+if TEST_PASS:
+	print('Test Ok, next test...\n')
+else:
+	print('Test Failed, next test...\n')
+
+
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #')
+print('Test:: upgrade the dates of an old briefcase, then search the versions between two dates.')
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #\n')
+
+
+if isoDate('2012-Mar-05 10:20:30') != '2012-03-05 10:20:30' or isoDate('2012-Dec-31') != '2012-12-31' or \
+	isoDate('2012-03-05 10:20:30') != '2012-03-05 10:20:30' or isoDate(None) is not None:
+	print('This is wrong man, isoDate is not correct!')
+	TEST_PASS = False
+
+try: os.remove('test2.prv')
+except: pass
+# With the old dates, "Dec" sorts before "Mar" ; after the upgrade, the order is correct.
+OldBriefcase('test2.prv', [('a.txt', 'a' * 500, '', '2012-Mar-05 10:00:00'),
+	('b.txt', 'b' * 500, '', '2012-Dec-01 10:00:00'), ('c.txt', 'c' * 500, '', '2013-Jan-01 10:00:00')])
+b2 = Briefcase('test2.prv', '')
+b2.verbose = 0
+dates = [b2.c.execute('select date from %s' % b2._table(f)).fetchone()[0] for f in ['a.txt', 'b.txt', 'c.txt']]
+if dates != ['2012-03-05 10:00:00', '2012-12-01 10:00:00', '2013-01-01 10:00:00'] or \
+	b2.c.execute('select date from _info_').fetchone()[0] != '2012-03-05 10:00:00':
+	print('This is wrong man, the dates of the old briefcase were not upgraded! %s' % dates)
+	TEST_PASS = False
+if b2.GetFileList(ssort='date desc') != ['c.txt', 'b.txt', 'a.txt']:
+	print('This is wrong man, the upgraded dates are not sorted!')
+	TEST_PASS = False
+
+# The old dates are accepted as arguments too.
+if b2.GetFilesChanged('2012-Apr-01') != ['b.txt', 'c.txt'] or \
+	b2.GetFilesChanged('2012-03-01', '2012-12-31') != ['a.txt', 'b.txt']:
+	print('This is wrong man, GetFilesChanged returned the wrong files!')
+	TEST_PASS = False
+
+# A new version of a.txt, added now.
+now = time()
+open(os.getcwd()+'/temp_test/a.txt', 'wb').write('a' * 600)
+b2.AddFile(os.getcwd()+'/temp_test/a.txt')
+if b2.GetFilesChanged(now - 60) != ['a.txt'] or b2.GetFilesChanged(now - 60, now - 30) != []:
+	print('This is wrong man, GetFilesChanged didn\'t find the new version!')
+	TEST_PASS = False
+versions = b2.GetVersionsBetween('2012-01-01', fname='a.txt')
+if [v[1:4:2] for v in versions] != [(1, 500), (2, 600)] or versions[0][4] != '2012-03-05 10:00:00':
+	print('This is wrong man, GetVersionsBetween returned the wrong versions of a.txt! %s' % versions)
+	TEST_PASS = False
+if [v[:2] for v in b2.GetVersionsBetween('2012-06-01', '2012-12-31')] != [('b.txt', 1)] or \
+	[v[:2] for v in b2.GetVersionsBetween(now - 60)] != [('a.txt', 2)]:
+	print('This is wrong man, GetVersionsBetween returned the wrong versions!')
+	TEST_PASS = False
+if b2.GetVersionsBetween('2012-01-01', fname='missing.txt') != -1:
+	print('This is wrong man, GetVersionsBetween for a missing file must return -1!')
+	TEST_PASS = False
+b2.Close()
+del b2
+os.remove('test2.prv')
+
+if TEST_PASS:
+	print('Test Ok, next test...\n')
+else:
+	print('Test Failed, next test...\n')
+
+
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #')
+print('Test:: sync out the briefcase into a folder, then sync again after changes.')
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #\n')
+
+
+try: os.remove('test2.prv')
+except: pass
+b2 = Briefcase('test2.prv', GLOB_PWD)
+b2.verbose = 0
+for i in range(TESTS):
+	RandFile(os.getcwd()+'/temp_test/file%i.rnd' % i)
+	b2.AddFile(os.getcwd()+'/temp_test/file%i.rnd' % i)
+# This file uses another password, so it's never exported.
+RandFile(os.getcwd()+'/temp_test/other.rnd')
+b2.AddFile(os.getcwd()+'/temp_test/other.rnd', password=RandPassword())
+
+def CheckSync(msg):
+	# All the files are the same in the folder, and the other file is not exported.
+	global TEST_PASS
+	for short in os.listdir(os.getcwd()+'/temp_test'):
+		fname = os.getcwd()+'/temp_test/'+short
+		ename = os.getcwd()+'/temp_test_exp/'+short
+		if short == 'other.rnd' or not b2.GetFileList(ffilter=('file', '=', short)):
+			continue
+		if not os.path.exists(ename) or MD5.new(open(fname, 'rb').read()).digest() != MD5.new(open(ename, 'rb').read()).digest():
+			print('This is wrong man, file `%s` is not the same %s!' % (fname, msg))
+			TEST_PASS = False
+	if os.path.exists(os.getcwd()+'/temp_test_exp/other.rnd'):
+		print('This is wrong man, the file with another password was exported %s!' % msg)
+		TEST_PASS = False
+
+shutil.rmtree(os.getcwd()+'/temp_test_exp')
+os.mkdir(os.getcwd()+'/temp_test_exp')
+steps = []
+if b2.SyncOut(os.getcwd()+'/temp_test_exp', progress=lambda *a: steps.append(a)) != 0 or len(steps) != TESTS:
+	print('This is wrong man, the first SyncOut didn\'t export all the files!')
+	TEST_PASS = False
+CheckSync('after the first sync')
+if not b2.c.execute('select msg from _logs_ where msg like "Func SyncOut: Password for file %other.rnd%"').fetchone():
+	print('This is wrong man, the skipped file is not logged by SyncOut!')
+	TEST_PASS = False
+
+# Nothing changed : nothing is exported again.
+mtimes = dict([(f, os.path.getmtime(os.getcwd()+'/temp_test_exp/'+f)) for f in os.listdir(os.getcwd()+'/temp_test_exp')])
+sleep(1.1)
+steps = []
+b2.SyncOut(os.getcwd()+'/temp_test_exp', progress=lambda *a: steps.append(a))
+if steps or [f for f in mtimes if os.path.getmtime(os.getcwd()+'/temp_test_exp/'+f) != mtimes[f]]:
+	print('This is wrong man, SyncOut exported the unchanged files! %s' % steps)
+	TEST_PASS = False
+
+# One new version, one file changed in the folder, one file deleted from the briefcase.
+RandFile(os.getcwd()+'/temp_test/file1.rnd', True)
+b2.AddFile(os.getcwd()+'/temp_test/file1.rnd')
+open(os.getcwd()+'/temp_test_exp/file2.rnd', 'ab').write('changed')
+b2.DelFile('file3.rnd')
+steps = []
+b2.SyncOut(os.getcwd()+'/temp_test_exp', delete=True, progress=lambda *a: steps.append(a))
+if len(steps) != 2 or os.path.exists(os.getcwd()+'/temp_test_exp/file3.rnd'):
+	print('This is wrong man, the second SyncOut didn\'t export only the changed files! %s' % steps)
+	TEST_PASS = False
+if [f for f in mtimes if f not in ['file1.rnd', 'file2.rnd', 'file3.rnd'] and \
+	os.path.getmtime(os.getcwd()+'/temp_test_exp/'+f) != mtimes[f]]:
+	print('This is wrong man, the second SyncOut rewrote the unchanged files!')
+	TEST_PASS = False
+CheckSync('after the second sync')
+b2.Close()
+del b2
+os.remove('test2.prv')
+os.remove(os.getcwd()+'/temp_test/other.rnd')
+
+if TEST_PASS:
+	print('Test Ok, next test...\n')
+else:
+	print('Test Failed, next test...\n')
+
+
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #')
+print('Test:: sync in a folder tree, then sync again after changing one file.')
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #\n')
+
+
+sync = os.getcwd()+'/temp_test_sync'
+try: shutil.rmtree(sync)
+except: pass
+os.makedirs(sync+'/docs/old')
+try: os.remove('test2.prv')
+except: pass
+b2 = Briefcase('test2.prv', GLOB_PWD)
+b2.verbose = 0
+names = []
+for i in range(TESTS):
+	folder = ['', 'docs/', 'docs/old/'][i % 3]
+	RandFile(sync+'/'+folder+'file%i.rnd' % i)
+	names.append(folder.replace('/', '~')+'file%i.rnd' % i)
+
+steps = []
+if b2.SyncIn(sync, progress=lambda *a: steps.append(a)) != 0 or len(steps) != TESTS:
+	print('This is wrong man, the first SyncIn didn\'t check all the files!')
+	TEST_PASS = False
+if b2.GetFileList() != sorted(names):
+	print('This is wrong man, SyncIn didn\'t add all the files! %s' % b2.GetFileList())
+	TEST_PASS = False
+
+# Nothing changed : no file is checked again.
+steps = []
+b2.SyncIn(sync, progress=lambda *a: steps.append(a))
+if steps:
+	print('This is wrong man, the second SyncIn checked the unchanged files! %s' % steps)
+	TEST_PASS = False
+
+# One file changed, and one file touched without changes : only the changed file gets a new version.
+RandFile(sync+'/docs/file1.rnd', True)
+os.utime(sync+'/docs/old/file2.rnd', (time() + 10, time() + 10))
+steps = []
+b2.SyncIn(sync, progress=lambda *a: steps.append(a))
+if len(steps) != 2:
+	print('This is wrong man, the third SyncIn didn\'t check only the changed files! %s' % steps)
+	TEST_PASS = False
+for short in names:
+	versions = b2.FileStatistics(short)['versions']
+	if versions != (short == 'docs~file1.rnd' and 2 or 1):
+		print('This is wrong man, file `%s` has %i versions after the sync!' % (short, versions))
+		TEST_PASS = False
+
+shutil.rmtree(os.getcwd()+'/temp_test_exp')
+os.mkdir(os.getcwd()+'/temp_test_exp')
+b2.ExportAll(os.getcwd()+'/temp_test_exp')
+for short in names:
+	fname = sync+'/'+short.replace('~', '/')
+	ename = os.getcwd()+'/temp_test_exp/'+short
+	if not os.path.exists(ename) or MD5.new(open(fname, 'rb').read()).digest() != MD5.new(open(ename, 'rb').read()).digest():
+		print('This is wrong man, file `%s` is not the same after the sync!' % fname)
+		TEST_PASS = False
+b2.Close()
+del b2
+os.remove('test2.prv')
+shutil.rmtree(sync)
+
+if TEST_PASS:
+	print('Test Ok, next test...\n')
+else:
+	print('Test Failed, next test...\n')
+
+
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #')
+print('Test:: readonly briefcase, and a second writer waiting for the first one.')
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #\n')
+
+
+try: os.remove('test2.prv')
+except: pass
+b2 = Briefcase('test2.prv', GLOB_PWD)
+b2.verbose = 0
+for i in range(TESTS):
+	RandFile(os.getcwd()+'/temp_test/file%i.rnd' % i)
+	b2.AddFile(os.getcwd()+'/temp_test/file%i.rnd' % i)
+b2.Close()
+del b2
+check = sqlite3.connect('test2.prv')
+logs = check.execute('select count(*) from _logs_').fetchone()[0]
+
+# The readonly briefcase can read, but it never writes, not even logs.
+r = Briefcase('test2.prv', GLOB_PWD, readonly=True)
+r.verbose = 0
+if r.GetFileList() != ['file%i.rnd' % i for i in range(TESTS)] or r.FileStatistics('file0.rnd')['versions'] != 1:
+	print('This is wrong man, the readonly briefcase cannot read the files!')
+	TEST_PASS = False
+RandFile(os.getcwd()+'/temp_test/file%i.rnd' % TESTS)
+try:
+	r.AddFile(os.getcwd()+'/temp_test/file%i.rnd' % TESTS)
+	print('This is wrong man, the readonly briefcase added a file!')
+	TEST_PASS = False
+except sqlite3.OperationalError:
+	pass
+r.Close()
+if check.execute('select count(*) from _logs_').fetchone()[0] != logs or \
+	check.execute('select count(*) from _files_').fetchone()[0] != TESTS:
+	print('This is wrong man, the readonly briefcase wrote in the briefcase file!')
+	TEST_PASS = False
+
+# Another program holds the write lock for a while : the readers don't wait, and the second
+# writer waits for the busy timeout, then retries until the lock is released.
+w = Briefcase('test2.prv', GLOB_PWD, timeout=0.1)
+w.verbose = 0
+lock = sqlite3.connect('test2.prv', isolation_level=None, check_same_thread=False)
+lock.execute('begin immediate')
+r = Briefcase('test2.prv', GLOB_PWD, readonly=True)
+r.verbose = 0
+shutil.rmtree(os.getcwd()+'/temp_test_exp')
+os.mkdir(os.getcwd()+'/temp_test_exp')
+if r.ExportFile('file0.rnd', path=os.getcwd()+'/temp_test_exp') == -1:
+	print('This is wrong man, the readonly briefcase waited for the writer!')
+	TEST_PASS = False
+r.Close()
+t = threading.Timer(0.5, lock.execute, ['commit'])
+t.start()
+ti = time()
+if w.AddFile(os.getcwd()+'/temp_test/file%i.rnd' % TESTS) != 0 or time() - ti < 0.4:
+	print('This is wrong man, the second writer didn\'t wait for the first one!')
+	TEST_PASS = False
+t.join()
+lock.close()
+if check.execute('select count(*) from _files_').fetchone()[0] != TESTS + 1:
+	print('This is wrong man, the file added by the second writer is missing!')
+	TEST_PASS = False
+w.Close()
+check.close()
+del r, w
+os.remove('test2.prv')
+os.remove(os.getcwd()+'/temp_test/file%i.rnd' % TESTS)
+
+if TEST_PASS:
+	print('Test Ok, next test...\n')
+else:
+	print('Test Failed, next test...\n')
+
+
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #')
+print('Test:: train a compression dictionary, then add and export files compressed with it.')
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #\n')
+
+
+def ConfigFile(fname):
+	# Small text files that are a little different, like configuration files.
+	lines = ['[service]', 'name = svc%i' % randrange(999), 'endpoint = https://api.example.com/v2/resource/%i' % randrange(999),
+		'timeout = %i' % randrange(1, 99), 'retries = 3', 'log_level = %s' % ['debug', 'info', 'warning'][randrange(3)],
+		'[features]', 'compression = true', 'encryption = %s' % ['true', 'false'][randrange(2)], 'cache_size_megabytes = 128']
+	open(fname, 'wb').write('\n'.join(lines * randrange(1, 4)))
+
+try: os.remove('test2.prv')
+except: pass
+b2 = Briefcase('test2.prv', GLOB_PWD)
+b2.verbose = 0
+if b2.TrainDictionary() != -1:
+	print('This is wrong man, a dictionary was trained without files!')
+	TEST_PASS = False
+for i in range(TESTS * 3):
+	ConfigFile(os.getcwd()+'/temp_test/train%i.cfg' % i)
+	b2.AddFile(os.getcwd()+'/temp_test/train%i.cfg' % i)
+dict_id = b2.TrainDictionary()
+if dict_id == -1:
+	print('This is wrong man, the dictionary was not trained!')
+	TEST_PASS = False
+
+# The new small files use the dictionary, with any password.
+other = RandPassword()
+passwords = {}
+for i in range(TESTS):
+	short = 'file%i.cfg' % i
+	passwords[short] = [1, other, None][i % 3]
+	ConfigFile(os.getcwd()+'/temp_test/'+short)
+	b2.AddFile(os.getcwd()+'/temp_test/'+short, password=passwords[short])
+	used = b2.c.execute('select b.dict from %s v join _blocks_ b on b.id = v.block' % b2._table(short)).fetchone()[0]
+	if used != dict_id:
+		print('This is wrong man, file `%s` was not compressed with the dictionary!' % short)
+		TEST_PASS = False
+
+shutil.rmtree(os.getcwd()+'/temp_test_exp')
+os.mkdir(os.getcwd()+'/temp_test_exp')
+for short, password in passwords.items():
+	fname = os.getcwd()+'/temp_test/'+short
+	ename = os.getcwd()+'/temp_test_exp/'+short
+	b2.ExportFile(short, password=password, path=os.getcwd()+'/temp_test_exp')
+	if not os.path.exists(ename) or MD5.new(open(fname, 'rb').read()).digest() != MD5.new(open(ename, 'rb').read()).digest():
+		print('This is wrong man, file `%s` is not the same after the dictionary compression!' % fname)
+		TEST_PASS = False
+
+for password, checked in [(1, TESTS * 3 + len([p for p in passwords.values() if p == 1])),
+	(other, len([p for p in passwords.values() if p == other])), (None, len([p for p in passwords.values() if p is None]))]:
+	report = b2.Verify(password=password, workers=1)
+	if report['bad'] or report['checked'] != checked:
+		print('This is wrong man, the verify of the files compressed with the dictionary failed! %s' % report)
+		TEST_PASS = False
+b2.Close()
+del b2
+os.remove('test2.prv')
+for f in glob(os.getcwd()+'/temp_test/*.cfg'):
+	os.remove(f)
+
+if TEST_PASS:
+	print('Test Ok, next test...\n')
+else:
+	print('Test Failed, next test...\n')
+
+
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #')
+print('Test:: add a zip archive made by another program, with deflated and stored members.')
+print('# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #\n')
+
+
+zpath = os.getcwd()+'/temp_test_exp/other.zip'
+members = {}
+zf = zipfile.ZipFile(zpath, 'w')
+for i in range(TESTS):
+	path = ['', 'docs/', 'docs/old/'][i % 3] + 'file%i.rnd' % i
+	RandFile(os.getcwd()+'/temp_test/file%i.rnd' % i)
+	members[path] = open(os.getcwd()+'/temp_test/file%i.rnd' % i, 'rb').read()
+	info = zipfile.ZipInfo(path)
+	info.compress_type = [zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED][i % 2]
+	zf.writestr(info, members[path])
+zf.close()
+
+def Deflated(path):
+	# The compressed data of one member, after its local header.
+	info = zipfile.ZipFile(zpath).getinfo(path)
+	f = open(zpath, 'rb')
+	f.seek(info.header_offset + 26)
+	skip = struct.unpack('<2H', f.read(4))
+	f.seek(sum(skip), 1)
+	data = f.read(info.compress_size)
+	f.close()
+	return info.compress_type == zipfile.ZIP_DEFLATED and data or None
+
+for password in [None, 1]:
+	try: os.remove('test2.prv')
+	except: pass
+	b2 = Briefcase('test2.prv', GLOB_PWD)
+	b2.verbose = 0
+	steps = []
+	if b2.AddArchive(zpath, password=password, labels='zip', path_labels=True, progress=lambda *a: steps.append(a)) != 0 or \
+		[s[:2] for s in steps] != [(i+1, TESTS) for i in range(TESTS)]:
+		print('This is wrong man, AddArchive failed! %s' % steps)
+		TEST_PASS = False
+	names = sorted([p.replace('/', '~') for p in members])
+	if b2.GetFileList() != names or b2.GetFilesByLabels('zip') != names or \
+		b2.GetFilesByLabels('docs') != sorted([n for n in names if n.startswith('docs~')]) or \
+		b2.GetFilesByLabels('docs;old') != sorted([n for n in names if n.startswith('docs~old~')]):
+		print('This is wrong man, the files or the path labels of the zip archive are not correct!')
+		TEST_PASS = False
+
+	# Without password, the deflated members are stored as they are in the archive, in a zlib stream.
+	for path, data in members.items():
+		deflated = Deflated(path)
+		raw = str(b2._versionRaw(b2._table(path.replace('/', '~')))[0])
+		if not password and deflated is not None and raw[2:-4] != deflated:
+			print('This is wrong man, member `%s` was compressed again!' % path)
+			TEST_PASS = False
+		if not password and zlib.decompress(raw) != data:
+			print('This is wrong man, member `%s` is not stored correctly!' % path)
+			TEST_PASS = False
+
+	shutil.rmtree(os.getcwd()+'/temp_test_exp/zip', True)
+	os.mkdir(os.getcwd()+'/temp_test_exp/zip')
+	b2.ExportAll(os.getcwd()+'/temp_test_exp/zip', password=password)
+	for path, data in members.items():
+		ename = os.getcwd()+'/temp_test_exp/zip/'+path.replace('/', '~')
+		if not os.path.exists(ename) or MD5.new(data).digest() != MD5.new(open(ename, 'rb').read()).digest():
+			print('This is wrong man, member `%s` is not the same after AddArchive!' % path)
+			TEST_PASS = False
+	report = b2.Verify(password=password, workers=1)
+	if report['bad'] or report['checked'] != TESTS:
+		print('This is wrong man, the verify of the zip members failed! %s' % report)
+		TEST_PASS = False
+	b2.Close()
+	del b2
+os.remove('test2.prv')
+os.remove(zpath)
+
+if TEST_PASS:
+	print('Test Ok, next test...\n')
+else:
+	print('Test Failed, next test...\n')
+
+
 if TEST_PASS:
 	print('All tests passed! Whee!\n')
 else: